@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+""" CPU cost of queueing lines and cutting them into PutLogEvents batches.
+
+Compares the byte accounted EventBatcher that LogSender uses against the old
+deque of decoded strings that were encoded again to measure each batch.
+Sending is left out, batches are just built and dropped.
+
+Measured on one core of a shared build host, 1M lines of the default length:
+
+    legacy   1.25 - 1.56 cpu s / 1M lines
+    batcher  1.40 - 1.65 cpu s / 1M lines
+
+and 1.90 s for both with 1000 byte lines. The two are within the noise of
+the measurement, about 15 percent, so the batcher is not faster per line.
+What it saves is encoding batches again when they are retried, and it
+closes batches by size, count and age as lines arrive.
+
+    python benchmarks/batching_benchmark.py [--lines N] [--line-length BYTES]
+"""
+import argparse
+import os
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ec2_utils.logs import EventBatcher
+
+
+class LegacyBatcher(object):
+    """ The queueing and batching that LogSender.send and _do_send used to do
+    """
+    def __init__(self):
+        self._messages = deque()
+
+    def send(self, line):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        self._messages.append(line.rstrip())
+
+    def do_send(self):
+        events = []
+        counter = 0
+        while len(self._messages) > 0 and counter < 1048576 and \
+                len(events) < 10000:
+            message = self._messages.popleft()
+            counter = counter + len(message.encode('utf-8', 'replace')) + 26
+            if counter > 1048576:
+                self._messages.appendleft(message)
+            elif message:
+                event = {}
+                event['timestamp'] = int(time.time() * 1000)
+                event['message'] = message
+                events.append(event)
+        return events
+
+
+def run_legacy(lines):
+    batcher = LegacyBatcher()
+    events = 0
+    for line in lines:
+        batcher.send(line)
+        if len(batcher._messages) >= 10000:
+            events += len(batcher.do_send())
+    while batcher._messages:
+        events += len(batcher.do_send())
+    return events
+
+
+def run_batcher(lines):
+    batcher = EventBatcher()
+    events = 0
+    for line in lines:
+        if batcher.add(line):
+            events += len(batcher.take_batch().events)
+    while len(batcher):
+        events += len(batcher.take_batch().events)
+    return events
+
+
+def measure(function, lines, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.process_time()
+        events = function(lines)
+        end = time.process_time()
+        if best is None or end - start < best:
+            best = end - start
+    return best, events
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=1000000,
+                        help="Number of lines to batch")
+    parser.add_argument("--line-length", type=int, default=120,
+                        help="Length of each line in bytes")
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="Rounds to run, the best is reported")
+    args = parser.parse_args()
+    line = b"2024-01-01T00:00:00.000Z INFO " + \
+        b"x" * max(0, args.line_length - 31) + b"\n"
+    lines = [line] * args.lines
+    print("%-10s %18s %12s" % ("batcher", "cpu s / 1M lines", "events"))
+    for name, function in (("legacy", run_legacy), ("batcher", run_batcher)):
+        seconds, events = measure(function, lines, args.rounds)
+        print("%-10s %18.3f %12d" % (name, seconds * 1000000.0 / args.lines,
+                                     events))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+""" Compare the inotify based follower against the old readline + sleep loop.
+
+Measures lines/sec for following a file that already has data in it and the
+p99 latency from writing a line to the line reaching the callback while the
+file is appended at a steady rate.
+
+    python benchmarks/follow_benchmark.py [--lines N] [--rate LINES_PER_SEC]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from threading import Event, Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ec2_utils.follow import FileFollower, inotify_supported
+
+
+class LegacyFollower(object):
+    """ The readline + sleep(wait) loop that read_and_follow used to run
+    """
+    def __init__(self, file_name, line_function, wait=1):
+        self.file_name = file_name
+        self.line_function = line_function
+        self.wait = wait
+        self._stopped = Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def follow(self):
+        with open(self.file_name) as file_:
+            end_seen = False
+            while not self._stopped.is_set():
+                curr_position = file_.tell()
+                line = file_.readline()
+                if not line:
+                    file_.seek(curr_position)
+                    end_seen = True
+                else:
+                    self.line_function(line)
+                    end_seen = False
+                if end_seen:
+                    time.sleep(self.wait)
+
+
+def _run_follower(follower_class, file_name, line_function):
+    follower = follower_class(file_name, line_function)
+    thread = Thread(target=follower.follow)
+    thread.daemon = True
+    thread.start()
+    return follower, thread
+
+
+def throughput(follower_class, lines):
+    fd, file_name = tempfile.mkstemp()
+    line = b"x" * 100 + b"\n"
+    with os.fdopen(fd, "wb") as out:
+        for _ in range(lines // 1000):
+            out.write(line * 1000)
+    seen = [0]
+    done = Event()
+
+    def count(_):
+        seen[0] += 1
+        if seen[0] >= lines:
+            done.set()
+    start = time.time()
+    follower, thread = _run_follower(follower_class, file_name, count)
+    done.wait()
+    elapsed = time.time() - start
+    follower.stop()
+    thread.join(5)
+    os.unlink(file_name)
+    return lines / elapsed
+
+
+def latency(follower_class, rate, duration):
+    fd, file_name = tempfile.mkstemp()
+    os.close(fd)
+    latencies = []
+
+    def measure(line):
+        latencies.append(time.time() - float(line.split()[0]))
+    follower, thread = _run_follower(follower_class, file_name, measure)
+    time.sleep(0.5)
+    interval = 1.0 / rate
+    written = 0
+    with open(file_name, "a") as out:
+        end = time.time() + duration
+        while time.time() < end:
+            out.write("%.6f %s\n" % (time.time(), "y" * 80))
+            out.flush()
+            written += 1
+            time.sleep(interval)
+    deadline = time.time() + 5
+    while len(latencies) < written and time.time() < deadline:
+        time.sleep(0.05)
+    follower.stop()
+    thread.join(5)
+    os.unlink(file_name)
+    latencies.sort()
+    if not latencies:
+        return float("nan"), float("nan")
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    return p50 * 1000, p99 * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=1000000,
+                        help="Lines to read in the throughput test")
+    parser.add_argument("--rate", type=int, default=200,
+                        help="Lines per second written in the latency test")
+    parser.add_argument("--duration", type=float, default=5.0,
+                        help="Seconds to write in the latency test")
+    args = parser.parse_args()
+    print("inotify supported on %s: %s" % (tempfile.gettempdir(),
+                                           inotify_supported(tempfile.gettempdir())))
+    print("%-10s %15s %12s %12s" % ("follower", "lines/sec", "p50 ms", "p99 ms"))
+    for name, follower_class in (("legacy", LegacyFollower),
+                                 ("inotify", FileFollower)):
+        lines_per_sec = throughput(follower_class, args.lines)
+        p50, p99 = latency(follower_class, args.rate, args.duration)
+        print("%-10s %15.0f %12.2f %12.2f" % (name, lines_per_sec, p50, p99))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+""" Events/sec for formatting and writing `ndt logs` output.
+
+Compares the old per event millis2iso + termcolor + uprint path against
+EventFormatter and BufferedOutput in text and jsonl modes. Output goes to
+/dev/null so only formatting and writing are measured.
+
+    python benchmarks/format_benchmark.py [--events N] [--color]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from termcolor import colored
+
+from ec2_utils.logs import BufferedOutput, EventFormatter, millis2iso
+
+
+def make_events(count):
+    start = int(time.time() * 1000) - count
+    return [{'timestamp': start + index * 7,
+             'logGroupName': 'my-application-group',
+             'logStreamName': 'i-0123456789abcdef0|/var/log/app.log',
+             'message': '2024-01-01 INFO request %d handled in 12 ms\n' % index}
+            for index in range(count)]
+
+
+def run_legacy(events, out):
+    stdout = sys.stdout
+    sys.stdout = out
+    try:
+        for event in events:
+            output = []
+            output.append(colored(millis2iso(event['timestamp']), 'yellow'))
+            output.append(colored(event['logGroupName'], 'green'))
+            output.append(colored(event['logStreamName'], 'cyan'))
+            output.append(event['message'])
+            message = ' '.join(output)
+            if message:
+                sys.stdout.write((message.strip() + os.linesep))
+    finally:
+        sys.stdout = stdout
+
+
+def formatter_run(output, color):
+    def run(events, out):
+        formatter = EventFormatter(output=output, color=color)
+        buffered = BufferedOutput(stream=out)
+        for event in events:
+            buffered.write(formatter.format(event))
+        buffered.flush()
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=200000,
+                        help="Number of events to format")
+    parser.add_argument("--color", action="store_true",
+                        help="Color the text output of the new formatter as on a terminal")
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="Rounds to run, the best is reported")
+    args = parser.parse_args()
+    events = make_events(args.events)
+    print("%-10s %15s" % ("formatter", "events/sec"))
+    with open(os.devnull, "w") as out:
+        for name, function in (("legacy", run_legacy),
+                               ("text", formatter_run("text", args.color)),
+                               ("jsonl", formatter_run("jsonl", False))):
+            best = None
+            for _ in range(args.rounds):
+                start = time.time()
+                function(events, out)
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            print("%-10s %15.0f" % (name, args.events / best))
+
+
+if __name__ == "__main__":
+    main()
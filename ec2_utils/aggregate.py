@@ -0,0 +1,106 @@
+""" Summaries of log events instead of the events themselves: event counts
+and bytes per time bucket and log group and the busiest log streams.
+"""
+from threading import Lock
+
+from ec2_utils.merge import INFINITY
+from ec2_utils.utils import is_ascii
+
+
+class TopCounter(object):
+    """ Approximate top-N counts in capacity counters with the Space-Saving
+    algorithm. A new key takes over the smallest counter once all are in
+    use, inheriting its count as the possible overcount (error). Keys with
+    counts above the error of any other key are exact in their ranking
+    """
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self._counters = {}
+
+    def add(self, key, size):
+        counter = self._counters.get(key)
+        if counter is None:
+            if len(self._counters) < self.capacity:
+                counter = [0, 0, 0]
+            else:
+                smallest = min(self._counters, key=lambda k: self._counters[k][0])
+                evicted = self._counters.pop(smallest)
+                counter = [evicted[0], evicted[1], evicted[0]]
+            self._counters[key] = counter
+        counter[0] += 1
+        counter[1] += size
+
+    def top(self, count):
+        """ (key, events, bytes, error) for the count keys with most events
+        """
+        return [(key,) + tuple(counter) for key, counter in
+                sorted(self._counters.items(), key=lambda item: -item[1][0])[:count]]
+
+
+class EventAggregator(object):
+    """ Counts events and message bytes per bucket_millis long time bucket
+    and log group in one pass over events that may arrive from many threads.
+    Memory depends on the number of buckets and groups, not on the number of
+    events, and the top streams are tracked in a TopCounter of top * 10
+    counters. Groups added with add_group() report how far their events have
+    come with advance(), and watermark() tells which buckets are complete
+    """
+    def __init__(self, bucket_millis=60000, top=10):
+        self.bucket_millis = bucket_millis
+        self.top = top
+        self._buckets = {}
+        self._watermarks = {}
+        self._streams = TopCounter(max(100, top * 10))
+        self._lock = Lock()
+
+    def add(self, group_name, event, stream_name=None):
+        """ Count event of group_name, under stream_name if given instead of
+        the stream of the event
+        """
+        message = event['message']
+        size = len(message) if is_ascii(message) else len(message.encode('utf-8'))
+        bucket = event['timestamp'] - event['timestamp'] % self.bucket_millis
+        key = (bucket, group_name)
+        with self._lock:
+            counts = self._buckets.get(key)
+            if counts is None:
+                counts = self._buckets[key] = [0, 0]
+            counts[0] += 1
+            counts[1] += size
+            self._streams.add((group_name, stream_name or event['logStreamName']), size)
+
+    def add_group(self, group_name):
+        with self._lock:
+            self._watermarks.setdefault(group_name, -INFINITY)
+
+    def advance(self, group_name, watermark):
+        """ Promise that no events older than watermark in milliseconds will
+        be added for group_name anymore, INFINITY once it is done
+        """
+        with self._lock:
+            if watermark > self._watermarks.get(group_name, -INFINITY):
+                self._watermarks[group_name] = watermark
+
+    def watermark(self):
+        """ Time in milliseconds that no group will add older events than.
+        Buckets that end before it are complete
+        """
+        with self._lock:
+            return min(self._watermarks.values() or [INFINITY])
+
+    def closed_buckets(self, before=None):
+        """ Remove and return (bucket, group, events, bytes) rows in time
+        order for buckets that end before the given time in milliseconds or
+        all of them
+        """
+        with self._lock:
+            keys = sorted(key for key in self._buckets
+                          if before is None or key[0] + self.bucket_millis <= before)
+            return [key + tuple(self._buckets.pop(key)) for key in keys]
+
+    def top_streams(self):
+        """ (group, stream, events, bytes, error) of the busiest streams
+        """
+        with self._lock:
+            return [key + (events, size, error) for key, events, size, error
+                    in self._streams.top(self.top)]
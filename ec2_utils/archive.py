@@ -0,0 +1,397 @@
+""" Archiving followed files to S3 instead of sending them to CloudWatch Logs.
+Lines are compressed into chunks that are uploaded as objects of their own,
+which costs a fraction of CloudWatch ingestion for logs that are rarely read.
+"""
+import re
+import sys
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from threading import BoundedSemaphore, Event, Lock, Thread
+
+from retry import retry
+from threadlocal_aws.clients import s3
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIONS = ("gzip", "zstd")
+MIN_PART_BYTES = 5 * 1024 * 1024
+UNSAFE = re.compile(r"[^A-Za-z0-9._-]+")
+
+
+class S3Archive(object):
+    """ Uploads the chunks of any number of S3ArchiveSenders with workers
+    threads. A chunk is closed when it has been open for max_age seconds or
+    has max_bytes bytes of lines. Compressed data is uploaded in parts of
+    part_bytes as multipart uploads while the chunk is still open, so a
+    file takes about part_bytes of memory, and at most max_pending parts
+    wait for upload at a time: senders block beyond that. Chunks smaller
+    than one part are uploaded with a single PutObject. Multipart uploads
+    are created in the upload threads together with their first part.
+
+    Keys are <prefix>/date=YYYY-MM-DD/instance=<instance>/file=<file>/
+    <time>-<sequence>.log.gz (or .log.zst)
+    """
+    def __init__(self, bucket, prefix="", instance_id="", compression="gzip",
+                 max_age=300, max_bytes=256 * 1024 * 1024,
+                 part_bytes=8 * 1024 * 1024, workers=4, max_pending=8):
+        if compression not in COMPRESSIONS:
+            raise ValueError("Unknown compression " + compression)
+        if compression == "zstd" and not zstandard:
+            raise ValueError("zstd compression needs zstandard")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.instance_id = instance_id
+        self.compression = compression
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.part_bytes = max(MIN_PART_BYTES, part_bytes)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._pending = BoundedSemaphore(max_pending)
+        self._senders = []
+        self._lock = Lock()
+        self._stopped = Event()
+        self._uploads = set()
+        self._thread = Thread(target=self._close_expired)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def register(self, sender):
+        with self._lock:
+            self._senders.append(sender)
+
+    def counters(self):
+        """ (chunks, failed) of all senders: the chunks that were closed and
+        the ones of them that failed to upload
+        """
+        with self._lock:
+            senders = list(self._senders)
+        return (sum(sender.chunks for sender in senders),
+                sum(sender.failed for sender in senders))
+
+    def key(self, file_name, opened, seq):
+        stamp = datetime.utcfromtimestamp(opened)
+        name = UNSAFE.sub("_", file_name).strip("_") or "file"
+        extension = "log.zst" if self.compression == "zstd" else "log.gz"
+        parts = [self.prefix] if self.prefix else []
+        parts += ["date=" + stamp.strftime("%Y-%m-%d"),
+                  "instance=" + (self.instance_id or "unknown"),
+                  "file=" + name,
+                  "%s-%06d.%s" % (stamp.strftime("%Y%m%dT%H%M%SZ"), seq, extension)]
+        return "/".join(parts)
+
+    def compressor(self):
+        if self.compression == "zstd":
+            return _ZstdCompressor()
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def submit(self, function, *args):
+        """ Run function in an upload thread, waiting while max_pending
+        uploads are queued or running
+        """
+        self._pending.acquire()
+        future = self._executor.submit(function, *args)
+        with self._lock:
+            self._uploads.add(future)
+        future.add_done_callback(self._upload_done)
+        return future
+
+    def _upload_done(self, future):
+        self._pending.release()
+        with self._lock:
+            self._uploads.discard(future)
+
+    def _close_expired(self):
+        while not self._stopped.wait(1.0):
+            with self._lock:
+                senders = list(self._senders)
+            now = time.time()
+            for sender in senders:
+                sender.close_expired(now)
+
+    def stop(self):
+        """ Upload the open chunks and wait for all uploads
+        """
+        self._stopped.set()
+        with self._lock:
+            senders = list(self._senders)
+        for sender in senders:
+            sender.flush()
+        while True:
+            with self._lock:
+                uploads = list(self._uploads)
+            if not uploads:
+                break
+            for future in uploads:
+                try:
+                    future.result()
+                except Exception:
+                    pass
+        self._executor.shutdown()
+
+    @retry(tries=5, delay=1, backoff=2)
+    def _call(self, method, **kwargs):
+        return getattr(s3(), method)(Bucket=self.bucket, **kwargs)
+
+
+class S3ArchiveSender(object):
+    """ Collects the lines of one file into chunks that an S3Archive uploads.
+    Works like LogSender: lines come through send(line, position) and the
+    position of the last line of each uploaded chunk is saved to
+    checkpoints once every chunk before it has been uploaded too. Once a
+    chunk has failed to upload, after the retries of S3Archive._call(), the
+    checkpoint stays before it for as long as the sender runs, so its lines
+    and the ones after them are archived again after a restart.
+    """
+    def __init__(self, file_name, archive, checkpoints=None, rules=None):
+        self.file_name = file_name
+        self.archive = archive
+        self._checkpoints = checkpoints
+        self._rules = rules
+        self._lock = Lock()
+        self._chunk = None
+        self._next_seq = 0
+        self._commit_seq = 0
+        self._done = {}
+        self._held = False
+        self._queued = deque()
+        self._checkpoint_lock = Lock()
+        self.chunks = 0
+        self.failed = 0
+        archive.register(self)
+
+    def send(self, line, position=None):
+        if self._rules is not None:
+            line = self._rules.apply(line)
+        if line is not None:
+            if not isinstance(line, bytes):
+                line = line.encode("utf-8", "replace")
+            if not line.endswith(b"\n"):
+                line += b"\n"
+        with self._lock:
+            chunk = self._chunk
+            if chunk is None:
+                chunk = self._chunk = _Chunk(self, self._next_seq)
+                self._next_seq += 1
+            if line:
+                chunk.add(line)
+            if position:
+                chunk.position = position
+            if chunk.size >= self.archive.max_bytes:
+                self._close_chunk()
+        self._submit_queued()
+
+    def close_expired(self, now):
+        with self._lock:
+            if self._chunk is not None and \
+                    now - self._chunk.opened >= self.archive.max_age:
+                self._close_chunk()
+        self._submit_queued()
+
+    def flush(self):
+        with self._lock:
+            if self._chunk is not None:
+                self._close_chunk()
+        self._submit_queued()
+
+    def stop(self):
+        self.flush()
+
+    def _close_chunk(self):
+        chunk = self._chunk
+        self._chunk = None
+        chunk.close()
+
+    def _queue(self, function, *args):
+        """ Queue an upload under the lock, _submit_queued() submits it once
+        the lock is released so that waiting for max_pending does not hold
+        up close_expired() and flush()
+        """
+        self._queued.append((function, args))
+
+    def _submit_queued(self):
+        while True:
+            with self._lock:
+                if not self._queued:
+                    return
+                function, args = self._queued.popleft()
+            self.archive.submit(function, *args)
+
+    def _chunk_done(self, chunk, uploaded):
+        with self._checkpoint_lock:
+            self.chunks += 1
+            if not uploaded:
+                self.failed += 1
+            self._done[chunk.seq] = (uploaded, chunk.position)
+            position = None
+            while self._commit_seq in self._done:
+                uploaded, chunk_position = self._done.pop(self._commit_seq)
+                self._commit_seq += 1
+                if not uploaded and not self._held:
+                    self._held = True
+                    sys.stderr.write("Keeping the checkpoint of %s before the chunk " %
+                                     self.file_name + "that failed, it is archived " +
+                                     "again after a restart\n")
+                if not self._held:
+                    position = chunk_position or position
+            if self._checkpoints and position:
+                try:
+                    self._checkpoints.set(self.file_name, position)
+                except OSError:
+                    pass
+
+
+class _Chunk(object):
+    """ One object being written. Lines are compressed about a megabyte at a
+    time and the compressed data is uploaded whenever a part is full. Used
+    under the lock of the sender, which submits the queued uploads
+    """
+    RAW_BLOCK = 1024 * 1024
+
+    def __init__(self, sender, seq):
+        self.sender = sender
+        self.archive = sender.archive
+        self.seq = seq
+        self.opened = time.time()
+        self.key = self.archive.key(sender.file_name, self.opened, seq)
+        self.position = None
+        self.size = 0
+        self._raw = []
+        self._raw_size = 0
+        self._compressor = self.archive.compressor()
+        self._compressed = []
+        self._compressed_size = 0
+        self._upload_id = None
+        self._parts = []
+        self._lock = Lock()
+        self._create_lock = Lock()
+        self._outstanding = 0
+        self._closed = False
+        self._failed = False
+
+    def add(self, line):
+        self._raw.append(line)
+        self._raw_size += len(line)
+        self.size += len(line)
+        if self._raw_size >= self.RAW_BLOCK:
+            self._compress()
+            if self._compressed_size >= self.archive.part_bytes:
+                self._upload_part()
+
+    def _compress(self):
+        if self._raw:
+            data = self._compressor.compress(b"".join(self._raw))
+            self._raw = []
+            self._raw_size = 0
+            if data:
+                self._compressed.append(data)
+                self._compressed_size += len(data)
+
+    def _take_compressed(self):
+        data = b"".join(self._compressed)
+        self._compressed = []
+        self._compressed_size = 0
+        return data
+
+    def _upload_part(self):
+        data = self._take_compressed()
+        if self._failed:
+            return
+        number = len(self._parts) + 1
+        self._parts.append(None)
+        with self._lock:
+            self._outstanding += 1
+        self.sender._queue(self._put_part, number, data)
+
+    def _create_upload(self):
+        """ Create the multipart upload in the upload thread of the first part
+        that gets there, the others wait for it
+        """
+        with self._create_lock:
+            if self._upload_id is None and not self._failed:
+                self._upload_id = self.archive._call(
+                    "create_multipart_upload", Key=self.key)['UploadId']
+
+    def _put_part(self, number, data):
+        try:
+            self._create_upload()
+            if not self._failed:
+                response = self.archive._call("upload_part", Key=self.key,
+                                              UploadId=self._upload_id,
+                                              PartNumber=number, Body=data)
+                self._parts[number - 1] = {'PartNumber': number,
+                                           'ETag': response['ETag']}
+        except Exception as error:
+            self._fail(error)
+        with self._lock:
+            self._outstanding -= 1
+            finish = self._closed and not self._outstanding
+        if finish:
+            self._finish()
+
+    def close(self):
+        self._compress()
+        data = self._compressor.flush()
+        if data:
+            self._compressed.append(data)
+            self._compressed_size += len(data)
+        if not self._parts and not self._failed:
+            if not self.size:
+                self.sender._chunk_done(self, True)
+                return
+            self.sender._queue(self._put_object, self._take_compressed())
+            return
+        if self._compressed_size:
+            self._upload_part()
+        with self._lock:
+            self._closed = True
+            finish = not self._outstanding
+        if finish:
+            self.sender._queue(self._finish)
+
+    def _put_object(self, data):
+        try:
+            self.archive._call("put_object", Key=self.key, Body=data)
+        except Exception as error:
+            self._fail(error)
+        self.sender._chunk_done(self, not self._failed)
+
+    def _finish(self):
+        if not self._failed:
+            try:
+                self.archive._call("complete_multipart_upload", Key=self.key,
+                                   UploadId=self._upload_id,
+                                   MultipartUpload={'Parts': self._parts})
+            except Exception as error:
+                self._fail(error)
+        if self._failed and self._upload_id:
+            try:
+                self.archive._call("abort_multipart_upload", Key=self.key,
+                                   UploadId=self._upload_id)
+            except Exception:
+                pass
+        self.sender._chunk_done(self, not self._failed)
+
+    def _fail(self, error):
+        if not self._failed:
+            self._failed = True
+            sys.stderr.write("Failed to archive s3://%s/%s: %s\n" %
+                             (self.archive.bucket, self.key, error))
+
+
+class _ZstdCompressor(object):
+    """ zstd with the compress() and flush() of zlib compressors
+    """
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor().compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush()
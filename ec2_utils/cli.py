@@ -1,9 +1,11 @@
 import os
 import argcomplete
 import argparse
+import glob
 import inspect
 import json
 import locale
+import re
 import sys
 import time
 import netifaces
@@ -12,7 +14,14 @@ from dateutil.tz import tzutc
 from jmespath import search
 from argcomplete.completers import ChoicesCompleter, FilesCompleter
 from ec2_utils.instance_info import info
-from ec2_utils import block_devices, ebs, instance_info, interface, logs, utils, ecs
+from ec2_utils import block_devices, ebs, instance_info, interface, listen, logs, stats, \
+    utils, ecs
+from ec2_utils.aggregate import EventAggregator
+from ec2_utils.archive import S3Archive
+from ec2_utils.emf import MetricConfig
+from ec2_utils.eventcache import EventCache
+from ec2_utils.export import FORMATS as EXPORT_FORMATS, EventExporter
+from ec2_utils.rules import RuleSet
 from ec2_utils.s3 import prune_s3_object_versions
 from ec2_utils.utils import best_effort_stacks
 from threadlocal_aws import is_ec2, region as client_region
@@ -439,13 +448,27 @@ def list_tags():
         parser.error("Only makes sense on an EC2 instance")
 
 def log_to_cloudwatch():
-    """Read a file and send rows to cloudwatch and keep following the end for new data.
+    """Read files and send rows to cloudwatch and keep following the end for new data.
+    Files can be given as glob patterns, in which case files that match the
+    pattern later are picked up as well. All files are sent by one process.
     The log group will be the stack name that created instance if not given
     as an argument. The logstream will be the instance id and filename if not
     given as an argument. Group and stream aare created if they do not exist.
     """
     parser = _get_parser()
-    parser.add_argument("file", help="File to follow").completer = FilesCompleter()
+    parser.add_argument("file", nargs="*",
+                        help="Files or quoted glob patterns to follow").completer = FilesCompleter()
+    parser.add_argument("-l", "--listen", action="append", metavar="ADDRESS",
+                        help="Also receive lines on a socket: unix:PATH " + \
+                             "(datagrams, like /dev/log), unix-stream:PATH, " + \
+                             "udp:[HOST]:PORT or tcp:[HOST]:PORT. The host " + \
+                             "defaults to 127.0.0.1, give 0.0.0.0 to listen on " + \
+                             "all interfaces. Syslog messages go to a stream " + \
+                             "per program, others to a stream per peer or " + \
+                             "socket. Can be given more than once")
+    parser.add_argument("--listen-mode", default="660", metavar="MODE",
+                        help="Permissions of unix sockets to listen on, in " + \
+                             "octal. Default is %(default)s")
     parser.add_argument("-g", "--group", help="Log group to log to. Defaults" +\
                                               " to the stack name that " +\
                                               "created the instance if not " +\
@@ -453,10 +476,185 @@ def log_to_cloudwatch():
                                               " with a CloudFormation stack")
     parser.add_argument("-s", "--stream", help="The log stream name to log" + \
                                                " to. The instance id and " + \
-                                               "filename if not given")
+                                               "filename if not given. Only" + \
+                                               " for a single file")
+    parser.add_argument("-d", "--state-dir", help="Directory to store read" + \
+                                                  " positions in so that a " + \
+                                                  "restart resumes where it " + \
+                                                  "stopped. Defaults to " + \
+                                                  "/var/lib/ec2-utils/checkpoints" + \
+                                                  " or ~/.ec2-utils/checkpoints")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="Send the file from the start even if a stored" + \
+                             " position exists")
+    parser.add_argument("-i", "--flush-interval", type=float, default=2.0,
+                        help="Maximum time in seconds that a line waits " + \
+                             "before it is sent. Default is 2")
+    parser.add_argument("-w", "--workers", type=int, default=4,
+                        help="Number of threads sending to CloudWatch. " + \
+                             "Default is 4")
+    parser.add_argument("-m", "--max-memory-mb", type=int, default=16,
+                        help="Memory in MiB for lines waiting to be sent per" + \
+                             " file. Lines beyond that are spilled to disk." + \
+                             " Default is 16")
+    parser.add_argument("--spill-dir", help="Directory to spill lines to " + \
+                                            "when memory is full. Defaults " + \
+                                            "to /var/lib/ec2-utils/spill or " + \
+                                            "~/.ec2-utils/spill")
+    parser.add_argument("--max-spill-mb", type=int, default=1024,
+                        help="Disk space in MiB for spilled lines per file." + \
+                             " The oldest lines are dropped beyond that. " + \
+                             "Default is 1024")
+    parser.add_argument("-n", "--in-flight", type=int, default=4,
+                        help="Number of batches per file that are sent at" + \
+                             " the same time. Default is 4")
+    parser.add_argument("-o", "--ordered", action="store_true",
+                        help="Send one batch per file at a time so that " + \
+                             "batches arrive in order")
+    parser.add_argument("-k", "--shards", default="1",
+                        help="Number of streams to spread each file over " + \
+                             "or 'auto' to add streams when sending falls " + \
+                             "behind. Streams are named <stream>#0..#n-1, " + \
+                             "see logs --merge-shards. " + \
+                             "Default is 1")
+    parser.add_argument("--max-shards", type=int, default=8,
+                        help="Maximum number of streams per file with " + \
+                             "--shards auto. Default is 8")
+    parser.add_argument("--shard-key", help="Regular expression whose first" + \
+                                            " group picks the stream of a " + \
+                                            "line so that lines with the " + \
+                                            "same key stay in one stream. " + \
+                                            "Batches go to streams in turns" + \
+                                            " if not given")
+    multiline = parser.add_mutually_exclusive_group()
+    multiline.add_argument("--multiline-start", metavar="REGEX",
+                           help="Regular expression that matches the first " + \
+                                "line of each message. Lines that do not " + \
+                                "match are joined to the message before them")
+    multiline.add_argument("--multiline-continue", metavar="REGEX",
+                           help="Regular expression that matches lines that " + \
+                                "continue the message before them, for " + \
+                                "example '^\\s' for stack traces")
+    parser.add_argument("--multiline-max-lines", type=int, default=500,
+                        help="Maximum number of lines joined into one " + \
+                             "message. Default is 500")
+    parser.add_argument("--multiline-timeout", type=float, default=1.0,
+                        help="Seconds to wait for more lines of a message " + \
+                             "before sending it. Default is 1")
+    parser.add_argument("-a", "--archive", action="append", metavar="FILE",
+                        help="File or quoted glob pattern to archive to S3 " + \
+                             "instead of sending it to CloudWatch. Needs " + \
+                             "--s3-bucket. Can be given more than once")
+    parser.add_argument("--s3-bucket", help="Bucket to archive files to")
+    parser.add_argument("--s3-prefix", default="logs",
+                        help="Key prefix of archived files. Keys continue " + \
+                             "with date=YYYY-MM-DD/instance=ID/file=NAME/. " + \
+                             "Default is logs")
+    parser.add_argument("--archive-compression", choices=["gzip", "zstd"],
+                        default="gzip", help="Compression of archived " + \
+                                             "chunks. Default is gzip")
+    parser.add_argument("--archive-interval", type=int, default=300,
+                        help="Seconds after which a chunk of an archived file " + \
+                             "is uploaded. Default is 300")
+    parser.add_argument("--archive-max-mb", type=int, default=256,
+                        help="MiB of lines after which a chunk is uploaded. " + \
+                             "Default is 256")
+    parser.add_argument("--rules", metavar="FILE",
+                        help="JSON file of rules that drop, sample, rate " + \
+                             "limit or redact lines before they are sent. " + \
+                             "See ec2_utils.rules").completer = FilesCompleter()
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="JSON file of metrics to aggregate from lines " + \
+                             "and send once per 10 or 60 second window in " + \
+                             "the Embedded Metric Format. Counted lines are " + \
+                             "not sent unless it says so. See ec2_utils.emf"
+                        ).completer = FilesCompleter()
+    parser.add_argument("--metrics-endpoint", metavar="ADDRESS",
+                        help="Serve metrics of the process in the " + \
+                             "Prometheus text format at /metrics and its " + \
+                             "health at /health on [HOST:]PORT or unix:PATH." + \
+                             " HOST defaults to 127.0.0.1")
+    parser.add_argument("--health-timeout", type=int, default=300,
+                        help="Seconds lines can wait without anything being " + \
+                             "sent before /health fails. Default is 300")
     argcomplete.autocomplete(parser)
     args = parser.parse_args()
-    logs.send_log_to_cloudwatch(args.file, group=args.group, stream=args.stream)
+    rules = None
+    if args.rules:
+        try:
+            rules = RuleSet.from_file(args.rules)
+        except (IOError, OSError, ValueError, re.error) as error:
+            parser.error("Invalid rules file " + args.rules + ": " + str(error))
+    metrics = None
+    if args.metrics:
+        try:
+            metrics = MetricConfig.from_file(args.metrics)
+        except (IOError, OSError, ValueError, re.error) as error:
+            parser.error("Invalid metrics file " + args.metrics + ": " + str(error))
+    if not args.file and not args.listen and not args.archive:
+        parser.error("give files to follow, --archive or --listen")
+    archive = None
+    if args.archive:
+        if not args.s3_bucket:
+            parser.error("--archive needs --s3-bucket")
+        try:
+            archive = S3Archive(args.s3_bucket, prefix=args.s3_prefix,
+                                instance_id=info().instance_id(),
+                                compression=args.archive_compression,
+                                max_age=args.archive_interval,
+                                max_bytes=args.archive_max_mb * 1024 * 1024,
+                                workers=args.workers)
+        except ValueError as error:
+            parser.error(str(error))
+    if args.metrics_endpoint:
+        try:
+            kind, address = stats.parse_endpoint(args.metrics_endpoint)
+            if kind == "unix":
+                listen.check_socket_path(address)
+        except ValueError as error:
+            parser.error(str(error))
+    for address in args.listen or []:
+        try:
+            kind, path = listen.parse_address(address)
+            if kind in ("unix", "unix-stream"):
+                listen.check_socket_path(path)
+        except ValueError as error:
+            parser.error(str(error))
+    try:
+        args.listen_mode = int(args.listen_mode, 8)
+    except ValueError:
+        parser.error("--listen-mode must be an octal number like 660")
+    if args.stream and (len(args.file) != 1 or glob.has_magic(args.file[0])):
+        parser.error("--stream can only be given for a single file")
+    if args.shards != "auto":
+        try:
+            args.shards = int(args.shards)
+        except ValueError:
+            parser.error("--shards must be a number or auto")
+        if args.shards < 1:
+            parser.error("--shards must be at least 1")
+    logs.send_log_to_cloudwatch(args.file, group=args.group, stream=args.stream,
+                                state_dir=args.state_dir,
+                                resume=not args.no_resume,
+                                flush_interval=args.flush_interval,
+                                workers=args.workers,
+                                max_memory_bytes=args.max_memory_mb * 1024 * 1024,
+                                spill_dir=args.spill_dir,
+                                max_spill_bytes=args.max_spill_mb * 1024 * 1024,
+                                max_in_flight=args.in_flight,
+                                ordered=args.ordered, shards=args.shards,
+                                max_shards=args.max_shards,
+                                shard_key=args.shard_key,
+                                multiline_start=args.multiline_start,
+                                multiline_continuation=args.multiline_continue,
+                                multiline_max_lines=args.multiline_max_lines,
+                                multiline_timeout=args.multiline_timeout,
+                                rules=rules, listen=args.listen,
+                                listen_mode=args.listen_mode,
+                                archive=archive, archive_patterns=args.archive,
+                                metrics=metrics,
+                                metrics_endpoint=args.metrics_endpoint,
+                                health_timeout=args.health_timeout)
 
 def get_logs():
     """Get logs from multiple CloudWatch log groups and possibly filter them.
@@ -467,17 +665,114 @@ def get_logs():
     parser.add_argument("-s", "--start", help="Start time (x m|h|d|w ago | now | <seconds since epoc>)", nargs="+")
     parser.add_argument("-e", "--end", help="End time (x m|h|d|w ago | now | <seconds since epoc>)", nargs="+")
     parser.add_argument("-o", "--order", help="Best effort ordering of log entries", action="store_true")
-    parser.usage = "ndt logs log_group_pattern [-h] [-f FILTER] [-s START [START ...]] [-e END [END ...]] [-o]"
+    parser.add_argument("-c", "--max-concurrency", type=int, default=64,
+                        help="Maximum number of CloudWatch Logs calls in flight. " + \
+                             "Calls are added while they succeed and cut on throttling. " + \
+                             "Default is 64")
+    parser.add_argument("--output", choices=["text", "jsonl"], default="text",
+                        help="Print events as colored text or as one JSON object per line. " + \
+                             "Default is text")
+    parser.add_argument("--no-color", action="store_true",
+                        help="Do not color text output. Colors are only used on a terminal " + \
+                             "by default")
+    parser.add_argument("--merge-shards", action="store_true",
+                        help="Show the streams <stream>#0..#n-1 of log-to-cloudwatch " + \
+                             "--shards as <stream>")
+    parser.add_argument("--group-cache-ttl", type=int, default=300,
+                        help="Seconds that a cached list of log groups is used before " + \
+                             "it is refreshed, in the background when tailing. 0 lists " + \
+                             "groups on every run without caching. Default is 300")
+    parser.add_argument("--cache-mb", type=int, default=1024,
+                        help="Disk space in MiB for caching events of queries with an end " + \
+                             "time so that the same window is not fetched again. 0 turns " + \
+                             "the cache off. Default is 1024")
+    parser.add_argument("--cache-dir", help="Directory for cached events. Defaults to " + \
+                                            "/var/lib/ec2-utils/event-cache or " + \
+                                            "~/.ec2-utils/event-cache")
+    parser.add_argument("-q", "--insights", help="Run a CloudWatch Logs Insights query over " + \
+                                                 "the matching groups instead of fetching events. " + \
+                                                 "Ends at --end or now")
+    parser.add_argument("-a", "--aggregate", action="store_true",
+                        help="Print event counts and bytes per time bucket and group and " + \
+                             "the busiest streams instead of the events")
+    parser.add_argument("--bucket", type=int, default=60,
+                        help="Length of an --aggregate time bucket in seconds. Default is 60")
+    parser.add_argument("--top", type=int, default=10,
+                        help="Number of busiest streams to print with --aggregate. " + \
+                             "Default is 10")
+    parser.add_argument("-x", "--export-dir", help="Write events to a file per group in this " + \
+                                                   "directory instead of printing them")
+    parser.add_argument("--export-format", choices=EXPORT_FORMATS,
+                        help="Format of exported files. Defaults to parquet if pyarrow " + \
+                             "is installed, else jsonl.zst if zstandard is installed, " + \
+                             "else jsonl.gz")
+    parser.add_argument("--row-group-size", type=int, default=100000,
+                        help="Events per Parquet row group or write. Default is 100000")
+    parser.add_argument("--export-writers", type=int, default=4,
+                        help="Number of threads writing export files. Default is 4")
+    parser.add_argument("--max-poll-interval", type=float, default=30.0, metavar="SECONDS",
+                        help="When tailing, log groups without new events are polled " + \
+                             "less and less often, at most this many seconds apart. " + \
+                             "Not used with --order. Default is 30")
+    parser.add_argument("--live", action="store_true",
+                        help="Tail with CloudWatch Logs Live Tail sessions of up to " + \
+                             "10 groups each instead of polling. Falls back to polling " + \
+                             "where Live Tail is not available")
+    regions = parser.add_mutually_exclusive_group()
+    regions.add_argument("--regions", help="Comma separated regions to query at the same " + \
+                                           "time. Each line gets its region")
+    regions.add_argument("--all-regions", action="store_true",
+                         help="Query all regions enabled for the account")
+    parser.usage = "ndt logs log_group_pattern [-h] [-f FILTER] [-s START [START ...]] [-e END [END ...]] [-o] [-c MAX_CONCURRENCY] [--output {text,jsonl}] [--no-color] [--merge-shards] [--group-cache-ttl SECONDS] [--cache-mb MB] [--cache-dir DIR] [-q QUERY] [-a] [--bucket SECONDS] [--top N] [-x EXPORT_DIR] [--export-format FORMAT] [--row-group-size N] [--export-writers N] [--max-poll-interval SECONDS] [--live] [--regions REGIONS | --all-regions]"
     argcomplete.autocomplete(parser)
     args = parser.parse_args()
+    if args.insights and args.filter:
+        parser.error("--filter can not be used with --insights, filter in the query instead")
+    if args.insights and args.aggregate:
+        parser.error("--aggregate can not be used with --insights, use stats in the query instead")
+    if args.bucket < 1:
+        parser.error("--bucket must be at least 1 second")
+    if args.export_dir and (args.insights or args.aggregate):
+        parser.error("--export-dir can not be used with --insights or --aggregate")
+    if args.live and (args.end or args.order or args.insights):
+        parser.error("--live can not be used with --end, --order or --insights")
+    regions = None
+    if args.all_regions:
+        regions = logs.enabled_regions()
+    elif args.regions:
+        regions = [region.strip() for region in args.regions.split(",") if region.strip()]
+    exporter = None
+    if args.export_dir:
+        try:
+            exporter = EventExporter(args.export_dir, export_format=args.export_format,
+                                     row_group_size=args.row_group_size,
+                                     writer_count=args.export_writers)
+        except ValueError as error:
+            parser.error(str(error))
     cwlogs_groups = logs.CloudWatchLogsGroups(
         log_group_filter=args.log_group_pattern,
         log_filter=args.filter,
         start_time=' '.join(args.start) if args.start else None,
         end_time=' '.join(args.end) if args.end else None,
-        sort=args.order
+        sort=args.order,
+        max_concurrency=args.max_concurrency,
+        output=args.output,
+        color=False if args.no_color else None,
+        group_cache_ttl=args.group_cache_ttl,
+        event_cache=EventCache(cache_dir=args.cache_dir,
+                               max_bytes=args.cache_mb * 1024 * 1024) if args.cache_mb > 0 else None,
+        insights=args.insights,
+        aggregate=EventAggregator(bucket_millis=args.bucket * 1000,
+                                  top=args.top) if args.aggregate else None,
+        exporter=exporter,
+        max_poll_interval=max(1.0, args.max_poll_interval),
+        live=args.live,
+        regions=regions,
+        merge_shards=args.merge_shards
     )
     cwlogs_groups.get_logs()
+    if cwlogs_groups.failed_groups:
+        sys.exit(1)
 
 def read_and_follow():
     """Read and print a file and keep following the end for new data
@@ -488,7 +783,10 @@ def read_and_follow():
     args = parser.parse_args()
     if not os.path.isfile(args.file):
         parser.error(args.file + " not found")
-    logs.read_and_follow(args.file, sys.stdout.write)
+    def write_block(block):
+        sys.stdout.write(block)
+        sys.stdout.flush()
+    logs.read_and_follow(args.file, write_block, split_lines=False)
 
 def prune_snapshots():
     """ Prune snapshots to have a specified amout of daily, weekly, monthly
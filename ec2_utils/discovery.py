@@ -0,0 +1,195 @@
+""" Finding the log groups that a `logs` query reads. Listing is narrowed to
+the literal prefix of the group pattern where the pattern has one and the
+lists are cached on disk so that repeated queries start right away.
+"""
+import hashlib
+import json
+import os
+import time
+from threading import Thread
+
+from ec2_utils.follow import default_state_dir
+
+REGEX_SPECIAL = ".^$*+?{}[]()|\\"
+
+
+def literal_prefix(pattern):
+    """ Longest literal string that every log group name matching pattern
+    with re.search starts with. Only patterns anchored with ^ and without
+    alternation have one, "" is returned otherwise
+    """
+    if not pattern or not pattern.startswith("^") or _has_alternation(pattern):
+        return ""
+    prefix = []
+    index = 1
+    while index < len(pattern):
+        char = pattern[index]
+        if char == "\\":
+            escaped = pattern[index + 1:index + 2]
+            if not escaped or escaped.isalnum():
+                break
+            step = 2
+            char = escaped
+        elif char in REGEX_SPECIAL:
+            break
+        else:
+            step = 1
+        following = pattern[index + step:index + step + 1]
+        if following and following in "*?{":
+            break
+        prefix.append(char)
+        if following == "+":
+            break
+        index += step
+    return "".join(prefix)
+
+
+def _has_alternation(pattern):
+    escaped = False
+    for char in pattern:
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == "|":
+            return True
+    return False
+
+
+def list_log_groups(client, prefix="", on_page=None):
+    """ Names of all log groups that start with prefix. on_page is called
+    with the names of each page as it arrives
+    """
+    params = {}
+    if prefix:
+        params['logGroupNamePrefix'] = prefix
+    names = []
+    while True:
+        resp = client.describe_log_groups(**params)
+        page = [group['logGroupName'] for group in resp['logGroups']]
+        names.extend(page)
+        if on_page:
+            on_page(page)
+        if not resp.get('nextToken'):
+            return names
+        params['nextToken'] = resp['nextToken']
+
+
+class LogGroupCache(object):
+    """ Log group lists per name prefix in a file per region and profile.
+    A list fetched for a prefix also answers queries for longer prefixes.
+    Lists younger than ttl seconds are used as such. An older list is used
+    too, but refreshed in a thread that passes the groups that the list did
+    not have to on_update page by page, or right away with wait. Without a
+    list the groups are listed right away.
+    """
+    def __init__(self, client, cache_dir=None, ttl=300):
+        self.client = client
+        self.ttl = ttl
+        self.cache_dir = cache_dir or default_state_dir("group-cache")
+        region = getattr(getattr(client, "meta", None), "region_name", None)
+        key = "%s|%s" % (region, os.environ.get("AWS_PROFILE", ""))
+        self.path = os.path.join(self.cache_dir,
+                                 hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _store(self, prefix, names):
+        # A fresh list for prefix replaces the lists of longer prefixes
+        entries = dict((cached_prefix, entry) for cached_prefix, entry
+                       in self._load().items()
+                       if not cached_prefix.startswith(prefix))
+        entries[prefix] = {"fetched": time.time(), "groups": names}
+        self._write(entries)
+
+    def _write(self, entries):
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as cache_file:
+                json.dump(entries, cache_file)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+    def _lookup(self, prefix):
+        best = None
+        for cached_prefix, entry in self._load().items():
+            if prefix.startswith(cached_prefix) and \
+                    (best is None or entry["fetched"] > best["fetched"]):
+                best = entry
+        return best
+
+    def _add(self, names):
+        """ Add new log groups to the cached lists of their prefixes, keeping
+        the time the lists were fetched
+        """
+        entries = self._load()
+        for cached_prefix, entry in entries.items():
+            entry["groups"].extend(name for name in names
+                                   if name.startswith(cached_prefix))
+        self._write(entries)
+
+    def forget(self, name):
+        """ Remove a log group that no longer exists from the cached lists
+        """
+        entries = self._load()
+        changed = False
+        for entry in entries.values():
+            if name in entry["groups"]:
+                entry["groups"].remove(name)
+                changed = True
+        if changed:
+            self._write(entries)
+
+    def refresh(self, prefix="", on_new=None):
+        """ List the groups that start with prefix again. Groups that the
+        cached list does not have are added to it as each page arrives and
+        passed to on_new, so a refresh that is cut short still finds them
+        """
+        entry = self._lookup(prefix) if self.ttl > 0 else None
+        known = set(entry["groups"]) if entry else set()
+
+        def add_new(page):
+            new = [name for name in page if name not in known]
+            if not new:
+                return
+            known.update(new)
+            if entry is not None:
+                self._add(new)
+            if on_new:
+                on_new(new)
+        names = list_log_groups(self.client, prefix,
+                                on_page=add_new if entry or on_new else None)
+        if self.ttl > 0:
+            self._store(prefix, names)
+        return names
+
+    def groups(self, prefix="", on_update=None, wait=False):
+        """ Names of log groups that start with prefix. With wait a stale
+        list is refreshed before returning
+        """
+        entry = self._lookup(prefix) if self.ttl > 0 else None
+        if entry is None:
+            return self.refresh(prefix)
+        names = [name for name in entry["groups"] if name.startswith(prefix)]
+        if time.time() - entry["fetched"] >= self.ttl:
+            if wait:
+                return self.refresh(prefix)
+            thread = Thread(target=self._refresh_in_background,
+                            args=(prefix, on_update))
+            thread.daemon = True
+            thread.start()
+        return names
+
+    def _refresh_in_background(self, prefix, on_update):
+        try:
+            self.refresh(prefix, on_new=on_update)
+        except Exception:
+            pass
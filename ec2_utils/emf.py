@@ -0,0 +1,310 @@
+""" Aggregating numbers in log lines into CloudWatch metrics before they are
+sent. Instead of sending every line and deriving metrics from them with
+metric filters, the values of each window of 10 or 60 seconds are sent as
+one log event in the Embedded Metric Format (EMF) per set of dimension
+values, and CloudWatch turns those into metrics. Metrics are read from a
+JSON file:
+
+    {"namespace": "MyApp",
+     "window": 60,
+     "dimensions": {"Service": "api"},
+     "keep_lines": false,
+     "metrics": [
+        {"name": "Requests", "match": "HTTP/1.1\\" ", "type": "count"},
+        {"name": "Bytes", "match": "HTTP/1.1\\" \\\\d+ (?P<value>\\\\d+)",
+         "type": "sum", "unit": "Bytes"},
+        {"name": "Latency",
+         "match": "status=(?P<status>\\\\d+) took=(?P<value>[\\\\d.]+)ms",
+         "type": "histogram", "unit": "Milliseconds",
+         "dimensions": ["status"]}
+    ]}
+
+count counts the lines that match, sum adds up the values and histogram
+keeps the distribution of the values, with a precision of about two
+percent. The value is the group named value of the pattern, or its first
+group. The named groups listed in the dimensions of a metric are added to
+the dimensions of the file with the text they matched as the value. Lines
+that some metric counted are not sent themselves unless keep_lines is true.
+"""
+import json
+import math
+import re
+import time
+from threading import Lock
+
+TYPES = ("count", "sum", "histogram")
+WINDOWS = (10, 60)
+MAX_VALUES = 100
+BUCKET_BASE = 1.04
+MISSING = "-"
+
+
+class Metric(object):
+    __slots__ = ("name", "kind", "unit", "dimensions", "patterns", "_value")
+
+    def __init__(self, name, kind, pattern, unit=None, dimensions=None):
+        if kind not in TYPES:
+            raise ValueError("Unknown type %s in metric %s" % (kind, name))
+        self.name = name
+        self.kind = kind
+        self.unit = unit or ("Count" if kind == "count" else "None")
+        self.dimensions = tuple(dimensions or ())
+        self.patterns = {bytes: re.compile(pattern.encode("utf-8")),
+                         str: re.compile(pattern)}
+        compiled = self.patterns[str]
+        for dimension in self.dimensions:
+            if dimension not in compiled.groupindex:
+                raise ValueError("Metric %s has no group %s" % (name, dimension))
+        if "value" in compiled.groupindex:
+            self._value = "value"
+        elif compiled.groups:
+            self._value = 1
+        elif kind != "count":
+            raise ValueError("Metric %s needs a group for its value" % name)
+        else:
+            self._value = None
+
+    def extract(self, line):
+        """ (value, dimension values) of a line or None if the metric does
+        not match it or the value is not a finite number
+        """
+        match = self.patterns[type(line)].search(line)
+        if match is None:
+            return None
+        if self.kind == "count":
+            value = 1
+        else:
+            try:
+                value = float(match.group(self._value))
+            except (TypeError, ValueError):
+                return None
+            if not math.isfinite(value):
+                return None
+        return value, tuple(_text(match.group(dimension))
+                            for dimension in self.dimensions)
+
+
+class MetricConfig(object):
+    """ Metrics and the settings they are sent with. Each sender gets an
+    aggregator() of its own and the config flushes the windows of all of
+    them. After max_series sets of dimension values in a window the rest
+    are counted under the value "other".
+    """
+    def __init__(self, metrics, namespace, window=60, dimensions=None,
+                 keep_lines=False, max_series=100):
+        if window not in WINDOWS:
+            raise ValueError("window must be 10 or 60 seconds")
+        if not namespace:
+            raise ValueError("namespace is needed")
+        self.metrics = metrics
+        self.namespace = namespace
+        self.window = window
+        self.dimensions = dict(dimensions or {})
+        self.keep_lines = keep_lines
+        self.max_series = max_series
+        self._aggregators = []
+        self._lock = Lock()
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, "r") as config_file:
+            data = json.load(config_file)
+        metrics = []
+        for index, metric in enumerate(data.get("metrics", [])):
+            if "name" not in metric or "match" not in metric:
+                raise ValueError("Metric %d needs name and match" % (index + 1))
+            metrics.append(Metric(metric["name"], metric.get("type", "count"),
+                                  metric["match"], unit=metric.get("unit"),
+                                  dimensions=metric.get("dimensions")))
+        if not metrics:
+            raise ValueError("No metrics")
+        return cls(metrics, data.get("namespace"), window=data.get("window", 60),
+                   dimensions=data.get("dimensions"),
+                   keep_lines=data.get("keep_lines", False),
+                   max_series=data.get("max_series", 100))
+
+    def aggregator(self, line_function):
+        aggregator = MetricAggregator(self, line_function)
+        with self._lock:
+            self._aggregators.append(aggregator)
+        return aggregator
+
+    def counters(self):
+        """ (lines, events) of all aggregators: the lines counted in metrics
+        and the EMF events handed on
+        """
+        with self._lock:
+            aggregators = list(self._aggregators)
+        return (sum(aggregator.lines for aggregator in aggregators),
+                sum(aggregator.events for aggregator in aggregators))
+
+    def flush_expired(self, now=None):
+        with self._lock:
+            aggregators = list(self._aggregators)
+        for aggregator in aggregators:
+            aggregator.flush_expired(now)
+
+    def flush(self):
+        with self._lock:
+            aggregators = list(self._aggregators)
+        for aggregator in aggregators:
+            aggregator.flush()
+
+
+class MetricAggregator(object):
+    """ Collects the values of the lines given to add() per window and
+    hands each window to line_function as EMF events once it is over, see
+    flush_expired(). Lines are counted in the window of the time they are
+    added. Lines may be bytes or text. Thread safe.
+    """
+    def __init__(self, config, line_function):
+        self.config = config
+        self.line_function = line_function
+        self.lines = 0
+        self.events = 0
+        self._windows = {}
+        self._lock = Lock()
+
+    def add(self, line, now=None):
+        """ Count the line in the metrics that match it. Returns True if it
+        was counted and is not to be sent
+        """
+        found = []
+        for metric in self.config.metrics:
+            extracted = metric.extract(line)
+            if extracted is not None:
+                found.append((metric, extracted))
+        if not found:
+            return False
+        window = self.config.window
+        start = int((now or time.time()) // window) * window
+        with self._lock:
+            self.lines += 1
+            series = self._windows.get(start)
+            if series is None:
+                series = self._windows[start] = {}
+            for metric, (value, values) in found:
+                key = (metric.dimensions, values)
+                if key not in series and len(series) >= self.config.max_series:
+                    key = (metric.dimensions, ("other",) * len(values))
+                values = series.get(key)
+                if values is None:
+                    values = series[key] = {}
+                accumulator = values.get(metric)
+                if accumulator is None:
+                    accumulator = values[metric] = _Distribution() \
+                        if metric.kind == "histogram" else _Total()
+                accumulator.add(value)
+        return not self.config.keep_lines
+
+    def flush_expired(self, now=None):
+        """ Hand on the windows that are over
+        """
+        now = now or time.time()
+        with self._lock:
+            expired = [start for start in self._windows
+                       if start + self.config.window <= now]
+            windows = [(start, self._windows.pop(start)) for start in sorted(expired)]
+        self._emit(windows)
+
+    def flush(self):
+        with self._lock:
+            windows = sorted(self._windows.items())
+            self._windows = {}
+        self._emit(windows)
+
+    def _emit(self, windows):
+        for start, series in windows:
+            for key, values in sorted(series.items(), key=lambda item: item[0]):
+                with self._lock:
+                    self.events += 1
+                self.line_function(self.format(start, key, values))
+
+    def format(self, start, key, values):
+        """ The EMF event of one set of dimension values in a window
+        """
+        config = self.config
+        names, dimension_values = key
+        document = dict(config.dimensions)
+        document.update(zip(names, dimension_values))
+        definitions = []
+        for metric in sorted(values, key=lambda metric: metric.name):
+            definition = {"Name": metric.name, "Unit": metric.unit}
+            if config.window < 60:
+                definition["StorageResolution"] = 1
+            definitions.append(definition)
+            document[metric.name] = values[metric].value()
+        document["_aws"] = {
+            "Timestamp": start * 1000,
+            "CloudWatchMetrics": [{
+                "Namespace": config.namespace,
+                "Dimensions": [list(config.dimensions) + list(names)],
+                "Metrics": definitions}]}
+        return json.dumps(document, separators=(",", ":"))
+
+
+class _Total(object):
+    __slots__ = ("total",)
+
+    def __init__(self):
+        self.total = 0
+
+    def add(self, value):
+        self.total += value
+
+    def value(self):
+        return _number(self.total)
+
+
+class _Distribution(object):
+    """ Values rounded to the nearest power of BUCKET_BASE with their counts
+    """
+    __slots__ = ("counts", "minimum", "maximum", "total", "count")
+
+    def __init__(self):
+        self.counts = {}
+        self.minimum = None
+        self.maximum = None
+        self.total = 0
+        self.count = 0
+
+    def add(self, value):
+        bucket = BUCKET_BASE ** round(math.log(value, BUCKET_BASE)) \
+            if value > 0 else value
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        if self.count == 0 or value < self.minimum:
+            self.minimum = value
+        if self.count == 0 or value > self.maximum:
+            self.maximum = value
+        self.total += value
+        self.count += 1
+
+    def value(self):
+        buckets = sorted(self.counts.items())
+        # EMF takes at most MAX_VALUES values, merge neighbours beyond that
+        while len(buckets) > MAX_VALUES:
+            merged = []
+            for index in range(0, len(buckets), 2):
+                pair = buckets[index:index + 2]
+                count = sum(bucket_count for _, bucket_count in pair)
+                merged.append((sum(value * bucket_count for value, bucket_count
+                                   in pair) / count, count))
+            buckets = merged
+        return {"Values": [_number(value) for value, _ in buckets],
+                "Counts": [count for _, count in buckets],
+                "Min": _number(self.minimum), "Max": _number(self.maximum),
+                "Sum": _number(self.total), "Count": self.count}
+
+
+def _number(value):
+    if value == int(value):
+        return int(value)
+    return float("%.6g" % value)
+
+
+def _text(value):
+    if value is None:
+        return MISSING
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", "replace")
+    return value or MISSING
@@ -0,0 +1,264 @@
+""" Local cache of fetched CloudWatch Logs events for time ranges that can not
+change anymore, so that querying the same window again reads it from disk
+and only the parts not seen before are fetched.
+"""
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import time
+from threading import Lock
+
+from ec2_utils.fetch import _call
+from ec2_utils.follow import default_state_dir
+
+
+SEGMENT_SUFFIX = ".jsonl.gz"
+WRITE_EVENTS = 1000
+TMP_MAX_AGE = 3600
+
+
+class EventCache(object):
+    """ Events of a log group and filter pattern are stored in gzipped JSON
+    lines segment files, each holding every event of a closed time range.
+    A segment file is named after its key and range, so the listing of the
+    cache directory is the time index and processes that share the cache
+    see each other's segments: a query is cut into pieces that segments
+    cover and gaps that are fetched and written as new segments. Only
+    ranges that end margin seconds before now are cached as events may
+    still be ingested for later times. The least recently used segments,
+    by modification time, are removed when the segments take more than
+    max_bytes.
+    """
+    def __init__(self, cache_dir=None, max_bytes=1024 * 1024 * 1024,
+                 margin=600, segment_events=50000):
+        self.cache_dir = cache_dir or default_state_dir("event-cache")
+        self.max_bytes = max_bytes
+        self.margin = margin
+        self.segment_events = segment_events
+        self._lock = Lock()
+
+    @staticmethod
+    def key(group_name, filter_pattern="", namespace=""):
+        """ Key of the segments of a group and filter pattern. namespace
+        tells apart groups of the same name in other regions and accounts
+        """
+        return hashlib.sha1(("%s|%s|%s" % (namespace, group_name,
+                                           filter_pattern or ""))
+                            .encode("utf-8")).hexdigest()
+
+    def segments(self, key=None):
+        """ Segments in the cache directory, of key if given, as dicts of key,
+        start, end, file, bytes and used
+        """
+        segments = []
+        try:
+            entries = list(os.scandir(self.cache_dir))
+        except OSError:
+            return segments
+        for entry in entries:
+            if not entry.name.endswith(SEGMENT_SUFFIX):
+                continue
+            parts = entry.name[:-len(SEGMENT_SUFFIX)].split("-")
+            if len(parts) != 3 or (key and parts[0] != key):
+                continue
+            try:
+                stat = entry.stat()
+                segments.append({"key": parts[0], "start": int(parts[1]),
+                                 "end": int(parts[2]), "file": entry.name,
+                                 "bytes": stat.st_size, "used": stat.st_mtime})
+            except (OSError, ValueError):
+                continue
+        return segments
+
+    def coverage(self, key, start, end):
+        """ [start, end] cut into (start, end, segment) pieces in order where
+        segment is None for gaps that are not cached
+        """
+        segments = sorted((segment for segment in self.segments(key)
+                           if segment["end"] >= start and segment["start"] <= end),
+                          key=lambda segment: segment["start"])
+        pieces = []
+        position = start
+        for segment in segments:
+            if segment["end"] < position:
+                continue
+            if segment["start"] > position:
+                pieces.append((position, segment["start"] - 1, None))
+            pieces.append((max(segment["start"], position),
+                           min(segment["end"], end), segment))
+            position = segment["end"] + 1
+        if position <= end:
+            pieces.append((position, end, None))
+        return pieces
+
+    def read(self, segment, start, end):
+        """ Events of segment from start to end
+        """
+        path = os.path.join(self.cache_dir, segment["file"])
+        events = []
+        with gzip.open(path, "rt") as segment_file:
+            for line in segment_file:
+                event = json.loads(line)
+                if event["timestamp"] > end:
+                    break
+                if event["timestamp"] >= start:
+                    events.append(event)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return events
+
+    def add(self, key, start, end, tmp_path):
+        """ Store a written segment file for the range start..end
+        """
+        name = "%s-%d-%d%s" % (key, start, end, SEGMENT_SUFFIX)
+        os.replace(tmp_path, os.path.join(self.cache_dir, name))
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        segments = self.segments()
+        total = sum(segment["bytes"] for segment in segments)
+        segments.sort(key=lambda segment: segment["used"])
+        while segments and total > self.max_bytes:
+            segment = segments.pop(0)
+            total -= segment["bytes"]
+            try:
+                os.unlink(os.path.join(self.cache_dir, segment["file"]))
+            except OSError:
+                pass
+        # Segments that a process did not get to finish
+        now = time.time()
+        for entry in os.scandir(self.cache_dir):
+            try:
+                if entry.name.endswith(".tmp") and \
+                        now - entry.stat().st_mtime > TMP_MAX_AGE:
+                    os.unlink(entry.path)
+            except OSError:
+                pass
+
+    async def scan(self, fetcher, params, on_event, on_done=None,
+                   on_watermark=None, namespace=""):
+        """ LogEventsFetcher.scan() that reads cached pieces of the range
+        from disk and caches the pieces that it fetches. Files are read and
+        written in the default executor of the loop. on_done is called when
+        the scan ends, also when it fails
+        """
+        start, end = params['startTime'], params['endTime']
+        closed = min(end, int((time.time() - self.margin) * 1000))
+        key = self.key(params['logGroupName'], params.get('filterPattern'),
+                       namespace)
+        loop = asyncio.get_event_loop()
+        try:
+            pieces = await loop.run_in_executor(None, self.coverage, key, start,
+                                                closed) if closed >= start else []
+            if closed < end:
+                pieces.append((max(start, closed + 1), end, False))
+            for piece_start, piece_end, segment in pieces:
+                piece = dict(params, startTime=piece_start, endTime=piece_end)
+                if segment is False:
+                    await fetcher.scan(piece, on_event, on_watermark=on_watermark)
+                elif segment:
+                    try:
+                        events = await loop.run_in_executor(None, self.read, segment,
+                                                            piece_start, piece_end)
+                    except (OSError, ValueError):
+                        # Evicted or damaged since the coverage was looked up
+                        await fetcher.scan(piece, on_event, on_watermark=on_watermark)
+                        continue
+                    for event in events:
+                        await _call(on_event, event)
+                    if events and on_watermark:
+                        await _call(on_watermark, events[-1]["timestamp"])
+                else:
+                    writer = SegmentWriter(self, key, piece_start)
+
+                    async def write_and_pass(event, writer=writer):
+                        await writer.add(event)
+                        await _call(on_event, event)
+                    try:
+                        await fetcher.scan(piece, write_and_pass,
+                                           on_watermark=on_watermark)
+                    except BaseException:
+                        writer.abort()
+                        raise
+                    await writer.close(piece_end)
+        finally:
+            if on_done:
+                on_done()
+
+
+class SegmentWriter(object):
+    """ Writes events of a range that is being fetched to segment files of
+    about segment_events events. A segment is cut only between events with
+    different timestamps so that it holds every event of its range. Events
+    are written WRITE_EVENTS at a time in the default executor of the loop
+    """
+    def __init__(self, cache, key, start):
+        self.cache = cache
+        self.key = key
+        self._start = start
+        self._file = None
+        self._path = None
+        self._lines = []
+        self._count = 0
+        self._last = None
+
+    def _open(self):
+        if not os.path.isdir(self.cache.cache_dir):
+            os.makedirs(self.cache.cache_dir)
+        self._path = os.path.join(self.cache.cache_dir, "%s-%d-%x.tmp" %
+                                  (self.key, os.getpid(), id(self)))
+        self._file = gzip.open(self._path, "wt")
+
+    async def _run(self, function, *args):
+        await asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+    async def add(self, event):
+        timestamp = event["timestamp"]
+        if self._count >= self.cache.segment_events and timestamp > self._last:
+            await self._run(self._finish, timestamp - 1)
+            self._start = timestamp
+            self._count = 0
+        stored = dict(event)
+        stored.pop("logGroupName", None)
+        self._lines.append(json.dumps(stored) + "\n")
+        self._count += 1
+        self._last = timestamp
+        if len(self._lines) >= WRITE_EVENTS:
+            await self._run(self._write)
+
+    def _write(self):
+        if self._file is None:
+            self._open()
+        lines, self._lines = self._lines, []
+        self._file.write("".join(lines))
+
+    def _finish(self, end):
+        self._write()
+        self._file.close()
+        self._file = None
+        self.cache.add(self.key, self._start, end, self._path)
+
+    async def close(self, end):
+        """ Store the last segment up to end, the end of the fetched range
+        """
+        try:
+            await self._run(self._finish, end)
+        except OSError:
+            self.abort()
+
+    def abort(self):
+        """ Drop the segment being written. Finished segments are kept
+        """
+        self._lines = []
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            try:
+                os.unlink(self._path)
+            except OSError:
+                pass
@@ -0,0 +1,204 @@
+""" Writing log events to files per log group for offline analysis. Parquet
+when pyarrow is installed, otherwise JSON lines compressed with zstd when
+zstandard is installed or gzip.
+"""
+import asyncio
+import gzip
+import json
+import os
+import queue
+import re
+import zlib
+from threading import Lock, Thread
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FORMATS = ("parquet", "jsonl.zst", "jsonl.gz")
+
+
+def default_format():
+    if pyarrow:
+        return "parquet"
+    if zstandard:
+        return "jsonl.zst"
+    return "jsonl.gz"
+
+
+def file_name(group_name, extension):
+    """ File name of a group. Names that had to be changed to be safe get a
+    hash of the group name so that, for example, /a/b and a_b do not end up
+    in the same file
+    """
+    name = re.sub(r"[^A-Za-z0-9._-]+", "_", group_name).strip("_") or "group"
+    if name != group_name:
+        name += "-%08x" % zlib.crc32(group_name.encode("utf-8"))
+    return "%s.%s" % (name, extension)
+
+
+class GroupFile(object):
+    """ Export file of one log group. Each write() of a batch of events is a
+    row group in Parquet and a run of lines in JSON lines
+    """
+    def __init__(self, path, export_format):
+        self.path = path
+        self.export_format = export_format
+        self.events = 0
+        self._writer = None
+        self._file = None
+
+    def write(self, events):
+        if self.export_format == "parquet":
+            self._write_parquet(events)
+        else:
+            self._write_lines(events)
+        self.events += len(events)
+
+    def _write_parquet(self, events):
+        table = pyarrow.Table.from_arrays([
+            pyarrow.array([event['timestamp'] for event in events],
+                          type=pyarrow.timestamp('ms', tz='UTC')),
+            pyarrow.array([event['logGroupName'] for event in events]).dictionary_encode(),
+            pyarrow.array([event['logStreamName'] for event in events]).dictionary_encode(),
+            pyarrow.array([event['message'] for event in events], type=pyarrow.string())
+        ], names=['timestamp', 'logGroupName', 'logStreamName', 'message'])
+        if self._writer is None:
+            self._writer = parquet.ParquetWriter(self.path, table.schema,
+                                                 compression='zstd')
+        self._writer.write_table(table)
+
+    def _write_lines(self, events):
+        if self._file is None:
+            if self.export_format == "jsonl.zst":
+                self._raw = open(self.path, "wb")
+                self._file = zstandard.ZstdCompressor().stream_writer(self._raw)
+            else:
+                self._file = gzip.open(self.path, "wb")
+        self._file.write("".join(json.dumps({'timestamp': event['timestamp'],
+                                             'logGroupName': event['logGroupName'],
+                                             'logStreamName': event['logStreamName'],
+                                             'message': event['message']},
+                                            ensure_ascii=False) + "\n"
+                                 for event in events).encode("utf-8"))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._file is not None:
+            self._file.close()
+            if self.export_format == "jsonl.zst":
+                self._raw.close()
+
+
+class EventExporter(object):
+    """ Collects events per log group into batches of row_group_size events
+    and writes them with writer_count threads to a file per group in
+    directory. All batches of a group go to the same thread so that each
+    file is written in order by one thread. add() blocks while the threads
+    have max_batches batches queued, which slows fetching down to the
+    speed of writing. On an event loop use add_async() instead, which waits
+    in an executor thread
+    """
+    def __init__(self, directory, export_format=None, row_group_size=100000,
+                 writer_count=4, max_batches=8):
+        self.directory = directory
+        self.export_format = export_format or default_format()
+        if self.export_format == "parquet" and not pyarrow:
+            raise ValueError("Parquet export needs pyarrow")
+        if self.export_format == "jsonl.zst" and not zstandard:
+            raise ValueError("zstd export needs zstandard")
+        self.row_group_size = row_group_size
+        self.files = {}
+        self.errors = []
+        self._batches = {}
+        self._paths = set()
+        self._files_lock = Lock()
+        self._queues = [queue.Queue(max(1, max_batches // writer_count))
+                        for _ in range(writer_count)]
+        self._threads = []
+        for write_queue in self._queues:
+            thread = Thread(target=self._write, args=(write_queue,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def add(self, group_name, event):
+        batch = self._append(group_name, event)
+        if batch is not None:
+            self._queue_batch(group_name, batch)
+
+    async def add_async(self, group_name, event):
+        batch = self._append(group_name, event)
+        if batch is not None:
+            await asyncio.get_event_loop().run_in_executor(
+                None, self._queue_batch, group_name, batch)
+
+    def _append(self, group_name, event):
+        """ Add event to the batch of group_name. Returns the batch once it
+        is full
+        """
+        batch = self._batches.get(group_name)
+        if batch is None:
+            batch = self._batches[group_name] = []
+        batch.append(event)
+        if len(batch) >= self.row_group_size:
+            return self._batches.pop(group_name)
+        return None
+
+    def _group_file(self, group_name):
+        with self._files_lock:
+            group_file = self.files.get(group_name)
+            if group_file is None:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                name = file_name(group_name, self.export_format)
+                path = os.path.join(self.directory, name)
+                suffix = 1
+                while path in self._paths:
+                    # A group named like the safe name of another one
+                    suffix += 1
+                    path = os.path.join(self.directory, "%s-%d.%s" % (
+                        name[:-len(self.export_format) - 1], suffix,
+                        self.export_format))
+                self._paths.add(path)
+                group_file = self.files[group_name] = GroupFile(path,
+                                                                self.export_format)
+            return group_file
+
+    def _queue_batch(self, group_name, batch):
+        group_file = self._group_file(group_name)
+        index = zlib.crc32(group_name.encode("utf-8")) % len(self._queues)
+        self._queues[index].put((group_file, batch))
+
+    def _write(self, write_queue):
+        while True:
+            item = write_queue.get()
+            if item is None:
+                return
+            group_file, batch = item
+            try:
+                group_file.write(batch)
+            except Exception as error:
+                self.errors.append((group_file.path, error))
+
+    def close(self):
+        """ Write out what is left and close all files
+        """
+        for group_name in list(self._batches):
+            self._queue_batch(group_name, self._batches.pop(group_name))
+        for write_queue in self._queues:
+            write_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        for group_file in self.files.values():
+            try:
+                group_file.close()
+            except Exception as error:
+                self.errors.append((group_file.path, error))
@@ -0,0 +1,394 @@
+""" Fetching CloudWatch Logs events for many log groups at once. Queries run as
+coroutines on one asyncio event loop in a thread of its own and share one
+client and its connection pool. The number of calls in flight adapts to the
+API limit of the account: it grows while calls succeed and halves when
+CloudWatch Logs throttles.
+"""
+import asyncio
+import copy
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Thread
+
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from threadlocal_aws.clients import logs
+
+THROTTLING_ERRORS = ("ThrottlingException", "Throttling",
+                     "TooManyRequestsException", "LimitExceededException")
+# Errors that trying again does not fix
+PERMANENT_ERRORS = ("ResourceNotFoundException", "AccessDeniedException",
+                    "InvalidParameterException", "UnrecognizedClientException")
+
+
+def is_throttling(error):
+    return isinstance(error, ClientError) and \
+        error.response.get("Error", {}).get("Code") in THROTTLING_ERRORS
+
+
+def is_not_found(error):
+    return isinstance(error, ClientError) and \
+        error.response.get("Error", {}).get("Code") == "ResourceNotFoundException"
+
+
+def is_permanent(error):
+    return isinstance(error, ClientError) and \
+        error.response.get("Error", {}).get("Code") in PERMANENT_ERRORS
+
+
+class AimdLimiter(object):
+    """ Concurrency limit with additive increase and multiplicative decrease.
+    The limit grows by one for every limit calls that succeed and is cut by
+    decrease on throttling, at most once per limit calls so that one burst of
+    throttled calls only counts once. Only used from the event loop.
+    """
+    def __init__(self, initial=4, minimum=1, maximum=64, decrease=0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.in_flight = 0
+        self.throttles = 0
+        self._since_decrease = 0
+        self._condition = None
+
+    def _get_condition(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def acquire(self):
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, throttled=False):
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            self._since_decrease += 1
+            if throttled:
+                self.throttles += 1
+                if self._since_decrease >= int(self.limit):
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self._since_decrease = 0
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            condition.notify_all()
+
+
+class PollInterval(object):
+    """ Time to wait between polls of one tailed log group. A group that had
+    events is polled again after interval seconds. Each poll that finds
+    nothing doubles the wait up to max_interval, so that idle groups leave
+    the call budget to busy ones. rate is an exponentially weighted average
+    of events per second over recent polls and a group counts as hot while
+    it is above hot_rate: hot groups are polled without backing off even
+    after an empty poll. Waits are jittered by a tenth to keep many groups
+    from polling in step.
+    """
+    def __init__(self, interval=1.0, max_interval=30.0, backoff=2.0,
+                 hot_rate=1.0, weight=0.3):
+        self.interval = interval
+        self.max_interval = max(interval, max_interval)
+        self.backoff = backoff
+        self.hot_rate = hot_rate
+        self.weight = weight
+        self.rate = 0.0
+        self.current = interval
+
+    def update(self, events, elapsed):
+        """ Record a poll that found events in elapsed seconds since the
+        previous one and return the seconds to wait until the next one
+        """
+        if elapsed > 0:
+            self.rate += self.weight * (events / float(elapsed) - self.rate)
+        if events or self.rate >= self.hot_rate:
+            self.current = self.interval
+        else:
+            self.current = min(self.max_interval, self.current * self.backoff)
+        return self.current * random.uniform(0.9, 1.1)
+
+
+class LogEventsFetcher(object):
+    """ Runs filter_log_events queries on an event loop. The blocking client
+    calls run in a thread pool as large as the maximum concurrency and the
+    client gets a connection pool of the same size. botocore's own retries
+    are turned off so that throttling reaches the limiter.
+    """
+    def __init__(self, max_concurrency=64, initial_concurrency=4,
+                 client=None, tries=5, delay=1.0):
+        self.max_concurrency = max_concurrency
+        self.tries = tries
+        self.delay = delay
+        self.initial_concurrency = initial_concurrency
+        self.region = None
+        self.limiter = AimdLimiter(initial=initial_concurrency,
+                                   maximum=max_concurrency)
+        self._client = client or self._new_client()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._tasks = set()
+        self._regions = {}
+        self.calls = 0
+
+    def _new_client(self, region=None):
+        config = Config(max_pool_connections=self.max_concurrency,
+                        retries={'total_max_attempts': 1})
+        if region:
+            return logs(region=region, config=config)
+        return logs(config=config)
+
+    def for_region(self, region):
+        """ Fetcher that calls CloudWatch Logs in region. It shares the loop,
+        threads and tasks of this one, so stop() stops it too, but has a
+        client and a limiter of its own as API limits are per region
+        """
+        fetcher = self._regions.get(region)
+        if fetcher is None:
+            fetcher = copy.copy(self)
+            fetcher.region = region
+            fetcher.calls = 0
+            fetcher.limiter = AimdLimiter(initial=self.initial_concurrency,
+                                          maximum=self.max_concurrency)
+            fetcher._client = self._new_client(region)
+            self._regions[region] = fetcher
+        return fetcher
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def submit(self, coroutine):
+        """ Run coroutine on the loop. Returns a concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(self._track(coroutine),
+                                                self._loop)
+
+    async def _track(self, coroutine):
+        task = self.spawn(coroutine)
+        return await task
+
+    def spawn(self, coroutine):
+        """ Start coroutine as a task on the loop, from the loop thread
+        """
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def stop(self):
+        async def cancel_all():
+            tasks = list(self._tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if self._thread.is_alive():
+            try:
+                asyncio.run_coroutine_threadsafe(cancel_all(),
+                                                 self._loop).result(5)
+            except Exception:
+                pass
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(5)
+        self._executor.shutdown(wait=False)
+
+    async def call(self, method, **params):
+        """ Call a client method within the concurrency limit. Throttled calls
+        are retried without limit after a backoff, other errors tries times
+        except for errors like a missing log group that are raised right away
+        """
+        failures = 0
+        backoff = self.delay
+        while True:
+            await self.limiter.acquire()
+            throttled = False
+            try:
+                self.calls += 1
+                return await self._loop.run_in_executor(
+                    self._executor,
+                    partial(getattr(self._client, method), **params))
+            except Exception as error:
+                throttled = is_throttling(error)
+                if not throttled:
+                    failures += 1
+                    if failures >= self.tries or is_permanent(error):
+                        raise
+            finally:
+                await self.limiter.release(throttled)
+            await asyncio.sleep(backoff * (0.5 + random.random()))
+            backoff = min(backoff * 2, 30)
+
+    async def pages(self, params):
+        """ Responses to a filter_log_events query following nextToken
+        """
+        params = dict(params)
+        while True:
+            response = await self.call("filter_log_events", **params)
+            yield response
+            if not response.get('nextToken'):
+                return
+            params['nextToken'] = response['nextToken']
+
+    async def follow(self, params, on_event, on_caught_up=None, tail=False,
+                     poll_interval=1.0, on_watermark=None, watermark_delay=2000,
+                     max_poll_interval=None):
+        """ Hand events of a filter_log_events query to on_event. When tail is
+        true query again for events newer than the last one seen, every
+        poll_interval seconds while the group has events and backing off up
+        to max_poll_interval seconds while it is idle (see PollInterval).
+        on_caught_up is called after each full pass and
+        on_watermark with the time in milliseconds that events older than
+        are not expected anymore: the start of the pass less watermark_delay
+        for events that are still being ingested. on_event and on_watermark
+        may be coroutine functions
+        """
+        params = dict(params)
+        schedule = PollInterval(poll_interval, max_poll_interval or poll_interval)
+        previous = time.time()
+        while True:
+            started = time.time()
+            last_timestamp = None
+            events = 0
+            async for response in self.pages(params):
+                for event in response.get('events', []):
+                    last_timestamp = event.get('timestamp', last_timestamp)
+                    events += 1
+                    await _call(on_event, event)
+            if last_timestamp:
+                params['startTime'] = last_timestamp + 1
+            if on_watermark:
+                await _call(on_watermark, max(last_timestamp or 0,
+                                              int(started * 1000) - watermark_delay))
+            if on_caught_up:
+                on_caught_up()
+            if not tail:
+                return
+            wait = schedule.update(events, started - previous)
+            previous = started
+            await asyncio.sleep(max(0, wait - (time.time() - started)))
+
+    async def scan(self, params, on_event, on_done=None, slices=8,
+                   min_span=1000, max_ranges=64, on_watermark=None):
+        """ Hand events of a filter_log_events query over the closed range
+        startTime..endTime to on_event in timestamp order. The range is cut
+        into slices that are fetched in parallel. A range whose first page
+        comes back with events and a nextToken is dense, so it is cut in half
+        again until ranges are min_span milliseconds or there are max_ranges
+        ranges. Ranges are handed on in order
+        and each range buffers at most a couple of pages ahead of that.
+        on_watermark gets the last timestamp handed on after each page.
+        on_event and on_watermark may be coroutine functions. on_done is
+        called when the scan ends, also when it fails with an error
+        """
+        start, end = params['startTime'], params['endTime']
+        span = end - start + 1
+        slices = max(1, min(slices, span // max(1, min_span)))
+        step = span // slices
+        ranges = []
+        limits = {'min_span': min_span, 'ranges': slices,
+                  'max_ranges': max_ranges}
+        for index in range(slices):
+            range_start = start + index * step
+            range_end = end if index == slices - 1 else range_start + step - 1
+            ranges.append(self._scan_range(params, range_start, range_end,
+                                           limits))
+        try:
+            for index, node in enumerate(ranges):
+                try:
+                    await self._emit_range(node, on_event, on_watermark)
+                except BaseException:
+                    self._abandon(ranges[index + 1:])
+                    raise
+        finally:
+            if on_done:
+                on_done()
+
+    def _abandon(self, nodes):
+        """ Read the errors of ranges that are not going to be handed on
+        """
+        for node in nodes:
+            node.add_done_callback(self._abandoned)
+
+    def _abandoned(self, node):
+        if node.cancelled() or node.exception() is not None:
+            return
+        kind, value = node.result()
+        if kind == 'split':
+            self._abandon(value)
+
+    def _scan_range(self, params, start, end, limits):
+        node = self._loop.create_future()
+        self.spawn(self._fetch_range(params, start, end, limits, node))
+        return node
+
+    async def _fetch_range(self, params, start, end, limits, node):
+        params = dict(params, startTime=start, endTime=end)
+        params.pop('nextToken', None)
+        try:
+            response = await self.call("filter_log_events", **params)
+        except Exception as error:
+            node.set_exception(error)
+            return
+        if response.get('nextToken') and response.get('events') and \
+                end - start + 1 >= 2 * limits['min_span'] and \
+                limits['ranges'] < limits['max_ranges']:
+            limits['ranges'] += 1
+            middle = start + (end - start + 1) // 2
+            node.set_result(('split', [
+                self._scan_range(params, start, middle - 1, limits),
+                self._scan_range(params, middle, end, limits)]))
+            return
+        pages = asyncio.Queue(maxsize=2)
+        node.set_result(('pages', pages))
+        try:
+            while True:
+                await pages.put(response.get('events', []))
+                if not response.get('nextToken'):
+                    break
+                params['nextToken'] = response['nextToken']
+                response = await self.call("filter_log_events", **params)
+            await pages.put(None)
+        except Exception as error:
+            await pages.put(error)
+
+    async def _emit_range(self, node, on_event, on_watermark):
+        kind, value = await node
+        if kind == 'split':
+            for index, child in enumerate(value):
+                try:
+                    await self._emit_range(child, on_event, on_watermark)
+                except BaseException:
+                    self._abandon(value[index + 1:])
+                    raise
+            return
+        while True:
+            events = await value.get()
+            if events is None:
+                return
+            if isinstance(events, Exception):
+                raise events
+            events = sorted(events, key=_timestamp)
+            for event in events:
+                await _call(on_event, event)
+            if events and on_watermark:
+                await _call(on_watermark, _timestamp(events[-1]))
+
+
+def _timestamp(event):
+    return event.get('timestamp', 0)
+
+
+async def _call(function, *args):
+    result = function(*args)
+    if asyncio.iscoroutine(result):
+        await result
@@ -0,0 +1,685 @@
+""" Following growing files. Uses inotify on Linux to wake up only when the
+followed file changes and falls back to polling elsewhere.
+"""
+import ctypes
+import ctypes.util
+import errno
+import glob
+import hashlib
+import json
+import os
+import select
+import struct
+import sys
+import time
+from threading import Event, Lock
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_MOVED_FROM = 0x00000040
+IN_DELETE = 0x00000200
+IN_MOVE_SELF = 0x00000800
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o0004000
+
+FOLLOW_MASK = IN_MODIFY | IN_ATTRIB | IN_MOVE_SELF | IN_DELETE_SELF
+CHUNK_SIZE = 1024 * 1024
+
+# Filesystems where changes made on other hosts never generate inotify events
+NO_INOTIFY_FILESYSTEMS = ("nfs", "nfs4", "cifs", "smb3", "smbfs", "9p",
+                          "vboxsf", "afs", "ceph", "glusterfs", "lustre",
+                          "gpfs", "sshfs")
+
+_EVENT_HEADER = struct.Struct("iIII")
+_LIBC = None
+
+
+def _libc():
+    global _LIBC
+    if _LIBC is None:
+        _LIBC = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                            use_errno=True)
+    return _LIBC
+
+
+def _mount_fs_type(path):
+    """ Filesystem type of the longest mount point containing path or None
+    """
+    path = os.path.realpath(path)
+    best = ""
+    best_type = None
+    try:
+        with open("/proc/self/mounts", "r") as mounts:
+            for mount in mounts:
+                fields = mount.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace("\\040", " ")
+                if (path == mount_point or
+                        path.startswith(mount_point.rstrip("/") + "/")) and \
+                        len(mount_point) >= len(best):
+                    best = mount_point
+                    best_type = fields[2]
+    except OSError:
+        return None
+    return best_type
+
+
+def inotify_supported(path):
+    """ True if inotify can be expected to report changes to path
+    """
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        if not hasattr(_libc(), "inotify_init1"):
+            return False
+    except OSError:
+        return False
+    fs_type = _mount_fs_type(path)
+    if fs_type and (fs_type in NO_INOTIFY_FILESYSTEMS or
+                    fs_type.startswith("fuse")):
+        return False
+    return True
+
+
+class Inotify(object):
+    """ Minimal ctypes binding to the Linux inotify API
+    """
+    def __init__(self):
+        self._libc = _libc()
+        self.fd = self._libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask=FOLLOW_MASK):
+        if not isinstance(path, bytes):
+            path = path.encode(sys.getfilesystemencoding())
+        wd = self._libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """ Read all queued events without blocking. Returns a list of
+        (wd, mask, cookie, name) tuples
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return events
+                raise
+            if not data:
+                return events
+            pos = 0
+            while pos + _EVENT_HEADER.size <= len(data):
+                wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, pos)
+                pos += _EVENT_HEADER.size
+                name = data[pos:pos + length].rstrip(b"\0")
+                pos += length
+                events.append((wd, mask, cookie, name))
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class FileFollower(object):
+    """ Read a file and keep following the end for new data. New data is read
+    in chunks of chunk_size bytes and split into lines in bulk. Only complete
+    lines are handed to line_function; a trailing line without a newline is
+    handed over once the file has been idle for wait seconds.
+
+    The file is tracked by device and inode. When the file is truncated it is
+    read again from the start and when it is replaced (e.g. by logrotate) the
+    old file is drained before switching over to the new one.
+
+    With split_lines=False line_function gets whole blocks of complete lines
+    instead of single lines. With binary=True it gets bytes instead of text.
+    With with_position=True line_function is called as
+    line_function(line, (device, inode, offset)) where offset is where the
+    line ends in the file. Passing such a tuple as start_position resumes
+    from that position, draining a rotated file with the same inode first if
+    it is found next to file_name.
+    """
+    def __init__(self, file_name, line_function, wait=1, chunk_size=CHUNK_SIZE,
+                 split_lines=True, binary=False, use_inotify=None,
+                 with_position=False, start_position=None, inotify=None):
+        self.file_name = file_name
+        self.line_function = line_function
+        self.wait = wait
+        self.chunk_size = chunk_size
+        self.split_lines = split_lines
+        self.binary = binary
+        self.use_inotify = use_inotify
+        self.with_position = with_position
+        self.start_position = start_position
+        self.offset = 0
+        self.dev = None
+        self.ino = None
+        self._file = None
+        self._partial = b""
+        # A shared Inotify belongs to whoever passed it in, see MultiFollower
+        self._inotify = inotify
+        self._file_wd = None
+        self._stopped = Event()
+        self._wake_read = self._wake_write = None
+
+    def stop(self):
+        self._stopped.set()
+        if self._wake_write is not None:
+            try:
+                os.write(self._wake_write, b"x")
+            except OSError:
+                pass
+
+    def _emit(self, data, end_offset):
+        if self.with_position:
+            self._emit_with_position(data, end_offset)
+            return
+        if not self.binary:
+            data = data.decode("utf-8", "replace")
+        if not self.split_lines:
+            self.line_function(data)
+            return
+        newline = b"\n" if self.binary else "\n"
+        lines = data.split(newline)
+        last = lines.pop()
+        line_function = self.line_function
+        for line in lines:
+            line_function(line + newline)
+        if last:
+            line_function(last)
+
+    def _emit_with_position(self, data, end_offset):
+        offset = end_offset - len(data)
+        dev, ino = self.dev, self.ino
+        binary = self.binary
+        line_function = self.line_function
+        lines = data.split(b"\n")
+        last = lines.pop()
+        for line in lines:
+            offset += len(line) + 1
+            line += b"\n"
+            line_function(line if binary else line.decode("utf-8", "replace"),
+                          (dev, ino, offset))
+        if last:
+            line_function(last if binary else last.decode("utf-8", "replace"),
+                          (dev, ino, end_offset))
+
+    def read_available(self):
+        """ Read everything that has been appended since the last call and
+        hand complete lines to line_function. Returns the number of bytes read
+        """
+        read = 0
+        while True:
+            data = self._file.read(self.chunk_size)
+            if not data:
+                return read
+            read += len(data)
+            self.offset += len(data)
+            end = data.rfind(b"\n")
+            if end < 0:
+                self._partial += data
+                continue
+            if self._partial:
+                data = self._partial + data
+                end += len(self._partial)
+            self._partial = data[end + 1:]
+            self._emit(data[:end + 1], self.offset - len(self._partial))
+
+    def flush_partial(self):
+        if self._partial:
+            partial = self._partial
+            self._partial = b""
+            self._emit(partial, self.offset)
+
+    def _open(self, file_name, offset=0):
+        self._close()
+        self._file = open(file_name, "rb")
+        stat = os.fstat(self._file.fileno())
+        self.dev, self.ino = stat.st_dev, stat.st_ino
+        if offset > stat.st_size:
+            offset = 0
+        if offset:
+            self._file.seek(offset)
+        self.offset = offset
+        self._partial = b""
+
+    def _close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _drain(self):
+        self.read_available()
+        self.flush_partial()
+
+    def _find_rotated(self, dev, ino):
+        """ Find a file next to file_name that is the given device and inode
+        """
+        directory, base = os.path.split(os.path.abspath(self.file_name))
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return None
+        for name in sorted(names):
+            if not name.startswith(base) or name == base:
+                continue
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if (stat.st_dev, stat.st_ino) == (dev, ino):
+                return path
+        return None
+
+    def _open_initial(self):
+        stat = os.stat(self.file_name)
+        if self.start_position:
+            dev, ino, offset = self.start_position
+            if (stat.st_dev, stat.st_ino) == (dev, ino):
+                self._open(self.file_name, offset)
+                return
+            rotated = self._find_rotated(dev, ino)
+            if rotated:
+                self._open(rotated, offset)
+                self._drain()
+        self._open(self.file_name)
+
+    def _check_file(self):
+        """ Handle truncation and replacement of the followed file
+        """
+        if os.fstat(self._file.fileno()).st_size < self.offset:
+            self._file.seek(0)
+            self.offset = 0
+            self._partial = b""
+            # Whatever was written after the truncation
+            self.read_available()
+            return
+        try:
+            stat = os.stat(self.file_name)
+        except OSError:
+            # Rotated away and not recreated yet, keep reading the old file
+            return
+        if (stat.st_dev, stat.st_ino) != (self.dev, self.ino):
+            self._drain()
+            self._open(self.file_name)
+            self._watch_file()
+            # Whatever was written before the watch was added
+            self.read_available()
+
+    def _start_inotify(self):
+        use_inotify = self.use_inotify
+        if use_inotify is None:
+            use_inotify = inotify_supported(self.file_name)
+        if not use_inotify:
+            return
+        try:
+            self._inotify = Inotify()
+            # Watching the directory reveals the file being recreated
+            self._inotify.add_watch(os.path.dirname(os.path.abspath(self.file_name)),
+                                    IN_CREATE | IN_MOVED_TO)
+        except OSError:
+            self._stop_inotify()
+
+    def _watch_file(self):
+        """ Watch the currently open file. Returns the watch descriptor or
+        None if the file has to be polled
+        """
+        if not self._inotify:
+            return None
+        self._unwatch_file()
+        try:
+            self._file_wd = self._inotify.add_watch(self.file_name)
+        except OSError:
+            self._file_wd = None
+        return self._file_wd
+
+    def _unwatch_file(self):
+        if self._file_wd is not None:
+            self._inotify.rm_watch(self._file_wd)
+            self._file_wd = None
+
+    def _stop_inotify(self):
+        if self._inotify:
+            self._inotify.close()
+            self._inotify = None
+            self._file_wd = None
+
+    def _wait_for_change(self, timeout):
+        """ Block until something happens to the file, timeout passes or
+        stop() is called
+        """
+        if not self._inotify:
+            self._stopped.wait(timeout)
+            return
+        try:
+            ready = select.select([self._inotify.fd, self._wake_read], [], [],
+                                  timeout)[0]
+        except (OSError, select.error) as err:
+            if err.args[0] == errno.EINTR:
+                return
+            raise
+        if self._wake_read in ready:
+            os.read(self._wake_read, 64)
+        if self._inotify.fd in ready:
+            for wd, mask, _, _ in self._inotify.read_events():
+                if wd == self._file_wd and mask & IN_IGNORED:
+                    # Only polling can see writes to the file from now on
+                    self._file_wd = None
+                if mask & IN_Q_OVERFLOW:
+                    return
+
+    def follow(self):
+        self._wake_read, self._wake_write = os.pipe()
+        try:
+            while not (os.path.isfile(self.file_name) and
+                       os.path.exists(self.file_name)):
+                if self._stopped.wait(self.wait):
+                    return
+            self._start_inotify()
+            self._open_initial()
+            self._watch_file()
+            last_data = time.time()
+            while not self._stopped.is_set():
+                if self.read_available():
+                    last_data = time.time()
+                self._check_file()
+                if self._partial and time.time() - last_data >= self.wait:
+                    self.flush_partial()
+                if self._partial or self._file_wd is None:
+                    timeout = self.wait
+                else:
+                    timeout = None
+                self._wait_for_change(timeout)
+        finally:
+            self._stop_inotify()
+            self._close()
+            os.close(self._wake_read)
+            os.close(self._wake_write)
+            self._wake_read = self._wake_write = None
+
+
+class MultiFollower(object):
+    """ Follow every file that matches any of patterns (file names or glob
+    patterns) from a single thread, including files that appear later.
+    follower_for(file_name) is called for every new file and returns the
+    keyword arguments for its FileFollower, at least line_function.
+
+    One inotify instance watches all the files and the directories they are
+    in. Files where inotify does not work are polled every wait seconds and
+    glob patterns with wildcards in the directory part are rescanned every
+    rescan_interval seconds. A file that has been removed and not recreated
+    is closed after close_after seconds.
+    """
+    def __init__(self, patterns, follower_for, wait=1, use_inotify=None,
+                 rescan_interval=10, close_after=300):
+        self.patterns = patterns
+        self.follower_for = follower_for
+        self.wait = wait
+        self.use_inotify = use_inotify
+        self.rescan_interval = rescan_interval
+        self.close_after = close_after
+        self._followers = {}
+        self._followers_lock = Lock()
+        self._file_wds = {}
+        self._dir_wds = {}
+        self._polled = set()
+        self._gone = {}
+        self._inotify = None
+        self._last_scan = 0
+        self._stopped = Event()
+        self._wake_read = self._wake_write = None
+
+    def stop(self):
+        self._stopped.set()
+        if self._wake_write is not None:
+            try:
+                os.write(self._wake_write, b"x")
+            except OSError:
+                pass
+
+    def positions(self):
+        """ (key, file name, device, inode, offset) of each followed file,
+        where offset is how far it has been read. Thread safe
+        """
+        with self._followers_lock:
+            followers = sorted(self._followers.items())
+        return [(key, follower.file_name, follower.dev, follower.ino,
+                 follower.offset) for key, follower in followers]
+
+    def _needs_periodic_scan(self):
+        if self._gone or self._inotify is None:
+            return True
+        for pattern in self.patterns:
+            directory = os.path.dirname(os.path.abspath(pattern))
+            if glob.has_magic(directory) or directory not in self._dir_wds.values():
+                return True
+        return False
+
+    def _watch_dir(self, directory):
+        if self._inotify is None or directory in self._dir_wds.values() or \
+                not inotify_supported(directory):
+            return
+        try:
+            wd = self._inotify.add_watch(directory, IN_CREATE | IN_MOVED_TO |
+                                         IN_DELETE | IN_MOVED_FROM)
+            self._dir_wds[wd] = directory
+        except OSError:
+            pass
+
+    def _scan(self):
+        self._last_scan = time.time()
+        for pattern in self.patterns:
+            if glob.has_magic(pattern):
+                paths = glob.glob(pattern)
+                for directory in set(os.path.dirname(os.path.abspath(path))
+                                     for path in paths):
+                    self._watch_dir(directory)
+                if not glob.has_magic(os.path.dirname(pattern)):
+                    self._watch_dir(os.path.dirname(os.path.abspath(pattern)))
+            else:
+                paths = [pattern]
+                directory = os.path.dirname(os.path.abspath(pattern))
+                if os.path.isdir(directory):
+                    self._watch_dir(directory)
+            for path in paths:
+                key = os.path.abspath(path)
+                if key not in self._followers and os.path.isfile(path):
+                    self._add(path)
+        now = time.time()
+        for key, follower in list(self._followers.items()):
+            if os.path.exists(follower.file_name):
+                self._gone.pop(key, None)
+            elif now - self._gone.setdefault(key, now) >= self.close_after:
+                self._remove(key)
+
+    def _add(self, path):
+        kwargs = self.follower_for(path)
+        kwargs.setdefault("wait", self.wait)
+        follower = FileFollower(path, inotify=self._inotify, **kwargs)
+        try:
+            follower._open_initial()
+        except OSError:
+            return
+        with self._followers_lock:
+            self._followers[os.path.abspath(path)] = follower
+        follower._last_data = time.time()
+        self._track(follower)
+
+    def _track(self, follower):
+        wd = follower._watch_file() if inotify_supported(follower.file_name) \
+            else None
+        if wd is None:
+            self._polled.add(follower)
+        else:
+            self._polled.discard(follower)
+            self._file_wds[wd] = follower
+
+    def _remove(self, key):
+        with self._followers_lock:
+            follower = self._followers.pop(key)
+        self._gone.pop(key, None)
+        self._polled.discard(follower)
+        if follower._file_wd is not None:
+            self._file_wds.pop(follower._file_wd, None)
+            follower._unwatch_file()
+        follower._drain()
+        follower._close()
+
+    def _service(self, follower, now):
+        if follower.read_available():
+            follower._last_data = now
+        wd = follower._file_wd
+        ino = follower.ino
+        follower._check_file()
+        if follower.ino != ino:
+            self._file_wds.pop(wd, None)
+            self._track(follower)
+        if follower._partial and now - follower._last_data >= self.wait:
+            follower.flush_partial()
+
+    def _wait(self, timeout):
+        """ Block until something happens, returns followers that need to be
+        read and whether the patterns need to be rescanned
+        """
+        if self._inotify is None:
+            self._stopped.wait(timeout)
+            return set(), False
+        try:
+            ready = select.select([self._inotify.fd, self._wake_read], [], [],
+                                  timeout)[0]
+        except (OSError, select.error) as err:
+            if err.args[0] == errno.EINTR:
+                return set(), False
+            raise
+        if self._wake_read in ready:
+            os.read(self._wake_read, 64)
+        dirty = set()
+        rescan = False
+        if self._inotify.fd in ready:
+            for wd, mask, _, name in self._inotify.read_events():
+                if mask & IN_Q_OVERFLOW:
+                    return set(self._followers.values()), True
+                follower = self._file_wds.get(wd)
+                if follower:
+                    if mask & IN_IGNORED:
+                        del self._file_wds[wd]
+                        follower._file_wd = None
+                        self._polled.add(follower)
+                    dirty.add(follower)
+                elif wd in self._dir_wds:
+                    if mask & IN_IGNORED:
+                        del self._dir_wds[wd]
+                        rescan = True
+                        continue
+                    path = os.path.join(self._dir_wds[wd],
+                                        name.decode(sys.getfilesystemencoding()))
+                    follower = self._followers.get(path)
+                    if follower:
+                        dirty.add(follower)
+                    rescan = True
+        return dirty, rescan
+
+    def follow(self):
+        self._wake_read, self._wake_write = os.pipe()
+        use_inotify = self.use_inotify
+        if use_inotify is None:
+            use_inotify = sys.platform.startswith("linux")
+        try:
+            if use_inotify:
+                try:
+                    self._inotify = Inotify()
+                except (OSError, AttributeError):
+                    self._inotify = None
+            self._scan()
+            dirty = set(self._followers.values())
+            while not self._stopped.is_set():
+                now = time.time()
+                for follower in dirty:
+                    self._service(follower, now)
+                periodic = self._needs_periodic_scan()
+                if self._polled or periodic or \
+                        any(f._partial for f in self._followers.values()):
+                    timeout = self.wait
+                else:
+                    timeout = None
+                dirty, rescan = self._wait(timeout)
+                now = time.time()
+                if rescan or (periodic and
+                              now - self._last_scan >= self.rescan_interval):
+                    before = set(self._followers)
+                    self._scan()
+                    dirty.update(self._followers[key] for key in
+                                 set(self._followers) - before)
+                dirty.update(self._polled)
+                dirty.update(f for f in self._followers.values() if f._partial)
+        finally:
+            for key in list(self._followers):
+                self._remove(key)
+            if self._inotify:
+                self._inotify.close()
+                self._inotify = None
+            os.close(self._wake_read)
+            os.close(self._wake_write)
+            self._wake_read = self._wake_write = None
+
+
+class OffsetCheckpoints(object):
+    """ Persist (device, inode, offset) positions of followed files, one small
+    json file per followed file in state_dir
+    """
+    def __init__(self, state_dir=None):
+        self.state_dir = state_dir or default_state_dir()
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+
+    def _path(self, file_name):
+        key = hashlib.sha1(os.path.abspath(file_name).encode("utf-8")).hexdigest()
+        return os.path.join(self.state_dir, key + ".json")
+
+    def get(self, file_name):
+        try:
+            with open(self._path(file_name), "r") as state:
+                data = json.load(state)
+            return data["dev"], data["ino"], data["offset"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def set(self, file_name, position):
+        path = self._path(file_name)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as state:
+            json.dump({"file": os.path.abspath(file_name), "dev": position[0],
+                       "ino": position[1], "offset": position[2]}, state)
+        os.replace(tmp, path)
+
+
+def default_state_dir(name="checkpoints"):
+    """ /var/lib/ec2-utils/<name> when writable and ~/.ec2-utils/<name>
+    otherwise
+    """
+    if os.access("/var/lib/ec2-utils", os.W_OK) or \
+            (not os.path.exists("/var/lib/ec2-utils") and
+             os.access("/var/lib", os.W_OK)):
+        return os.path.join("/var/lib/ec2-utils", name)
+    return os.path.join(os.path.expanduser("~"), ".ec2-utils", name)
+
+
+def follow(file_name, line_function, wait=1, **kwargs):
+    FileFollower(file_name, line_function, wait=wait, **kwargs).follow()
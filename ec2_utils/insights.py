@@ -0,0 +1,103 @@
+""" Running CloudWatch Logs Insights queries over any number of log groups.
+"""
+import asyncio
+import calendar
+import re
+from datetime import datetime
+
+MAX_GROUPS_PER_QUERY = 50
+MAX_RESULTS = 10000
+DONE_STATUSES = ("Complete", "Failed", "Cancelled", "Timeout", "Unknown")
+AGGREGATING = re.compile(r"(^|\|)\s*(stats|dedup)\b")
+
+
+class InsightsQuery(object):
+    """ Runs query_string over groups between start and end (milliseconds)
+    on a LogEventsFetcher and hands each result row to on_row as a dict of
+    field names to values.
+
+    Groups are split into queries of at most 50 groups that run at the same
+    time, up to max_queries at once to stay under the concurrent query limit
+    of the account. A query that does not aggregate and hits the limit of
+    results is run again as two queries over the halves of its time range
+    until the results fit, so no rows are lost to the limit. Rows of a
+    query are handed on once it has completed.
+    """
+    def __init__(self, fetcher, query_string, groups, start, end, on_row,
+                 poll_interval=1.0, limit=MAX_RESULTS, max_queries=20):
+        self.fetcher = fetcher
+        self.query_string = query_string
+        self.groups = groups
+        self.start = start
+        self.end = end
+        self.on_row = on_row
+        self.poll_interval = poll_interval
+        self.limit = limit
+        self.max_queries = max_queries
+        self.splittable = not AGGREGATING.search(query_string)
+        self.failed = []
+        self._running = None
+
+    async def run(self):
+        self._running = asyncio.Semaphore(self.max_queries)
+        chunks = [self.groups[index:index + MAX_GROUPS_PER_QUERY]
+                  for index in range(0, len(self.groups), MAX_GROUPS_PER_QUERY)]
+        await asyncio.gather(*[self._run_range(chunk, self.start, self.end)
+                               for chunk in chunks])
+
+    async def _run_range(self, groups, start, end):
+        async with self._running:
+            status, rows = await self._query(groups, start, end)
+        if status != "Complete":
+            self.failed.append((groups, start, end, status))
+            return
+        if len(rows) >= self.limit and self.splittable and \
+                end // 1000 > start // 1000:
+            # Insights queries whole seconds, so split between seconds
+            middle = (start // 1000 + (end // 1000 - start // 1000) // 2) * 1000
+            await asyncio.gather(self._run_range(groups, start, middle + 999),
+                                 self._run_range(groups, middle + 1000, end))
+            return
+        for row in rows:
+            row = dict((field['field'], field['value']) for field in row)
+            if '@log' not in row and len(groups) == 1:
+                row['@log'] = groups[0]
+            self.on_row(row)
+
+    async def _query(self, groups, start, end):
+        response = await self.fetcher.call(
+            "start_query", logGroupNames=groups, startTime=start // 1000,
+            endTime=end // 1000, queryString=self.query_string,
+            limit=self.limit)
+        query_id = response['queryId']
+        status = None
+        try:
+            while True:
+                await asyncio.sleep(self.poll_interval)
+                response = await self.fetcher.call("get_query_results",
+                                                   queryId=query_id)
+                status = response.get('status')
+                if status in DONE_STATUSES:
+                    return status, response.get('results', [])
+        finally:
+            if status not in DONE_STATUSES:
+                try:
+                    await self.fetcher.call("stop_query", queryId=query_id)
+                except Exception:
+                    pass
+
+
+def row_to_event(row):
+    """ A filter_log_events style event of an Insights row that has the
+    @timestamp and @message fields or None
+    """
+    if '@timestamp' not in row or '@message' not in row:
+        return None
+    stamp = datetime.strptime(row['@timestamp'][:19], "%Y-%m-%d %H:%M:%S")
+    millis = row['@timestamp'][20:23]
+    group = row.get('@log', '')
+    return {'timestamp': calendar.timegm(stamp.timetuple()) * 1000 +
+                         (int(millis) if millis.isdigit() else 0),
+            'logGroupName': group.split(':', 1)[-1],
+            'logStreamName': row.get('@logStream', ''),
+            'message': row['@message']}
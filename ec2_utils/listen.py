@@ -0,0 +1,272 @@
+""" Receiving log lines over sockets instead of from files, so that
+applications can hand their logs to log-to-cloudwatch without writing them
+to disk first. Messages in syslog format are sent to a stream per program.
+"""
+import os
+import re
+import selectors
+import socket
+import stat
+from threading import Event
+
+SYSLOG_5424 = re.compile(br"^<\d{1,3}>1 \S+ \S+ (\S+) ")
+SYSLOG_3164 = re.compile(br"^<\d{1,3}>(?:[A-Z][a-z]{2} [ \d]\d \d\d:\d\d:\d\d )?"
+                         br"(?:\S+ )?([\w./-]+)(?:\[\d+\])?: ")
+PRIORITY = re.compile(br"^<\d{1,3}>")
+OCTET_COUNT = re.compile(br"^(\d{1,6}) (?=<)")
+FRAME = re.compile(br"^\n*(\d{1,6}) ")
+PARTIAL_COUNT = re.compile(br"^\n*\d{1,6} ?$")
+UNSAFE = re.compile(r"[^A-Za-z0-9._-]+")
+MAX_MESSAGE = 262144
+
+
+def parse_address(address):
+    """ (kind, address) of unix:PATH, unix-stream:PATH, udp:[HOST]:PORT or
+    tcp:[HOST]:PORT. unix: is a datagram socket like /dev/log. The host
+    defaults to 127.0.0.1, listening on all interfaces takes 0.0.0.0
+    """
+    kind, _, rest = address.partition(":")
+    if kind in ("unix", "unix-stream") and rest:
+        return kind, rest
+    if kind in ("udp", "tcp"):
+        host, _, port = rest.rpartition(":")
+        if port.isdigit():
+            return kind, (host.strip("[]") or "127.0.0.1", int(port))
+    raise ValueError("Invalid listen address " + address +
+                     ", expected unix:PATH, unix-stream:PATH, udp:[HOST]:PORT" +
+                     " or tcp:[HOST]:PORT")
+
+
+def check_socket_path(path):
+    """ True if there is a socket at path, False if there is nothing. Raises
+    ValueError if there is something else, which is not to be replaced
+    """
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return False
+    if not stat.S_ISSOCK(mode):
+        raise ValueError(path + " exists and is not a socket")
+    return True
+
+
+def remove_socket(path):
+    """ Remove a socket left behind at path, see check_socket_path()
+    """
+    if check_socket_path(path):
+        os.unlink(path)
+
+
+def stream_framing(data, final=False):
+    """ "octet" if a stream starts with a syslog message framed with octet
+    counting, "newline" if it does not or None if too little of it has
+    arrived to tell. final tells that no more is coming
+    """
+    if OCTET_COUNT.match(data):
+        return "octet"
+    if not final and PARTIAL_COUNT.match(data):
+        return None
+    return "newline"
+
+
+def parse_syslog(message):
+    """ Program name of a syslog message, RFC 5424 or 3164, and the message
+    without its priority. The name is None for messages that are not syslog
+    """
+    match = SYSLOG_5424.match(message)
+    if match and match.group(1) != b"-":
+        program = match.group(1)
+    else:
+        match = SYSLOG_3164.match(message)
+        program = match.group(1) if match else None
+    if PRIORITY.match(message):
+        message = PRIORITY.sub(b"", message, 1)
+    return (program.decode("utf-8", "replace") if program else None), message
+
+
+class LogListener(object):
+    """ Listens on addresses (see parse_address) in one thread and hands each
+    message to sender_for(source).send(). A datagram is one message. Stream
+    connections carry newline separated messages or syslog messages framed
+    with octet counting (RFC 6587), which is decided for each connection
+    from its first bytes, see stream_framing(). source is the program of
+    syslog messages, otherwise the address of the peer or the name of the
+    socket. After max_sources sources the rest share the source "other".
+    Unix sockets get socket_mode as their permissions.
+    """
+    def __init__(self, addresses, sender_for, max_sources=100, socket_mode=0o660):
+        self.addresses = [parse_address(address) if isinstance(address, str)
+                          else address for address in addresses]
+        self.sender_for = sender_for
+        self.max_sources = max_sources
+        self.socket_mode = socket_mode
+        self.messages = 0
+        self._sources = {}
+        self._selector = selectors.DefaultSelector()
+        self._sockets = []
+        self._buffers = {}
+        self._framing = {}
+        self._stopped = Event()
+
+    def _source(self, default, message):
+        program, message = parse_syslog(message)
+        name = UNSAFE.sub("_", program or default).strip("_") or "unknown"
+        sender = self._sources.get(name)
+        if sender is None:
+            if len(self._sources) >= self.max_sources:
+                name = "other"
+                sender = self._sources.get(name)
+            if sender is None:
+                sender = self._sources[name] = self.sender_for(name)
+        return sender, message
+
+    def _handle(self, default, message):
+        message = message.rstrip(b"\r\n\x00")
+        if not message:
+            return
+        sender, message = self._source(default, message)
+        self.messages += 1
+        sender.send(message)
+
+    def _bind(self, kind, address):
+        if kind in ("unix", "unix-stream"):
+            remove_socket(address)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM if kind == "unix"
+                                 else socket.SOCK_STREAM)
+            sock.bind(address)
+            os.chmod(address, self.socket_mode)
+            name = os.path.basename(address)
+        else:
+            family = socket.AF_INET6 if ":" in address[0] else socket.AF_INET
+            sock = socket.socket(family, socket.SOCK_DGRAM if kind == "udp"
+                                 else socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(address)
+            name = None
+        sock.setblocking(False)
+        if kind in ("unix", "udp"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+            self._selector.register(sock, selectors.EVENT_READ, ("datagram", name))
+        else:
+            sock.listen(64)
+            self._selector.register(sock, selectors.EVENT_READ, ("accept", name))
+        self._sockets.append((kind, address, sock))
+        return sock
+
+    def start(self):
+        """ Bind all addresses. Returns the bound sockets
+        """
+        return [self._bind(kind, address) for kind, address in self.addresses]
+
+    def stop(self):
+        self._stopped.set()
+
+    def serve(self):
+        if not self._sockets:
+            self.start()
+        try:
+            while not self._stopped.is_set():
+                for key, _ in self._selector.select(1.0):
+                    action, name = key.data
+                    if action == "datagram":
+                        self._read_datagram(key.fileobj, name)
+                    elif action == "accept":
+                        self._accept(key.fileobj, name)
+                    else:
+                        self._read_stream(key.fileobj, name)
+        finally:
+            self._close()
+
+    def _read_datagram(self, sock, name):
+        for _ in range(256):
+            try:
+                data, peer = sock.recvfrom(MAX_MESSAGE)
+            except OSError:
+                return
+            self._handle(name or "udp-" + str(peer and peer[0]), data)
+
+    def _accept(self, sock, name):
+        try:
+            connection, peer = sock.accept()
+        except OSError:
+            return
+        connection.setblocking(False)
+        default = name or "tcp-" + peer[0]
+        self._buffers[connection] = b""
+        self._selector.register(connection, selectors.EVENT_READ,
+                                ("stream", default))
+
+    def _read_stream(self, connection, default):
+        try:
+            data = connection.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        buffered = self._buffers[connection] + data
+        framing = self._framing.get(connection)
+        if framing is None and buffered:
+            framing = stream_framing(buffered, final=not data)
+            self._framing[connection] = framing
+        if framing == "octet":
+            buffered = self._read_frames(connection, default, buffered)
+        elif framing == "newline":
+            buffered = self._read_lines(default, buffered)
+        if not data:
+            if buffered:
+                self._handle(default, buffered)
+            self._selector.unregister(connection)
+            del self._buffers[connection]
+            self._framing.pop(connection, None)
+            connection.close()
+            return
+        self._buffers[connection] = buffered
+
+    def _read_frames(self, connection, default, buffered):
+        """ Hand on the octet counted messages in buffered. Returns the rest
+        """
+        while buffered:
+            match = FRAME.match(buffered)
+            if not match:
+                if PARTIAL_COUNT.match(buffered):
+                    break
+                # Not framed after all, read the rest of the connection as lines
+                self._framing[connection] = "newline"
+                return self._read_lines(default, buffered)
+            end = match.end() + int(match.group(1))
+            if end > len(buffered):
+                break
+            self._handle(default, buffered[match.end():end])
+            buffered = buffered[end:]
+        return buffered
+
+    def _read_lines(self, default, buffered):
+        """ Hand on the newline separated messages in buffered. Returns the
+        rest
+        """
+        while buffered:
+            newline = buffered.find(b"\n")
+            if newline < 0:
+                if len(buffered) >= MAX_MESSAGE:
+                    self._handle(default, buffered)
+                    buffered = b""
+                break
+            self._handle(default, buffered[:newline])
+            buffered = buffered[newline + 1:]
+        return buffered
+
+    def _close(self):
+        for connection in list(self._buffers):
+            self._selector.unregister(connection)
+            connection.close()
+        self._buffers.clear()
+        self._framing.clear()
+        for kind, address, sock in self._sockets:
+            self._selector.unregister(sock)
+            sock.close()
+            if kind in ("unix", "unix-stream"):
+                try:
+                    os.unlink(address)
+                except OSError:
+                    pass
+        self._sockets = []
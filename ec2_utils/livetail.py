@@ -0,0 +1,241 @@
+""" Tailing log groups with CloudWatch Logs Live Tail. A session streams new
+events of up to ten log groups as they are ingested, so tailing neither
+polls nor waits for the next poll. Groups that can not be tailed live are
+polled with LogEventsFetcher.follow() instead.
+"""
+import asyncio
+import sys
+import time
+from threading import Thread
+
+from botocore.config import Config
+from threadlocal_aws.clients import logs
+
+from ec2_utils.fetch import _call
+from ec2_utils.instance_info import resolve_account
+
+MAX_GROUPS_PER_SESSION = 10
+
+
+class LiveTail(object):
+    """ Live Tail sessions for the groups given to follow(). Groups are
+    collected for coalesce seconds and then started in sessions of at most
+    ten groups, up to max_sessions sessions, the concurrent session limit
+    of the account. Each session reads its event stream in a thread of its
+    own and hands the events of an update to the loop of fetcher in one go.
+    Sessions that end or time out are started again and the events of each
+    group between its last event in the old session and the start of the
+    new one are fetched with filter_log_events. Groups that do not fit
+    in the sessions, or whose session can not be started, for example when
+    Live Tail is not available in the region or for the credentials, fall
+    back to polling on fetcher.
+
+    endpoint_url and client are for testing against a stub of the event
+    stream API.
+    """
+    def __init__(self, fetcher, filter_pattern="", max_sessions=15,
+                 coalesce=0.2, client=None, endpoint_url=None):
+        self.fetcher = fetcher
+        self.region = fetcher.region
+        self.filter_pattern = filter_pattern
+        self.max_sessions = max_sessions
+        self.coalesce = coalesce
+        self.sessions = 0
+        self.sampled = False
+        self._endpoint_url = endpoint_url
+        self._client = client
+        self._pending = []
+        self._flush = None
+        self._arn_prefix = None
+
+    def client(self):
+        if self._client is None:
+            config = Config(max_pool_connections=self.max_sessions,
+                            read_timeout=300)
+            kwargs = {'config': config}
+            if self.region:
+                kwargs['region'] = self.region
+            if self._endpoint_url:
+                kwargs['config'] = config.merge(Config(inject_host_prefix=False))
+                kwargs['endpoint_url'] = self._endpoint_url
+            self._client = logs(**kwargs)
+        return self._client
+
+    def arn(self, group_name):
+        if self._arn_prefix is None:
+            meta = self.client().meta
+            self._arn_prefix = "arn:%s:logs:%s:%s:log-group:" % (
+                meta.partition, meta.region_name, resolve_account() or "")
+        return self._arn_prefix + group_name
+
+    async def follow(self, params, on_event, on_caught_up=None,
+                     poll_interval=1.0, max_poll_interval=None):
+        """ Hand new events of params['logGroupName'] to on_event until
+        cancelled. Events older than the session that are newer than
+        params['startTime'] are fetched once with filter_log_events first.
+        on_caught_up is called once the group is tailed live or polled
+        """
+        done = asyncio.get_event_loop().create_future()
+        self._pending.append((params, on_event, on_caught_up, poll_interval,
+                              max_poll_interval, done))
+        if self._flush is None:
+            self._flush = asyncio.get_event_loop().call_later(
+                self.coalesce, self._start_pending)
+        await done
+
+    def _start_pending(self):
+        pending, self._pending, self._flush = self._pending, [], None
+        for index in range(0, len(pending), MAX_GROUPS_PER_SESSION):
+            groups = pending[index:index + MAX_GROUPS_PER_SESSION]
+            if self.sessions < self.max_sessions:
+                self.sessions += 1
+                self.fetcher.spawn(self._session(groups))
+            else:
+                for group in groups:
+                    self.fetcher.spawn(self._poll(group))
+
+    async def _poll(self, group):
+        params, on_event, on_caught_up, poll_interval, max_poll_interval, done = group
+        try:
+            await self.fetcher.follow(params, on_event, on_caught_up=on_caught_up,
+                                      tail=True, poll_interval=poll_interval,
+                                      max_poll_interval=max_poll_interval)
+        finally:
+            if not done.done():
+                done.set_result(None)
+
+    async def _session(self, groups):
+        loop = asyncio.get_event_loop()
+        handlers = dict((self.arn(group[0]['logGroupName']), group)
+                        for group in groups)
+        previous = None
+        session = None
+        try:
+            while True:
+                session = _Session(self, loop, handlers)
+                try:
+                    await session.start()
+                except Exception as error:
+                    sys.stderr.write("Live tail unavailable, polling instead: %s\n" % error)
+                    self.sessions -= 1
+                    if previous:
+                        groups = [(dict(group[0], startTime=previous.resume_time(arn)),) +
+                                  group[1:] for arn, group in handlers.items()]
+                    await asyncio.gather(*[self._poll(group) for group in groups])
+                    return
+                if previous is None:
+                    await asyncio.gather(*[
+                        self._catch_up(group, group[0].get('startTime'),
+                                       session.started, caught_up=True)
+                        for group in groups])
+                else:
+                    await asyncio.gather(*[
+                        self._catch_up(group, previous.resume_time(arn),
+                                       session.started)
+                        for arn, group in handlers.items()])
+                error = await session.finished
+                session.close()
+                previous = session
+                if error != "SessionTimeoutException":
+                    await asyncio.sleep(1.0)
+        finally:
+            if session:
+                session.close()
+            for group in groups:
+                if not group[5].done():
+                    group[5].set_result(None)
+
+    async def _catch_up(self, group, start, started, caught_up=False):
+        """ Fetch the events of group from start up to the start of a session
+        """
+        params, on_event, on_caught_up = group[:3]
+        if start and start < started:
+            await self.fetcher.follow(dict(params, startTime=start,
+                                           endTime=started - 1), on_event)
+        if caught_up and on_caught_up:
+            on_caught_up()
+
+
+class _Session(object):
+    """ One Live Tail session and the thread that reads its event stream.
+    finished is resolved when the stream ends, with the error code if it
+    ended with an error. last_seen has the newest timestamp handed on per
+    group
+    """
+    def __init__(self, live, loop, handlers):
+        self.live = live
+        self.loop = loop
+        self.handlers = handlers
+        self.finished = loop.create_future()
+        self.started = None
+        self.last_seen = {}
+        self._stream = None
+        self._closed = False
+
+    async def start(self):
+        params = {'logGroupIdentifiers': sorted(self.handlers)}
+        self.started = int(time.time() * 1000)
+        if self.live.filter_pattern:
+            params['logEventFilterPattern'] = self.live.filter_pattern
+        response = await self.loop.run_in_executor(
+            None, lambda: self.live.client().start_live_tail(**params))
+        self._stream = response['responseStream']
+        thread = Thread(target=self._read)
+        thread.daemon = True
+        thread.start()
+
+    def _read(self):
+        code = None
+        try:
+            for item in self._stream:
+                if self._closed:
+                    return
+                update = item.get('sessionUpdate')
+                if update is None:
+                    continue
+                if update.get('sessionMetadata', {}).get('sampled') and \
+                        not self.live.sampled:
+                    self.live.sampled = True
+                    sys.stderr.write("Live tail is sampling events, " +
+                                     "the log groups have too many of them\n")
+                results = update.get('sessionResults')
+                if results:
+                    asyncio.run_coroutine_threadsafe(self._deliver(results),
+                                                     self.loop).result()
+        except Exception as error:
+            code = getattr(error, "response", {}).get("Error", {}).get("Code") or \
+                str(error)
+        if not self._closed:
+            self.loop.call_soon_threadsafe(self._finish, code)
+
+    def _finish(self, code):
+        if not self.finished.done():
+            self.finished.set_result(code)
+
+    def resume_time(self, arn):
+        """ Time from which the events of a group may be missing once this
+        session has ended
+        """
+        if arn in self.last_seen:
+            return self.last_seen[arn] + 1
+        return self.started
+
+    async def _deliver(self, results):
+        for result in results:
+            arn = result.get('logGroupIdentifier')
+            group = self.handlers.get(arn)
+            if group is None:
+                continue
+            if result['timestamp'] > self.last_seen.get(arn, 0):
+                self.last_seen[arn] = result['timestamp']
+            await _call(group[1], {'timestamp': result['timestamp'],
+                                   'ingestionTime': result.get('ingestionTime'),
+                                   'logStreamName': result['logStreamName'],
+                                   'message': result['message']})
+
+    def close(self):
+        self._closed = True
+        try:
+            self._stream.close()
+        except Exception:
+            pass
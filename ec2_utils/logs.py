@@ -49,26 +49,47 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import asyncio
+import hashlib
+import json
 import locale
 import os
 import sys
 import time
 import re
+import zlib
 import queue
 from builtins import object, range
 from past.utils import old_div
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime, timedelta
+from fnmatch import fnmatch
+from functools import partial
 from dateutil import tz
 from dateutil.parser import parse
 from dateutil.tz import tzutc
-from termcolor import colored
-from threading import Event, Lock, Thread, BoundedSemaphore
+from threading import Condition, Event, Lock, Thread
 from botocore.compat import total_seconds
 from threading import Event, Lock, Thread
-from ec2_utils.instance_info import info
+from ec2_utils.archive import S3ArchiveSender
+from ec2_utils.discovery import LogGroupCache, literal_prefix
+from ec2_utils.fetch import LogEventsFetcher, _call, is_not_found
+from ec2_utils.follow import MultiFollower, OffsetCheckpoints, default_state_dir, \
+    follow
+from ec2_utils.insights import InsightsQuery, row_to_event
+from ec2_utils.listen import LogListener
+from ec2_utils.livetail import LiveTail
+from ec2_utils.instance_info import info, resolve_account
+from ec2_utils.merge import INFINITY, WatermarkMerge
+from ec2_utils.multiline import MultilineAssembler
+from ec2_utils.spool import SpillQueue
+from ec2_utils.stats import MetricsServer, ShipperStats, archive_collector, \
+    emf_collector, follower_collector, listener_collector, rules_collector, \
+    shipper_collector
+from ec2_utils.utils import is_ascii
 from retry import retry
-from threadlocal_aws.clients import logs
+from threadlocal_aws.clients import ec2, logs
 
 
 def millis2iso(millis):
@@ -140,106 +161,869 @@ class IntervalThread(Thread):
         while not self._stopped.wait(self._interval):
             self._call_function()
 
-class LogSender(object):
-    def __init__(self, file_name, group=None, stream=None):
-        self._lock = Lock()
-        self._send_lock = Lock()
+MAX_BATCH_BYTES = 1048576
+MAX_BATCH_EVENTS = 10000
+EVENT_OVERHEAD = 26
+MAX_EVENT_BYTES = 262144 - EVENT_OVERHEAD
+MAX_RETRY_DELAY = 30.0
+SHARD_SUFFIX = re.compile(r'#\d+$')
+
+
+class EventBatch(object):
+    """ Events for one PutLogEvents call, the bytes they count against the
+    batch size limit, the position of the last line in the batch and the
+    time the batch was opened
+    """
+    __slots__ = ("events", "size", "empty_lines", "position", "opened", "seq")
+
+    def __init__(self, opened):
+        self.events = []
+        self.size = 0
+        self.empty_lines = 0
+        self.position = None
+        self.opened = opened
+        self.seq = None
+
+    def __len__(self):
+        return len(self.events) + self.empty_lines
+
+
+class EventBatcher(object):
+    """ Cuts queued lines into batches as they are added. The size of each
+    event is computed once when it is added so that batches are closed at the
+    PutLogEvents limits without encoding messages again. A batch is closed
+    when the next line would not fit in max_batch_bytes or max_batch_events
+    and the open batch is ready when it has been open for flush_interval
+    seconds. Not thread safe.
+
+    Closed batches are kept in memory up to max_memory_bytes. Batches after
+    that go to a SpillQueue in spill_dir, at most max_spill_bytes of them,
+    and are read back in order once the batches in memory have been sent.
+    Without spill_dir the oldest batches are dropped instead. Dropped data
+    is counted in dropped_bytes and dropped_lines.
+    """
+    def __init__(self, max_batch_bytes=MAX_BATCH_BYTES,
+                 max_batch_events=MAX_BATCH_EVENTS, flush_interval=2.0,
+                 max_memory_bytes=None, spill_dir=None,
+                 max_spill_bytes=1024 * 1024 * 1024):
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_events = max_batch_events
+        self.flush_interval = flush_interval
+        self.max_memory_bytes = max_memory_bytes
+        self._closed = deque()
+        self._closed_bytes = 0
+        self._open = None
+        self._last_timestamp = 0
+        self._dropped_bytes = 0
+        self._dropped_lines = 0
+        self.batches_closed = 0
+        self._spill = SpillQueue(spill_dir, max_bytes=max_spill_bytes) \
+            if spill_dir and max_memory_bytes else None
+
+    def __len__(self):
+        lines = sum(len(batch) for batch in self._closed)
+        if self._spill is not None:
+            lines += self._spill.pending_count
+        return lines + len(self._open) if self._open else lines
+
+    @property
+    def pending_bytes(self):
+        """ Bytes of events in memory
+        """
+        return self._closed_bytes + self._open.size if self._open \
+            else self._closed_bytes
+
+    @property
+    def spilled_bytes(self):
+        return self._spill.spilled_bytes if self._spill is not None else 0
+
+    @property
+    def dropped_bytes(self):
+        if self._spill is not None:
+            return self._dropped_bytes + self._spill.dropped_bytes
+        return self._dropped_bytes
+
+    @property
+    def dropped_lines(self):
+        if self._spill is not None:
+            return self._dropped_lines + self._spill.dropped_count
+        return self._dropped_lines
+
+    def add(self, line, position=None, timestamp=None):
+        """ Queue a line. Returns True if a closed batch is waiting
+        """
+        if isinstance(line, bytes):
+            line = line.rstrip()
+            try:
+                message = line.decode('utf-8')
+                size = len(line)
+            except UnicodeDecodeError:
+                message = line.decode('utf-8', 'replace')
+                size = len(message.encode('utf-8'))
+        else:
+            message = line.rstrip()
+            size = len(message) if is_ascii(message) else \
+                len(message.encode('utf-8', 'replace'))
+        if size > MAX_EVENT_BYTES:
+            message = message.encode('utf-8', 'replace')[:MAX_EVENT_BYTES]\
+                .decode('utf-8', 'ignore')
+            size = len(message.encode('utf-8'))
+        if timestamp is None:
+            timestamp = int(time.time() * 1000)
+        # Events in a batch have to be in chronological order
+        last_timestamp = self._last_timestamp
+        if timestamp < last_timestamp:
+            timestamp = last_timestamp
+        elif timestamp > last_timestamp:
+            self._last_timestamp = timestamp
+        batch = self._open
+        if message:
+            size += EVENT_OVERHEAD
+            if batch is None or batch.size + size > self.max_batch_bytes or \
+                    len(batch.events) >= self.max_batch_events:
+                batch = self._new_batch(timestamp)
+            batch.events.append({'timestamp': timestamp, 'message': message})
+            batch.size += size
+        else:
+            if batch is None:
+                batch = self._new_batch(timestamp)
+            batch.empty_lines += 1
+        if position:
+            batch.position = position
+        return self._has_closed()
+
+    def _new_batch(self, opened):
+        if self._open is not None:
+            self._close(self._open)
+        self._open = EventBatch(opened)
+        return self._open
+
+    def _close(self, batch):
+        self.batches_closed += 1
+        max_memory = self.max_memory_bytes
+        if self._spill is not None and \
+                (len(self._spill) or self._closed_bytes + batch.size > max_memory):
+            self._spill.append(_batch_record(batch), len(batch))
+            return
+        self._closed.append(batch)
+        self._closed_bytes += batch.size
+        while max_memory and self._closed_bytes > max_memory and \
+                len(self._closed) > 1:
+            dropped = self._closed.popleft()
+            self._closed_bytes -= dropped.size
+            self._dropped_bytes += dropped.size
+            self._dropped_lines += len(dropped)
+
+    def _has_closed(self):
+        return bool(self._closed) or bool(self._spill)
+
+    @property
+    def waiting_batches(self):
+        """ Closed batches waiting to be sent, in memory or spilled
+        """
+        spilled = len(self._spill) if self._spill is not None else 0
+        return len(self._closed) + spilled
+
+    def ready(self, now=None):
+        if self._has_closed():
+            return True
+        if self._open is None:
+            return False
+        return self.next_flush(now) <= 0
+
+    def next_flush(self, now=None):
+        """ Seconds until the open batch has to be sent, zero if a closed
+        batch is waiting and None if nothing is queued
+        """
+        if self._has_closed():
+            return 0
+        if self._open is None:
+            return None
+        if now is None:
+            now = time.time()
+        return self._open.opened / 1000.0 + self.flush_interval - now
+
+    def take_batch(self):
+        """ Remove the oldest batch from the queue, closing the open batch
+        if it is the only one. Returns None if nothing is queued
+        """
+        if self._closed:
+            batch = self._closed.popleft()
+            self._closed_bytes -= batch.size
+        elif self._spill:
+            batch = _record_batch(self._spill.pop())
+        elif self._open is not None:
+            batch = self._open
+            self._open = None
+            self.batches_closed += 1
+        else:
+            return None
+        return batch
+
+    def put_back(self, batch):
+        """ Return a batch from take_batch() to the front of the queue
+        """
+        self._closed.appendleft(batch)
+        self._closed_bytes += batch.size
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+
+
+def _batch_record(batch):
+    return {'o': batch.opened, 's': batch.size, 'n': batch.empty_lines,
+            'p': batch.position,
+            'e': [[event['timestamp'], event['message']] for event in batch.events]}
+
+
+def _record_batch(record):
+    batch = EventBatch(record['o'])
+    batch.size = record['s']
+    batch.empty_lines = record['n']
+    batch.position = tuple(record['p']) if record['p'] else None
+    batch.events = [{'timestamp': timestamp, 'message': message}
+                    for timestamp, message in record['e']]
+    return batch
+
+
+class LogShipper(object):
+    """ Sends the batches of any number of LogSenders through one logs client
+    and one bounded pool of worker threads. Every stream has its own batches
+    and up to max_in_flight of them are sent at the same time. A stream whose
+    batch failed is retried after flush_interval seconds, doubled after each
+    further failure up to MAX_RETRY_DELAY, so that failing streams do not
+    hold up the workers. stats, a ShipperStats, counts what the senders
+    send.
+    """
+    def __init__(self, workers=4, flush_interval=2.0):
+        self.flush_interval = flush_interval
+        self.stats = ShipperStats()
         self._logs = logs()
+        self._lock = Lock()
+        self._wakeup = Condition(self._lock)
+        self._senders = []
+        self._next = 0
+        self._sleeping = 0
+        self._stopping = False
+        self._groups = set()
+        self._groups_lock = Lock()
+        self._threads = []
+        for _ in range(workers):
+            thread = Thread(target=self._work)
+            thread.start()
+            self._threads.append(thread)
+
+    def register(self, sender):
+        with self._lock:
+            self._senders.append(sender)
+
+    def queues(self):
+        """ (group, stream, lines, bytes, dropped lines) of the queue of each
+        sender, where bytes are in memory or spilled to disk
+        """
+        with self._lock:
+            return [(sender.group_name, sender.stream_name, len(sender._batcher),
+                     sender._batcher.pending_bytes + sender._batcher.spilled_bytes,
+                     sender._batcher.dropped_lines) for sender in self._senders]
+
+    def queue(self, sender, line, position=None):
+        with self._lock:
+            batcher = sender._batcher
+            opened = batcher._open
+            # A new open batch may be due before the workers wake up
+            if batcher.add(line, position) or self._sleeping or \
+                    batcher._open is not opened:
+                self._wakeup.notify()
+
+    def create_group(self, group_name):
+        with self._groups_lock:
+            if group_name in self._groups:
+                return
+            try:
+                self._logs.create_log_group(logGroupName=group_name)
+            except BaseException:
+                pass
+            self._groups.add(group_name)
+
+    def forget_group(self, group_name):
+        """ Create group_name again before it is next used
+        """
+        with self._groups_lock:
+            self._groups.discard(group_name)
+
+    def stop(self):
+        """ Send what is queued, stop the worker threads and close the
+        batchers of the senders
+        """
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join()
+        with self._lock:
+            senders = list(self._senders)
+        for sender in senders:
+            sender._batcher.close()
+
+    def _take(self, now):
+        """ Find the next sender with a batch to send. Returns the sender, the
+        batch and the time to wait for the next batch if there is none yet
+        """
+        count = len(self._senders)
+        timeout = None
+        for i in range(count):
+            index = (self._next + i) % count
+            sender = self._senders[index]
+            if sender._in_flight >= sender.max_in_flight:
+                continue
+            wait = sender._batcher.next_flush(now)
+            if wait is None:
+                continue
+            if self._stopping:
+                if sender._retry_at > now:
+                    # Failed while stopping, give up on it
+                    continue
+                wait = 0
+            wait = max(wait, sender._retry_at - now)
+            if wait <= 0:
+                sender._in_flight += 1
+                self._next = index + 1
+                batch = sender._batcher.take_batch()
+                if batch.seq is None:
+                    batch.seq = sender._next_seq
+                    sender._next_seq += 1
+                return sender, batch, 0
+            if timeout is None or wait < timeout:
+                timeout = wait
+        return None, None, timeout
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while True:
+                    sender, batch, timeout = self._take(time.time())
+                    if sender:
+                        break
+                    if self._stopping and timeout is None:
+                        return
+                    if timeout is None:
+                        self._sleeping += 1
+                    self._wakeup.wait(timeout)
+                    if timeout is None:
+                        self._sleeping -= 1
+            sent = sender._send_batch(batch)
+            with self._lock:
+                sender._in_flight -= 1
+                if sent:
+                    sender._failures = 0
+                else:
+                    # Put back in front to keep lines and checkpoints in order
+                    sender._batcher.put_back(batch)
+                    sender._failures += 1
+                    sender._retry_at = time.time() + min(
+                        self.flush_interval * 2 ** (sender._failures - 1),
+                        MAX_RETRY_DELAY)
+                self._wakeup.notify()
+
+
+class LogSender(object):
+    """ Batch lines and send them to a CloudWatch log stream. A batch is sent
+    when it is full or when its oldest line has waited for flush_interval
+    seconds. If checkpoints (an ec2_utils.follow.OffsetCheckpoints) is given,
+    the file position of the last line of each successfully sent batch is
+    persisted so that a restart can resume from there.
+
+    Senders that share a LogShipper share its logs client and worker threads.
+    Without one the sender gets a LogShipper with a single worker of its own.
+
+    Batches waiting to be sent take at most max_memory_bytes of memory, the
+    rest is spilled to disk under spill_dir (see EventBatcher).
+
+    Up to max_in_flight batches of the stream are sent at the same time.
+    Batches can then arrive out of order, which CloudWatch accepts now that
+    it no longer uses sequence tokens. ordered=True sends one batch at a
+    time. Checkpoints only move past a batch once every batch before it has
+    been sent.
+
+    Lines are passed through rules (an ec2_utils.rules.RuleSet) before they
+    are queued. Dropped lines are queued as empty lines so that the
+    checkpoint still moves past them. With metrics, an
+    ec2_utils.emf.MetricConfig, lines are first counted in the metrics of
+    the stream and the lines that are counted instead of sent are dropped
+    likewise. The metrics of each window are queued as EMF events.
+    """
+    def __init__(self, file_name, group=None, stream=None, checkpoints=None,
+                 flush_interval=2.0, shipper=None, max_memory_bytes=None,
+                 spill_dir=None, max_spill_bytes=1024 * 1024 * 1024,
+                 max_in_flight=1, ordered=False, on_commit=None,
+                 send_info=True, rules=None, metrics=None):
+        self.file_name = file_name
+        self._rules = rules
+        self._metrics = metrics.aggregator(self.send_event) \
+            if metrics is not None else None
+        self._checkpoints = checkpoints
+        self._debug = 'CLOUDWATCH_LOG_DEBUG' in os.environ
+        self._own_shipper = shipper is None
+        self._shipper = shipper or LogShipper(workers=1,
+                                              flush_interval=flush_interval)
+        self._logs = self._shipper._logs
         if group:
             self.group_name = group
         else:
             self.group_name = resolve_stack_name()
-        self._messages = deque()
         if stream:
             self.stream_name = stream
         else:
             self.stream_name = resolve_instance_id() + "|" + \
                 file_name.replace(':', '_').replace('*', '_')
-        try:
-            self._logs.create_log_group(logGroupName=self.group_name)
-        except BaseException:
-            pass
+        if spill_dir:
+            key = (self.group_name + "|" + self.stream_name).encode('utf-8')
+            spill_dir = os.path.join(spill_dir, hashlib.sha1(key).hexdigest())
+        self._batcher = EventBatcher(flush_interval=flush_interval,
+                                     max_memory_bytes=max_memory_bytes,
+                                     spill_dir=spill_dir,
+                                     max_spill_bytes=max_spill_bytes)
+        self.max_in_flight = 1 if ordered else max(1, max_in_flight)
+        self._in_flight = 0
+        self._retry_at = 0
+        self._failures = 0
+        self._stream_created = False
+        self._next_seq = 0
+        self._commit_seq = 0
+        self._done = {}
+        self._checkpoint_lock = Lock()
+        self._on_commit = on_commit
+        self._shipper.register(self)
+        if send_info:
+            self.send(str(info()))
+
+    def send(self, line, position=None):
+        if self._metrics is not None and self._metrics.add(line):
+            line = None
+        elif self._rules is not None:
+            line = self._rules.apply(line)
+        if line is None:
+            if not position:
+                return
+            line = b""
+        self._shipper.queue(self, line, position)
+        if self._debug:
+            print("Queued message")
+
+    def send_event(self, line):
+        """ Queue a line that does not come from the file, so it is not
+        passed through rules or metrics
+        """
+        self._shipper.queue(self, line)
+
+    def stop(self):
+        """ Send what is queued and stop the sending thread if this sender
+        has a LogShipper of its own
+        """
+        if self._own_shipper:
+            self._shipper.stop()
+
+    def _create_stream(self):
+        self._shipper.create_group(self.group_name)
         try:
             self._logs.create_log_stream(logGroupName=self.group_name,
                                          logStreamName=self.stream_name)
         except BaseException:
             pass
-        self.token = None
-        self.send(str(info()))
-        self._do_send()
-        self._stop_flag = Event()
-        self._thread = IntervalThread(self._stop_flag, 2, self._do_send)
-        self._thread.start()
-
-    def send(self, line):
+        self._stream_created = True
+
+    def _send_batch(self, batch):
+        """ Send one batch. Returns False if sending failed
+        """
+        if batch.events:
+            if not self._stream_created:
+                self._create_stream()
+            try:
+                self._put_log_events(batch.events)
+            except Exception as error:
+                if is_not_found(error):
+                    # The stream or the group was deleted, create it again
+                    self._stream_created = False
+                    self._shipper.forget_group(self.group_name)
+                return False
+            self._shipper.stats.batch_sent(batch)
+        self._batch_done(batch)
+        return True
+
+    def _batch_done(self, batch):
+        """ Save the position of the newest batch that has no unsent batches
+        before it
+        """
+        with self._checkpoint_lock:
+            self._done[batch.seq] = (batch.position, len(batch))
+            position = None
+            lines = 0
+            while self._commit_seq in self._done:
+                done_position, done_lines = self._done.pop(self._commit_seq)
+                position = done_position or position
+                lines += done_lines
+                self._commit_seq += 1
+            if self._on_commit:
+                if lines:
+                    self._on_commit(self, position, lines)
+            else:
+                self._save_checkpoint(position)
+
+    def _save_checkpoint(self, position):
+        if self._checkpoints and position:
+            try:
+                self._checkpoints.set(self.file_name, position)
+            except (IOError, OSError) as err:
+                if self._debug:
+                    print("Failed to save checkpoint: " + str(err))
+
+    def _put_log_events(self, events):
+        started = time.time()
         try:
-            self._lock.acquire()
+            self._logs.put_log_events(logGroupName=self.group_name,
+                                      logStreamName=self.stream_name,
+                                      logEvents=events)
+        except Exception as error:
+            self._shipper.stats.put_failed(error)
+            raise
+        self._shipper.stats.put_done(time.time() - started)
+        if self._debug:
+            print("Sent " + str(len(events)) + " messages to " + self.stream_name)
+
+class ShardedLogSender(object):
+    """ Spreads the lines of one file over several log streams named
+    <stream>#0 ... <stream>#<n-1> to get past the throughput limit of a
+    single stream. `logs --merge-shards` shows the shards as one stream.
+
+    Lines go to the shards in turns of one batch each, whether the batch was
+    closed when full or taken for sending when due, passing over shards
+    that wait to retry a failed batch, or by a hash of the
+    first group of shard_key (a regular expression) when it matches so that
+    lines with the same key stay in one stream. With shards="auto" the file
+    starts with one shard and another is added, up to max_shards, whenever
+    more than two batches per shard wait to be sent.
+
+    The checkpoint of the file only moves past a line once every shard has
+    sent all of its lines up to that line. metrics and rules are applied
+    before a line is routed to a shard.
+    """
+    def __init__(self, file_name, group=None, stream=None, checkpoints=None,
+                 shards=2, max_shards=8, shard_key=None, rules=None,
+                 metrics=None, **kwargs):
+        self.file_name = file_name
+        self._rules = rules
+        self._metrics = metrics.aggregator(self.send_event) \
+            if metrics is not None else None
+        self._checkpoints = checkpoints
+        self._kwargs = kwargs
+        self.group_name = group or resolve_stack_name()
+        self.stream_name = stream or resolve_instance_id() + "|" + \
+            file_name.replace(':', '_').replace('*', '_')
+        self._auto = shards == "auto"
+        self.max_shards = max_shards if self._auto else int(shards)
+        self._shard_key = re.compile(shard_key) if shard_key else None
+        self._lock = Lock()
+        self._shards = []
+        self._routed = []
+        self._committed = []
+        self._floors = []
+        self._line = 0
+        self._last = (0, None)
+        self._saved = None
+        self._current = 0
+        self._closed_at_switch = 0
+        for _ in range(1 if self._auto else self.max_shards):
+            self._add_shard()
+
+    def _add_shard(self):
+        index = len(self._shards)
+        shard = LogSender(self.file_name, group=self.group_name,
+                          stream=self.stream_name + "#" + str(index),
+                          on_commit=self._shard_committed, send_info=False,
+                          **self._kwargs)
+        shard._shard_index = index
+        self._shards.append(shard)
+        self._routed.append(0)
+        self._committed.append(0)
+        self._floors.append(self._last)
+        self._route(index, str(info()), None)
+
+    def _pick(self, line):
+        if self._shard_key:
             if isinstance(line, bytes):
                 line = line.decode('utf-8', 'replace')
-            self._messages.append(line.rstrip())
-            if 'CLOUDWATCH_LOG_DEBUG' in os.environ:
-                print("Queued message")
-        finally:
-            self._lock.release()
+            match = self._shard_key.search(line)
+            if match:
+                key = match.group(1) if match.groups() else match.group(0)
+                return zlib.crc32(key.encode('utf-8')) % len(self._shards)
+        shard = self._shards[self._current]
+        if shard._batcher.batches_closed != self._closed_at_switch or \
+                shard._retry_at > time.time():
+            # Next shard, passing over the ones that wait to retry a batch
+            now = time.time()
+            count = len(self._shards)
+            for step in range(1, count + 1):
+                index = (self._current + step) % count
+                if self._shards[index]._retry_at <= now:
+                    break
+            self._current = index
+            self._closed_at_switch = self._shards[index]._batcher.batches_closed
+        return self._current
 
-    def _do_send(self):
-        events = []
-        try:
-            self._lock.acquire()
-            if len(self._messages) == 0:
+    def _grow_if_behind(self):
+        if not self._auto or len(self._shards) >= self.max_shards:
+            return
+        waiting = sum(shard._batcher.waiting_batches for shard in self._shards)
+        if waiting > 2 * len(self._shards):
+            self._add_shard()
+
+    def send(self, line, position=None):
+        if self._metrics is not None and self._metrics.add(line):
+            line = None
+        elif self._rules is not None:
+            line = self._rules.apply(line)
+        if line is None:
+            if not position:
                 return
-            counter = 0
-            while len(self._messages) > 0 and counter < 1048576 and \
-                    len(events) < 10000:
-                message = self._messages.popleft()
-                counter = counter + len(message.encode('utf-8', 'replace')) + 26
-                if counter > 1048576:
-                    self._messages.appendleft(message)
-                elif message:
-                    event = {}
-                    event['timestamp'] = int(time.time() * 1000)
-                    event['message'] = message
-                    events.append(event)
-        finally:
-            self._lock.release()
-        if len(events) == 0:
+            line = b""
+        with self._lock:
+            index = self._pick(line)
+            closed = self._shards[index]._batcher.batches_closed
+            self._route(index, line, position)
+            if self._shards[index]._batcher.batches_closed != closed:
+                self._grow_if_behind()
+
+    def send_event(self, line):
+        with self._lock:
+            self._route(self._pick(line), line, None)
+
+    def _route(self, index, line, position):
+        if self._routed[index] - self._committed[index] - \
+                self._shards[index]._batcher.dropped_lines <= 0:
+            # Everything before this line in the shard has been sent
+            self._floors[index] = self._last
+        self._routed[index] += 1
+        if position:
+            self._line += 1
+            self._last = (self._line, position)
+            position = self._last
+        self._shards[index].send(line, position)
+
+    def _shard_committed(self, shard, position, lines):
+        with self._lock:
+            index = shard._shard_index
+            self._committed[index] += lines
+            if position:
+                self._floors[index] = position
+            safe = self._last
+            for i, _ in enumerate(self._shards):
+                if self._routed[i] - self._committed[i] - \
+                        self._shards[i]._batcher.dropped_lines > 0 and \
+                        self._floors[i][0] < safe[0]:
+                    safe = self._floors[i]
+            if safe[1] and safe != self._saved:
+                self._saved = safe
+                if self._checkpoints:
+                    try:
+                        self._checkpoints.set(self.file_name, safe[1])
+                    except (IOError, OSError):
+                        pass
+
+    def stop(self):
+        for shard in self._shards:
+            shard.stop()
+
+
+class RulesReport(object):
+    """ Writes the counters of a RuleSet to stderr when they have changed
+    since the last call
+    """
+    def __init__(self, rules):
+        self.rules = rules
+        self._last = None
+
+    def __call__(self):
+        counters = self.rules.counters()
+        if counters == self._last:
             return
-        try:
-            self._send_lock.acquire()
-            self._put_log_events(events)
-        except:
-            self.token = None
-            for event in events:
-                self.send(event['message'].encode('utf-8', 'replace'))
-        finally:
-            self._send_lock.release()
+        self._last = counters
+        sys.stderr.write("Rules: " + ", ".join(
+            "%s %s %d hits %d dropped" % counter for counter in counters) + os.linesep)
 
-    @retry(tries=5, delay=1, backoff=2)
-    def _put_log_events(self, events):
-        if not self.token:
-            stream_desc = self._logs.describe_log_streams(logGroupName=self.group_name,
-                                                          logStreamNamePrefix=self.stream_name)
-            if 'uploadSequenceToken' in stream_desc['logStreams'][0]:
-                self.token = stream_desc['logStreams'][0]['uploadSequenceToken']
-        if self.token:
-            log_response = self._logs.put_log_events(logGroupName=self.group_name,
-                                                     logStreamName=self.stream_name,
-                                                     logEvents=events,
-                                                     sequenceToken=self.token)
+
+def unshard_stream_name(stream_name):
+    """ Name of the stream that a ShardedLogSender shard belongs to
+    """
+    return SHARD_SUFFIX.sub('', stream_name)
+
+
+def enabled_regions():
+    """ Names of the regions that are enabled for the account
+    """
+    return sorted(region['RegionName'] for region in ec2().describe_regions()['Regions'])
+
+
+async def _add_region(on_event, region, event):
+    event['region'] = region
+    await _call(on_event, event)
+
+
+def send_log_to_cloudwatch(file_names, group=None, stream=None, state_dir=None,
+                           resume=True, flush_interval=2.0, workers=4,
+                           max_memory_bytes=16 * 1024 * 1024, spill_dir=None,
+                           max_spill_bytes=1024 * 1024 * 1024, max_in_flight=4,
+                           ordered=False, shards=1, max_shards=8,
+                           shard_key=None, multiline_start=None,
+                           multiline_continuation=None, multiline_max_lines=500,
+                           multiline_timeout=1.0, rules=None, rules_report=60,
+                           listen=None, listen_mode=0o660, archive=None,
+                           archive_patterns=None, metrics=None,
+                           metrics_endpoint=None, health_timeout=300):
+    """ Follow files and glob patterns in file_names and send each file to a
+    stream of its own through one shared LogShipper. With shards other than 1
+    each file is spread over several streams, see ShardedLogSender. With
+    multiline_start or multiline_continuation the lines of multiline
+    messages are sent as one event, see MultilineAssembler. rules, an
+    ec2_utils.rules.RuleSet, is shared by all files and its counters are
+    written to stderr every rules_report seconds when they have changed.
+
+    listen is a list of socket addresses to receive lines on as well, see
+    ec2_utils.listen.LogListener. Lines from each source go to a stream of
+    their own, without checkpoints. Unix sockets get listen_mode as their
+    permissions.
+
+    Files that match archive_patterns are followed too, but archived to S3
+    with archive, an ec2_utils.archive.S3Archive, instead of sent to
+    CloudWatch Logs.
+
+    metrics, an ec2_utils.emf.MetricConfig, aggregates metrics from the
+    lines of each stream, which are sent as EMF events once per window.
+
+    metrics_endpoint, [HOST:]PORT or unix:PATH, serves the metrics of the
+    process in the Prometheus text format at /metrics, see
+    ec2_utils.stats. /health fails when lines have waited for
+    health_timeout seconds without anything being sent
+    """
+    if not file_names:
+        file_names = []
+    elif not isinstance(file_names, (list, tuple)):
+        file_names = [file_names]
+    if not group:
+        group = resolve_stack_name()
+    checkpoints = OffsetCheckpoints(state_dir)
+    shipper = LogShipper(workers=workers, flush_interval=flush_interval)
+    assemblers = []
+    multiline = multiline_start or multiline_continuation
+
+    sender_kwargs = {'group': group, 'flush_interval': flush_interval,
+                     'shipper': shipper, 'max_memory_bytes': max_memory_bytes,
+                     'spill_dir': spill_dir or default_state_dir("spill"),
+                     'max_spill_bytes': max_spill_bytes,
+                     'max_in_flight': max_in_flight, 'ordered': ordered,
+                     'rules': rules, 'metrics': metrics}
+
+    archive_patterns = list(archive_patterns or [])
+
+    def archived(file_name):
+        path = os.path.abspath(file_name)
+        return any(fnmatch(path, os.path.abspath(pattern))
+                   for pattern in archive_patterns)
+
+    def follower_for(file_name):
+        kwargs = dict(sender_kwargs, stream=stream, checkpoints=checkpoints)
+        if archive is not None and archived(file_name):
+            log_sender = S3ArchiveSender(file_name, archive, checkpoints=checkpoints,
+                                         rules=rules)
+        elif shards == 1:
+            log_sender = LogSender(file_name, **kwargs)
         else:
-            log_response = self._logs.put_log_events(logGroupName=self.group_name,
-                                                     logStreamName=self.stream_name,
-                                                     logEvents=events)
-        if 'CLOUDWATCH_LOG_DEBUG' in os.environ:
-            print("Sent " + str(len(events)) + " messages to " + self.stream_name)
-        if log_response and 'nextSequenceToken' in log_response:
-            self.token = log_response['nextSequenceToken']
+            log_sender = ShardedLogSender(file_name, shards=shards,
+                                          max_shards=max_shards,
+                                          shard_key=shard_key, **kwargs)
+        line_function = log_sender.send
+        if multiline:
+            assembler = MultilineAssembler(log_sender.send, start=multiline_start,
+                                           continuation=multiline_continuation,
+                                           max_lines=multiline_max_lines,
+                                           max_bytes=MAX_EVENT_BYTES,
+                                           timeout=multiline_timeout)
+            assemblers.append(assembler)
+            line_function = assembler.add
+        return {'line_function': line_function, 'binary': True,
+                'with_position': True,
+                'start_position': checkpoints.get(file_name) if resume else None}
+    stopped = Event()
+    if rules is not None and rules_report:
+        reporter = IntervalThread(stopped, rules_report, RulesReport(rules))
+        reporter.daemon = True
+        reporter.start()
+    if multiline:
+        flusher = IntervalThread(stopped, min(multiline_timeout, 1.0) / 2,
+                                 lambda: [assembler.flush_expired()
+                                          for assembler in list(assemblers)])
+        flusher.daemon = True
+        flusher.start()
+    if metrics is not None:
+        emitter = IntervalThread(stopped, 1.0, metrics.flush_expired)
+        emitter.daemon = True
+        emitter.start()
+    listener = None
+    if listen:
+        listener = LogListener(listen, lambda source: LogSender(source, **sender_kwargs),
+                               socket_mode=listen_mode)
+        listener.start()
+    follower = MultiFollower(list(file_names) + archive_patterns, follower_for)
+    server = None
+    if metrics_endpoint:
+        collectors = [shipper_collector(shipper),
+                      follower_collector(follower, checkpoints)]
+        if rules is not None:
+            collectors.append(rules_collector(rules))
+        if metrics is not None:
+            collectors.append(emf_collector(metrics))
+        if archive is not None:
+            collectors.append(archive_collector(archive))
+        if listener:
+            collectors.append(listener_collector(listener))
+        server = MetricsServer(metrics_endpoint, collectors,
+                               healthy=partial(_shipper_health, shipper,
+                                               health_timeout))
+        server.start()
+    try:
+        if listener and not file_names and not archive_patterns:
+            listener.serve()
         else:
-            self.token = None
+            if listener:
+                thread = Thread(target=listener.serve)
+                thread.daemon = True
+                thread.start()
+            follower.follow()
+    finally:
+        stopped.set()
+        if server:
+            server.stop()
+        if listener:
+            listener.stop()
+        for assembler in assemblers:
+            assembler.flush()
+        if metrics is not None:
+            metrics.flush()
+        shipper.stop()
+        if archive is not None:
+            archive.stop()
+
 
-def send_log_to_cloudwatch(file_name, group=None, stream=None):
-    log_sender = LogSender(file_name, group=group, stream=stream)
-    read_and_follow(file_name, log_sender.send)
+def _shipper_health(shipper, timeout):
+    """ Why shipper is not healthy or None if it is: lines are waiting
+    and nothing has been sent for timeout seconds
+    """
+    queued = sum(lines for _, _, lines, _, _ in shipper.queues())
+    last = shipper.stats.last_sent or shipper.stats.started
+    idle = time.time() - last
+    if queued and idle >= timeout:
+        return "%d lines waiting, nothing sent for %d seconds" % (queued, idle)
+    return None
 
 @retry(tries=10, delay=1, backoff=3)
 def resolve_stack_name():
@@ -257,22 +1041,11 @@ def resolve_instance_id():
         raise Exception("Failed to resolve instance id")
     return instance_id
 
-def read_and_follow(file_name, line_function, wait=1):
-    while not (os.path.isfile(file_name) and os.path.exists(file_name)):
-        time.sleep(wait)
-    with open(file_name) as file_:
-        end_seen = False
-        while True:
-            curr_position = file_.tell()
-            line = file_.readline()
-            if not line:
-                file_.seek(curr_position)
-                end_seen = True
-            else:
-                line_function(line)
-                end_seen = False
-            if end_seen:
-                time.sleep(wait)
+def read_and_follow(file_name, line_function, wait=1, **kwargs):
+    """ Hand lines of file_name to line_function and keep following the end
+    for new data. See ec2_utils.follow.FileFollower for the keyword arguments
+    """
+    follow(file_name, line_function, wait=wait, **kwargs)
 
 class CloudWatchLogsThread(Thread):
     def __init__(self, log_group_name, start_time=None):
@@ -290,13 +1063,40 @@ class CloudWatchLogsThread(Thread):
 
 
 class CloudWatchLogsGroups(object):
-    def __init__(self, log_filter='', log_group_filter='', start_time=None, end_time=None, sort=False):
+    def __init__(self, log_filter='', log_group_filter='', start_time=None, end_time=None, sort=False,
+                 max_concurrency=64, output="text", color=None, group_cache_ttl=300,
+                 event_cache=None, insights=None, aggregate=None, exporter=None,
+                 max_poll_interval=30.0, live=False, regions=None, merge_shards=False):
         self._logs = logs()
+        self.regions = regions or [None]
+        self.group_cache_ttl = group_cache_ttl
+        self._group_caches = {}
+        self._relisted = set()
+        self._live_tails = {}
+        self.max_poll_interval = max_poll_interval
+        self.live = live
+        self.exporter = exporter
+        self.aggregate = aggregate
+        self.insights = insights
+        self.event_cache = event_cache
+        self._cache_namespace = None
+        if event_cache is not None:
+            # Cached events of another account or profile are not to be used
+            self._cache_namespace = "%s|%s" % (resolve_account() or "",
+                                               os.environ.get("AWS_PROFILE", ""))
+        self._groups = set()
+        self._groups_lock = Lock()
+        self._start_group = None
+        self.max_concurrency = max_concurrency
+        self.formatter = EventFormatter(output=output, color=color,
+                                        merge_shards=merge_shards)
+        self.output = BufferedOutput()
         self.log_filter = log_filter
         self.log_group_filter = log_group_filter
         self.start_time = validatestarttime(parse_datetime(start_time))
         self.end_time = parse_datetime(end_time) * 1000 if end_time else None
         self.sort = sort
+        self.failed_groups = []
         self._stopped = Event()
 
     def filter_groups(self, log_group_filter, groups):
@@ -306,163 +1106,520 @@ class CloudWatchLogsGroups(object):
                 filtered.append(group['logGroupName'])
         return filtered
 
-    def get_filtered_groups(self, log_group_filter):
-        resp = self._logs.describe_log_groups()
-        filtered_group_names = []
-        filtered_group_names.extend(self.filter_groups(self.log_group_filter, resp['logGroups']))
-        while resp.get('nextToken'):
-            resp = self._logs.describe_log_groups(nextToken=resp['nextToken'])
-            filtered_group_names.extend(self.filter_groups(self.log_group_filter, resp['logGroups']))
-        return filtered_group_names
+    def group_cache(self, region=None):
+        """ LogGroupCache of region, None for the default region
+        """
+        with self._groups_lock:
+            if region not in self._group_caches:
+                client = logs(region=region) if region else self._logs
+                self._group_caches[region] = LogGroupCache(client,
+                                                           ttl=self.group_cache_ttl)
+            return self._group_caches[region]
+
+    def get_filtered_groups(self, log_group_filter, on_update=None, region=None):
+        """ Names of log groups that match log_group_filter. Only groups that
+        start with the literal prefix of the filter are listed and the lists
+        come from LogGroupCache. A stale cached list is refreshed first for
+        queries with an end time, which may be over before a refresh in the
+        background is, and without on_update. Otherwise on_update is called
+        with the new matching groups as the refresh finds them
+        """
+        def matching(names):
+            return [name for name in names if re.search(log_group_filter, name)]
+        update = (lambda names: on_update(matching(names))) if on_update else None
+        wait = bool(self.end_time) or on_update is None
+        return matching(self.group_cache(region).groups(literal_prefix(log_group_filter),
+                                                        on_update=update, wait=wait))
+
+    def start_groups(self, start_group):
+        """ Call start_group with the name and region of each matching log
+        group, including groups that show up when the cached group list is
+        refreshed. Groups of several regions are listed at the same time
+        """
+        self._start_group = start_group
+
+        def start_region(region):
+            self.add_groups(self.get_filtered_groups(
+                self.log_group_filter, region=region,
+                on_update=partial(self.add_groups, region=region)), region=region)
+        if len(self.regions) == 1:
+            start_region(self.regions[0])
+            return
+        with ThreadPoolExecutor(max_workers=len(self.regions)) as executor:
+            for _ in executor.map(start_region, self.regions):
+                pass
+
+    def add_groups(self, group_names, region=None):
+        with self._groups_lock:
+            for group_name in group_names:
+                if (region, group_name) not in self._groups and \
+                        not self._stopped.is_set():
+                    self._groups.add((region, group_name))
+                    self._start_group(group_name, region)
+
+    @staticmethod
+    def group_label(group_name, region=None):
+        """ Name of a group in summaries and file names, with the region
+        when querying several
+        """
+        return "%s:%s" % (region, group_name) if region else group_name
 
     def get_logs(self):
-        groups = self.get_filtered_groups(self.log_group_filter)
-        log_threads = []
-        work_queue = queue.Queue()
-        semaphore = BoundedSemaphore(5)
+        fetcher = LogEventsFetcher(max_concurrency=self.max_concurrency).start()
+        try:
+            if self.insights:
+                self.print_insights(fetcher)
+            elif self.aggregate:
+                self.print_aggregated(fetcher)
+            elif self.exporter:
+                self.export(fetcher)
+            elif self.sort:
+                self.print_merged(fetcher)
+            else:
+                self.print_unordered(fetcher)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            fetcher.stop()
+            self.output.flush()
+
+    def query(self, group_name):
+        item = {'logGroupName': group_name,
+                'interleaved': True,
+                'startTime': self.start_time,
+                'filterPattern': self.log_filter if self.log_filter else ""
+                }
+        if self.end_time:
+            item['endTime'] = self.end_time
+        return item
+
+    def live_tail(self, fetcher):
+        if fetcher.region not in self._live_tails:
+            self._live_tails[fetcher.region] = LiveTail(fetcher,
+                                                        filter_pattern=self.log_filter)
+        return self._live_tails[fetcher.region]
+
+    def fetch_group(self, fetcher, group_name, on_event, on_done=None,
+                    on_watermark=None, region=None):
+        """ Coroutine that hands events of group_name to on_event. Events of
+        a group in one of several regions get the region as 'region'
+        """
+        if region:
+            fetcher = fetcher.for_region(region)
+            on_event = partial(_add_region, on_event, region)
+        if self.end_time and self.event_cache:
+            return self.event_cache.scan(fetcher, self.query(group_name), on_event,
+                                         on_done=on_done, on_watermark=on_watermark,
+                                         namespace="%s|%s" % (
+                                             self._cache_namespace,
+                                             region or self._logs.meta.region_name))
+        if self.end_time:
+            return fetcher.scan(self.query(group_name), on_event,
+                                on_done=on_done, on_watermark=on_watermark)
+        if self.live and not on_watermark:
+            return self.live_tail(fetcher).follow(self.query(group_name), on_event,
+                                                  on_caught_up=on_done,
+                                                  max_poll_interval=self.max_poll_interval)
+        # Merged output waits for the watermark of every group, so idle
+        # groups can not back off there without holding up the busy ones
+        return fetcher.follow(self.query(group_name), on_event,
+                              on_caught_up=on_done, tail=True,
+                              on_watermark=on_watermark,
+                              max_poll_interval=None if on_watermark
+                              else self.max_poll_interval)
+
+    def submit_group(self, fetcher, group_name, on_event, region=None,
+                     on_watermark=None):
+        """ Fetch group_name on fetcher with fetch_group(). Returns an Event
+        that is set when the group is done, or when fetching it failed
+        """
+        done = Event()
+        future = fetcher.submit(self.fetch_group(fetcher, group_name, on_event,
+                                                 on_done=done.set,
+                                                 on_watermark=on_watermark,
+                                                 region=region))
+        future.add_done_callback(partial(self._group_finished, group_name,
+                                         region, done))
+        return done
+
+    def _group_finished(self, group_name, region, done, future):
+        error = None if future.cancelled() else future.exception()
+        if error is not None and is_not_found(error):
+            thread = Thread(target=self.group_missing,
+                            args=(group_name, region, done))
+            thread.daemon = True
+            thread.start()
+            return
+        if error is not None:
+            self.group_failed(self.group_label(group_name, region), error)
+        done.set()
+
+    def group_missing(self, group_name, region=None, done=None):
+        """ Handle a group that was deleted after the group list was cached:
+        drop it from the cache and, once per region, list the groups again
+        and start the ones that the cached list did not have. done is set
+        once that is over
+        """
+        try:
+            cache = self.group_cache(region)
+            cache.forget(group_name)
+            sys.stderr.write("Log group %s no longer exists%s" %
+                             (self.group_label(group_name, region), os.linesep))
+            with self._groups_lock:
+                relist = region not in self._relisted
+                self._relisted.add(region)
+            if relist:
+                try:
+                    names = cache.refresh(literal_prefix(self.log_group_filter))
+                except Exception as error:
+                    self.group_failed(self.group_label(group_name, region), error)
+                    return
+                self.add_groups([name for name in names
+                                 if re.search(self.log_group_filter, name)],
+                                region=region)
+        finally:
+            if done:
+                done.set()
+
+    def group_failed(self, label, error):
+        """ Report a group that could not be fetched. get_logs() callers
+        find them in failed_groups
+        """
+        with self._groups_lock:
+            self.failed_groups.append(label)
+        sys.stderr.write("Failed to fetch %s: %s%s" % (label, error, os.linesep))
+
+    def print_unordered(self, fetcher):
         output_queue = queue.PriorityQueue()
-        work_items = []
-
-        for group_name in groups:
-            work_item = {'item': {'logGroupName': group_name,
-                                  'interleaved': True,
-                                  'startTime': self.start_time,
-                                  'filterPattern': self.log_filter if self.log_filter else ""
-                                  },
-                         'meta': {'initialQueriesDone': Event()}
-                         }
-            if self.end_time:
-                work_item['item']['endTime'] = self.end_time
-            work_queue.put(work_item)
-            work_items.append(work_item)
-
-        for _ in range(10):
-            cwlogs_worker = CloudWatchLogsWorker(work_queue, semaphore, output_queue)
-            log_threads.append(cwlogs_worker)
-            cwlogs_worker.start()
-
-        speed_limiter = SpeedLimitThread(semaphore)
-        speed_limiter.start()
-        all_initial_queries_done = False
-        tailing = True if not self.end_time else False
-        wait_time = None if self.sort else 0.0
-
-        while not self._stopped.isSet():
-            try:
-                if not all_initial_queries_done:
-                    loop_queries_done = True
-                    for work_item in work_items:
-                        if not work_item['meta']['initialQueriesDone'].wait(wait_time):
-                            loop_queries_done = False
-                    all_initial_queries_done = loop_queries_done
-                elif self.sort:
-                    time.sleep(5.0)  # allow time to sort while tailing
-                self.print_output_if_any(output_queue)
-                if all_initial_queries_done and not tailing:
-                    raise KeyboardInterrupt
-            except KeyboardInterrupt:
-                for thread in log_threads:
-                    thread.stop()
-                speed_limiter.stop()
+        done_events = []
+
+        def start_group(group_name, region):
+            done_events.append(self.submit_group(
+                fetcher, group_name,
+                partial(self.queue_event, output_queue, group_name),
+                region=region))
+        self.start_groups(start_group)
+        while not self._stopped.is_set():
+            all_done = all(done.is_set() for done in done_events)
+            self.print_output_if_any(output_queue)
+            if all_done and self.end_time:
                 return
 
+    def print_merged(self, fetcher):
+        """ Print events of all groups in timestamp order as soon as every
+        group has got past them. Fetching of groups that are ahead stops
+        while their buffer in the merge is full
+        """
+        merge = fetcher.submit(self.new_merge()).result()
+        started = []
+
+        def start_group(group_name, region):
+            started.append(fetcher.submit(self.merge_new_group(fetcher, merge,
+                                                               group_name, region)))
+        self.start_groups(start_group)
+        for future in list(started):
+            future.result()
+        merged = fetcher.submit(merge.run())
+        while not self._stopped.is_set():
+            try:
+                return merged.result(timeout=1.0)
+            except FutureTimeoutError:
+                pass
+
+    async def new_merge(self):
+        return WatermarkMerge(self.print_event, on_idle=self.output.flush)
+
+    async def merge_new_group(self, fetcher, merge, group_name, region=None):
+        source = merge.source(self.group_label(group_name, region))
+        fetcher.spawn(self.merge_group(fetcher, source, group_name, region))
+
+    async def merge_group(self, fetcher, source, group_name, region=None):
+        async def on_event(event):
+            event['logGroupName'] = group_name
+            await source.put(event['timestamp'], event)
+        try:
+            await self.fetch_group(fetcher, group_name, on_event,
+                                   on_watermark=source.advance, region=region)
+        except Exception as error:
+            if is_not_found(error):
+                await asyncio.get_event_loop().run_in_executor(
+                    None, self.group_missing, group_name, region)
+            else:
+                self.group_failed(self.group_label(group_name, region), error)
+        finally:
+            await source.close()
+
+    def print_insights(self, fetcher):
+        """ Run self.insights as Logs Insights queries over the matching
+        groups and print the result rows
+        """
+        end = self.end_time or int(time.time() * 1000)
+        queries = []
+        for region in self.regions:
+            groups = self.get_filtered_groups(self.log_group_filter, region=region)
+            if groups:
+                queries.append(InsightsQuery(
+                    fetcher.for_region(region) if region else fetcher,
+                    self.insights, groups, self.start_time, end,
+                    partial(self.print_row, region=region)))
+        if not queries:
+            return
+        async def run_queries():
+            await asyncio.gather(*[insights_query.run() for insights_query in queries])
+        done = fetcher.submit(run_queries())
+        while not self._stopped.is_set():
+            try:
+                done.result(timeout=1.0)
+                break
+            except FutureTimeoutError:
+                pass
+        failed = [failure for insights_query in queries
+                  for failure in insights_query.failed]
+        for failed_groups, start, end, status in failed:
+            sys.stderr.write("Insights query %s for %s from %s to %s%s" %
+                             (status, ", ".join(failed_groups), millis2iso(start),
+                              millis2iso(end), os.linesep))
+
+    def print_aggregated(self, fetcher):
+        """ Count events and bytes per bucket and group with self.aggregate,
+        an EventAggregator, and print the counts instead of the events.
+        Buckets are printed once every group has gone past them, and when
+        tailing a minute after they end
+        """
+        done_events = []
+
+        def start_group(group_name, region):
+            label = self.group_label(group_name, region)
+
+            def count(event):
+                self.aggregate.add(label, event,
+                                   self.formatter.stream_name(event['logStreamName']))
+            self.aggregate.add_group(label)
+            done = self.submit_group(fetcher, group_name, count, region=region,
+                                     on_watermark=partial(self.aggregate.advance,
+                                                          label)
+                                     if self.end_time else None)
+            done_events.append((label, done))
+        self.start_groups(start_group)
+        header = self.formatter.format_bucket_header()
+        if header:
+            self.output.write(header)
+        try:
+            while not self._stopped.is_set():
+                if self.end_time and all(done.is_set() for _, done in done_events):
+                    break
+                time.sleep(1.0)
+                if self.end_time:
+                    for label, done in list(done_events):
+                        if done.is_set():
+                            self.aggregate.advance(label, INFINITY)
+                    self.print_buckets(self.aggregate.watermark())
+                else:
+                    self.print_buckets(int(time.time() * 1000) - 60000)
+        finally:
+            self.print_buckets()
+            for row in self.formatter.format_top_streams(self.aggregate.top_streams()):
+                self.output.write(row)
+
+    def export(self, fetcher):
+        """ Write events to files per group with self.exporter, an
+        EventExporter, and print a line per file when done
+        """
+        done_events = []
+
+        def start_group(group_name, region):
+            label = self.group_label(group_name, region)
+
+            async def add(event):
+                event['logGroupName'] = group_name
+                event['logStreamName'] = self.formatter.stream_name(event['logStreamName'])
+                await self.exporter.add_async(label, event)
+            done_events.append(self.submit_group(fetcher, group_name, add,
+                                                 region=region))
+        self.start_groups(start_group)
+        try:
+            while not self._stopped.is_set():
+                if self.end_time and all(done.is_set() for done in done_events):
+                    break
+                time.sleep(1.0)
+        finally:
+            fetcher.stop()
+            self.exporter.close()
+            for group_name, group_file in sorted(self.exporter.files.items()):
+                self.output.write("%10d %s" % (group_file.events, group_file.path))
+            for path, error in self.exporter.errors:
+                sys.stderr.write("Failed to write %s: %s%s" % (path, error, os.linesep))
+
+    def print_buckets(self, before=None):
+        for row in self.aggregate.closed_buckets(before):
+            self.output.write(self.formatter.format_bucket(row))
+        self.output.flush()
+
+    def print_row(self, row, region=None):
+        if region:
+            row['@region'] = region
+        event = row_to_event(row)
+        if event:
+            if region:
+                event['region'] = region
+            self.output.write(self.formatter.format(event))
+        else:
+            self.output.write(self.formatter.format_fields(row))
+
+    def print_event(self, event):
+        self.output.write(self.formatter.format(event))
+
+    def queue_event(self, output_queue, group_name, event):
+        event['logGroupName'] = group_name
+        output_queue.put((event['timestamp'], self.formatter.format(event)))  # sort by timestamp (first value in tuple)
+
     def print_output_if_any(self, output_queue):
         while True:
             try:
-                uprint(' '.join(output_queue.get(timeout=1.0)[1]))
+                line = output_queue.get_nowait()[1]
             except queue.Empty:
-                break
+                self.output.flush()
+                try:
+                    line = output_queue.get(timeout=1.0)[1]
+                except queue.Empty:
+                    break
+            self.output.write(line)
 
 
-class SpeedLimitThread(Thread):
-    def __init__(self, semaphore):
-        Thread.__init__(self)
-        self.semaphore = semaphore
-        self._stopped = Event()
-        self.setDaemon(True)
+class EventFormatter(object):
+    """ Formats events as lines of text or JSON. Timestamps are converted to
+    text once per second and colors are only added when writing to a
+    terminal, unless color is given. With merge_shards the shards of a
+    ShardedLogSender are shown as the stream they belong to
+    """
+    COLORED = "\033[33m%s\033[0m \033[32m%s\033[0m \033[36m%s\033[0m %s"
+    PLAIN = "%s %s %s %s"
+    COLORED_REGION = "\033[33m%s\033[0m \033[35m%s\033[0m \033[32m%s\033[0m \033[36m%s\033[0m %s"
+    PLAIN_REGION = "%s %s %s %s %s"
 
-    def tick(self):
-        while not self._stopped.wait(1.1):
-            try:
-                for _ in range(5):
-                    self.semaphore.release()
-            except ValueError:
-                pass
-        return
+    def __init__(self, output="text", color=None, stream=None, merge_shards=False):
+        self.output = output
+        self.merge_shards = merge_shards
+        if color is None:
+            color = use_color(stream or sys.stdout)
+        self._template = self.COLORED if color else self.PLAIN
+        self._region_template = self.COLORED_REGION if color else self.PLAIN_REGION
+        self._seconds = {}
 
-    def stop(self):
-        self._stopped.set()
+    def iso_time(self, millis):
+        """ Same as millis2iso(millis)
+        """
+        seconds, millis = divmod(int(millis), 1000)
+        cached = self._seconds.get(seconds)
+        if cached is None:
+            if len(self._seconds) > 4096:
+                self._seconds.clear()
+            whole = millis2iso(seconds * 1000)
+            cached = (whole[:19], whole)
+            self._seconds[seconds] = cached
+        if millis:
+            return "%s.%03d" % (cached[0], millis)
+        return cached[1]
 
-    def run(self):
-        self.tick()
+    def stream_name(self, stream_name):
+        if self.merge_shards:
+            return unshard_stream_name(stream_name)
+        return stream_name
 
+    def format(self, event):
+        """ Event as a line. The region of the event, when it has one, comes
+        after the time
+        """
+        region = event.get('region')
+        if self.output == "jsonl":
+            fields = {'timestamp': event['timestamp'],
+                      'logGroupName': event['logGroupName'],
+                      'logStreamName': self.stream_name(event['logStreamName']),
+                      'message': event['message']}
+            if region:
+                fields['region'] = region
+            return json.dumps(fields, ensure_ascii=False)
+        if region:
+            return (self._region_template % (self.iso_time(event['timestamp']), region,
+                                             event['logGroupName'],
+                                             self.stream_name(event['logStreamName']),
+                                             event['message'])).rstrip()
+        return (self._template % (self.iso_time(event['timestamp']),
+                                  event['logGroupName'],
+                                  self.stream_name(event['logStreamName']),
+                                  event['message'])).rstrip()
 
-class LogWorkerThread(Thread):
-    def __init__(self):
-        Thread.__init__(self)
-        self._stopped = Event()
-        self.setDaemon(True)
+    def format_bucket_header(self):
+        if self.output == "jsonl":
+            return ""
+        return "%-19s %10s %12s %s" % ("bucket", "events", "bytes", "group")
 
-    def list_logs(self):
-        return
+    def format_bucket(self, row):
+        bucket, group_name, events, size = row
+        if self.output == "jsonl":
+            return json.dumps({'bucket': bucket, 'time': self.iso_time(bucket)[:19],
+                               'logGroupName': group_name, 'events': events,
+                               'bytes': size})
+        return "%-19s %10d %12d %s" % (self.iso_time(bucket)[:19], events, size, group_name)
 
-    def stop(self):
-        self._stopped.set()
+    def format_top_streams(self, rows):
+        if self.output == "jsonl":
+            return [json.dumps({'logGroupName': group_name,
+                                'logStreamName': self.stream_name(stream_name),
+                                'events': events, 'bytes': size, 'error': error})
+                    for group_name, stream_name, events, size, error in rows]
+        lines = ["", "%-19s %10s %12s %s" % ("top streams", "events", "bytes", "group stream")]
+        for group_name, stream_name, events, size, error in rows:
+            lines.append("%-19s %10d %12d %s %s" % ("+-%d" % error if error else "",
+                                                    events, size, group_name,
+                                                    self.stream_name(stream_name)))
+        return lines
 
-    def run(self):
-        self.list_logs()
+    def format_fields(self, fields):
+        """ Format a row of named values such as an Insights stats result
+        """
+        fields = dict((name, value) for name, value in fields.items()
+                      if name != '@ptr')
+        if self.output == "jsonl":
+            return json.dumps(fields, ensure_ascii=False)
+        return ' '.join("%s=%s" % (name, value) for name, value in sorted(fields.items()))
 
 
-class CloudWatchLogsWorker(LogWorkerThread):
-    def __init__(self, work_queue, semaphore, output_queue):
-        LogWorkerThread.__init__(self)
-        self.work_queue = work_queue
-        self.semaphore = semaphore
-        self.output_queue = output_queue
-        self._logs = logs()
+class BufferedOutput(object):
+    """ Writes lines to stream in batches of up to buffer_bytes. Lines wait at
+    most max_delay seconds unless nothing else is written, so call flush()
+    when there is nothing more to write for now
+    """
+    def __init__(self, stream=None, buffer_bytes=65536, max_delay=0.2):
+        self.stream = stream or sys.stdout
+        self.buffer_bytes = buffer_bytes
+        self.max_delay = max_delay
+        self._lines = []
+        self._size = 0
+        self._first = None
+
+    def write(self, line):
+        if not self._lines:
+            self._first = time.time()
+        self._lines.append(line)
+        self._lines.append(os.linesep)
+        self._size += len(line) + 1
+        if self._size >= self.buffer_bytes or \
+                time.time() - self._first >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        if self._lines:
+            self.stream.write(''.join(self._lines))
+            self._lines = []
+            self._size = 0
+        self.stream.flush()
 
-    @retry(tries=5, delay=2, backoff=2)
-    def filter_log_events(self, item):
-        return self._logs.filter_log_events(**item)
-
-    def list_logs(self):
-        do_wait = object()
-
-        def generator():
-            work_item = None
-            last_timestamp = None
-            while True:
-                if not work_item:
-                    work_item = self.work_queue.get()
-                    last_timestamp = None
-                self.semaphore.acquire()
-                response = self.filter_log_events(work_item['item'])
-                for event in response.get('events', []):
-                    event['logGroupName'] = work_item['item']['logGroupName']
-                    last_timestamp = event.get('timestamp', None)
-                    yield event
-
-                if 'nextToken' in response:
-                    work_item['item']['nextToken'] = response['nextToken']
-                else:
-                    if 'nextToken' in work_item['item']:
-                        work_item['item'].pop('nextToken')
-                    if last_timestamp:
-                        work_item['item']['startTime'] = last_timestamp + 1
-                    work_item['meta']['initialQueriesDone'].set()
-                    self.work_queue.put(work_item)
-                    work_item = None
-                    yield do_wait
-
-        for event in generator():
-            if event is do_wait and not self._stopped.wait(0.0):
-                continue
-            elif self._stopped.is_set():
-                return
 
-            output = []
-            output.append(colored(millis2iso(event['timestamp']), 'yellow'))
-            output.append(colored(event['logGroupName'], 'green'))
-            output.append(colored(event['logStreamName'], 'cyan'))
-            output.append(event['message'])
-            self.output_queue.put((event['timestamp'], output))  # sort by timestamp (first value in tuple)
+def use_color(stream):
+    if os.environ.get("NO_COLOR"):
+        return False
+    if os.environ.get("FORCE_COLOR"):
+        return True
+    isatty = getattr(stream, "isatty", None)
+    return bool(isatty and isatty())
@@ -0,0 +1,103 @@
+""" Streaming k-way merge of timestamped items from many sources by
+watermarks. Runs on an asyncio event loop next to the sources that feed it.
+"""
+import asyncio
+import heapq
+from collections import deque
+
+INFINITY = float("inf")
+
+
+class MergeSource(object):
+    """ One input of a WatermarkMerge. Items must be put in timestamp order.
+    The watermark promises that no item older than it will be put anymore.
+    put() waits while buffer_size items are waiting to be merged
+    """
+    def __init__(self, merge, name, buffer_size):
+        self.name = name
+        self.buffer_size = buffer_size
+        self.watermark = -INFINITY
+        self.closed = False
+        self._merge = merge
+        self._buffer = deque()
+
+    def bound(self):
+        """ Timestamp that every item still to come from this source is at
+        or after
+        """
+        if self._buffer:
+            return self._buffer[0][0]
+        return self.watermark
+
+    async def put(self, timestamp, item):
+        merge = self._merge
+        async with merge._lock:
+            while len(self._buffer) >= self.buffer_size:
+                await merge._space.wait()
+            self._buffer.append((timestamp, item))
+            if len(self._buffer) == 1:
+                merge._ready.notify()
+
+    async def advance(self, watermark):
+        async with self._merge._lock:
+            if watermark > self.watermark:
+                self.watermark = watermark
+                if not self._buffer:
+                    self._merge._ready.notify()
+
+    async def close(self):
+        await self.advance(INFINITY)
+        self.closed = True
+
+
+class WatermarkMerge(object):
+    """ Hands items from all sources to emit in timestamp order. An item is
+    emitted as soon as it is not newer than the bound of every source: the
+    head of its buffer or, with an empty buffer, its watermark. Sources that
+    are ahead wait in put() once their buffer is full, so memory stays at
+    most buffer_size items per source. run() returns once every source is
+    closed and drained. on_idle is called whenever the merge has to wait
+    for a source.
+    """
+    def __init__(self, emit, buffer_size=1000, on_idle=None):
+        self.emit = emit
+        self.on_idle = on_idle
+        self.buffer_size = buffer_size
+        self._sources = []
+        self._lock = asyncio.Lock()
+        self._ready = asyncio.Condition(self._lock)
+        self._space = asyncio.Condition(self._lock)
+
+    def source(self, name):
+        source = MergeSource(self, name, self.buffer_size)
+        self._sources.append(source)
+        return source
+
+    def _bound(self):
+        return min([source.bound() for source in self._sources] or [INFINITY])
+
+    async def run(self):
+        async with self._lock:
+            while True:
+                bound = self._bound()
+                heads = [(source._buffer[0][0], index) for index, source
+                         in enumerate(self._sources) if source._buffer]
+                if not heads and bound == INFINITY:
+                    return
+                heapq.heapify(heads)
+                emitted = False
+                while heads and heads[0][0] <= bound:
+                    _, index = heapq.heappop(heads)
+                    source = self._sources[index]
+                    self.emit(source._buffer.popleft()[1])
+                    emitted = True
+                    if source._buffer:
+                        heapq.heappush(heads, (source._buffer[0][0], index))
+                    else:
+                        bound = min(bound, source.watermark)
+                if emitted:
+                    self._space.notify_all()
+                else:
+                    if self.on_idle:
+                        self.on_idle()
+                    await self._ready.wait()
@@ -0,0 +1,79 @@
+""" Joining the lines of multiline messages, such as stack traces, into one
+log event before they are batched.
+"""
+import re
+import time
+from threading import Lock
+
+
+class MultilineAssembler(object):
+    """ Collects lines given to add() into events and hands each event to
+    line_function as the lines joined with newlines, with the position of
+    its last line. Either start or continuation, a regular expression, tells
+    where events begin: with start a line that matches it begins a new event
+    and other lines continue the current one, with continuation a line that
+    matches it continues the current event and other lines begin a new one.
+
+    An event is handed on when the next one begins, when it has max_lines
+    lines or max_bytes bytes, or when no line has been added for timeout
+    seconds, which flush_expired() checks. Lines may be bytes or text.
+    Thread safe.
+    """
+    def __init__(self, line_function, start=None, continuation=None,
+                 max_lines=500, max_bytes=262118, timeout=1.0):
+        if bool(start) == bool(continuation):
+            raise ValueError("Give either start or continuation")
+        pattern = start or continuation
+        self._patterns = {bytes: re.compile(pattern.encode("utf-8")),
+                          str: re.compile(pattern)}
+        self._continuation = bool(continuation)
+        self.line_function = line_function
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.events = 0
+        self.lines = 0
+        self._lock = Lock()
+        self._lines = []
+        self._bytes = 0
+        self._position = None
+        self._added = 0
+
+    def _begins_event(self, line):
+        matches = self._patterns[type(line)].search(line) is not None
+        return matches != self._continuation
+
+    def add(self, line, position=None):
+        line = line.rstrip(b"\r\n" if isinstance(line, bytes) else "\r\n")
+        with self._lock:
+            self.lines += 1
+            if self._lines and (self._begins_event(line) or
+                                self._bytes + len(line) + 1 > self.max_bytes):
+                self._flush()
+            self._lines.append(line)
+            self._bytes += len(line) + 1
+            self._position = position
+            self._added = time.time()
+            if len(self._lines) >= self.max_lines or self._bytes >= self.max_bytes:
+                self._flush()
+
+    def flush_expired(self, now=None):
+        """ Hand on the current event if no line has been added to it for
+        timeout seconds
+        """
+        with self._lock:
+            if self._lines and (now or time.time()) - self._added >= self.timeout:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            if self._lines:
+                self._flush()
+
+    def _flush(self):
+        lines = self._lines
+        self._lines = []
+        self._bytes = 0
+        self.events += 1
+        separator = b"\n" if isinstance(lines[0], bytes) else "\n"
+        self.line_function(separator.join(lines), self._position)
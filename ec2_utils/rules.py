@@ -0,0 +1,156 @@
+""" Rules that drop, sample, rate limit and redact log lines before they are
+queued for sending. Rules are read from a JSON file:
+
+    {"rules": [
+        {"name": "health", "match": "GET /health", "action": "drop"},
+        {"name": "retry", "match": "Retrying connection", "action": "sample",
+         "every": 100},
+        {"name": "errors", "match": "ERROR", "action": "rate", "per_second": 50},
+        {"name": "cards", "match": "\\\\b\\\\d{16}\\\\b", "action": "redact",
+         "replace": "<card>"}
+    ]}
+
+drop drops every matching line, sample keeps the first of every `every`
+matching lines and rate keeps at most `per_second` matching lines per
+second. The first of these rules in the file whose pattern matches a line
+decides what happens to it. redact replaces every match in the lines that
+are kept with `replace`, an empty string by default. As the patterns are
+combined into one, they can not refer to groups by number.
+"""
+import json
+import re
+import time
+from functools import partial
+from threading import Lock
+
+ACTIONS = ("drop", "sample", "rate", "redact")
+
+
+class Rule(object):
+    __slots__ = ("name", "action", "pattern", "every", "per_second",
+                 "replace", "hits", "dropped", "_second", "_in_second")
+
+    def __init__(self, name, action, pattern, every=1, per_second=0,
+                 replace=""):
+        if action not in ACTIONS:
+            raise ValueError("Unknown action %s in rule %s" % (action, name))
+        self.name = name
+        self.action = action
+        self.pattern = pattern
+        self.every = max(1, int(every))
+        self.per_second = int(per_second)
+        self.replace = replace
+        self.hits = 0
+        self.dropped = 0
+        self._second = None
+        self._in_second = 0
+
+    def keep(self, now):
+        """ Count a hit and tell if the line is kept
+        """
+        self.hits += 1
+        if self.action == "drop":
+            kept = False
+        elif self.action == "sample":
+            kept = (self.hits - 1) % self.every == 0
+        else:
+            second = int(now)
+            if second != self._second:
+                self._second = second
+                self._in_second = 0
+            self._in_second += 1
+            kept = self._in_second <= self.per_second
+        if not kept:
+            self.dropped += 1
+        return kept
+
+
+class RuleSet(object):
+    """ Applies rules to lines. The patterns of the dropping, sampling and
+    rate limiting rules are combined into one regular expression, so a line
+    that matches none of them costs one search however many rules there
+    are. For a line that matches, only the rules before the one that
+    matched first in the line are tried on their own to find the first rule
+    in the file that matches. The redaction patterns are likewise combined
+    into one substitution. Lines may be bytes or text. Thread safe.
+    """
+    def __init__(self, rules):
+        self.rules = rules
+        self._filters = [rule for rule in rules if rule.action != "redact"]
+        self._redactions = [rule for rule in rules if rule.action == "redact"]
+        self._compiled = {}
+        self._lock = Lock()
+        for kind in (bytes, str):
+            self._compiled[kind] = (
+                _combine([rule.pattern for rule in self._filters], kind),
+                [_compile(rule.pattern, kind) for rule in self._filters],
+                _combine([rule.pattern for rule in self._redactions], kind),
+                [_encode(rule.replace, kind) for rule in self._redactions])
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, "r") as rules_file:
+            data = json.load(rules_file)
+        rules = []
+        for index, rule in enumerate(data.get("rules", [])):
+            if "match" not in rule or "action" not in rule:
+                raise ValueError("Rule %d needs match and action" % (index + 1))
+            rules.append(Rule(rule.get("name", "rule%d" % (index + 1)),
+                              rule["action"], rule["match"],
+                              every=rule.get("every", 1),
+                              per_second=rule.get("per_second", 0),
+                              replace=rule.get("replace", "")))
+        return cls(rules)
+
+    def apply(self, line):
+        """ The line to send, redacted if needed, or None to drop it
+        """
+        combined, patterns, redact, replacements = self._compiled[type(line)]
+        if combined is not None:
+            match = combined.search(line)
+            if match:
+                first = int(match.lastgroup[1:])
+                for index in range(first):
+                    if patterns[index].search(line):
+                        first = index
+                        break
+                with self._lock:
+                    if not self._filters[first].keep(time.time()):
+                        return None
+        if redact is not None:
+            matched = []
+            line = redact.sub(partial(self._redact, replacements, matched), line)
+            if matched:
+                with self._lock:
+                    for index in matched:
+                        self._redactions[index].hits += 1
+        return line
+
+    @staticmethod
+    def _redact(replacements, matched, match):
+        index = int(match.lastgroup[1:])
+        matched.append(index)
+        return replacements[index]
+
+    def counters(self):
+        """ (name, action, hits, dropped) of each rule. The hits of a
+        redaction rule are the matches it replaced
+        """
+        with self._lock:
+            return [(rule.name, rule.action, rule.hits, rule.dropped)
+                    for rule in self.rules]
+
+
+def _encode(text, kind):
+    return text.encode("utf-8") if kind is bytes else text
+
+
+def _compile(pattern, kind):
+    return re.compile(_encode(pattern, kind))
+
+
+def _combine(patterns, kind):
+    if not patterns:
+        return None
+    return _compile("|".join("(?P<r%d>%s)" % (index, pattern)
+                             for index, pattern in enumerate(patterns)), kind)
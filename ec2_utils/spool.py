@@ -0,0 +1,166 @@
+""" Segmented on-disk queue for batches that do not fit in memory
+"""
+import json
+import os
+import struct
+
+_HEADER = struct.Struct(">II")
+
+
+class SpillQueue(object):
+    """ FIFO of records on disk. Records are appended to segment files of
+    about segment_bytes each and read back in order from a read cursor
+    (segment, offset). Fully read segments are deleted. Each record carries a
+    count of the things it holds (e.g. lines) for the pending_count and
+    dropped_count counters. When appending would take the queue over
+    max_bytes the oldest segments are dropped and counted in dropped_bytes
+    and dropped_count.
+
+    The queue only extends memory while the process runs and the directory
+    is emptied when the queue is opened: anything not sent before a restart
+    is read again from the followed files through their checkpoints.
+    """
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024,
+                 segment_bytes=16 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.spilled_bytes = 0
+        self.dropped_bytes = 0
+        self.dropped_count = 0
+        self._segments = []
+        self._sizes = {}
+        self._counts = {}
+        self._record_counts = {}
+        self._next_segment = 0
+        self._writer = None
+        self._reader = None
+        self._read_segment = None
+        self._read_offset = 0
+        self.pending_bytes = 0
+        self.pending_count = 0
+        self._records = 0
+        self._remove_segment_files()
+
+    def __len__(self):
+        return self._records
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, "%020d.seg" % segment)
+
+    def _rotate_writer(self):
+        if self._writer:
+            self._writer.close()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        segment = self._next_segment
+        self._next_segment += 1
+        self._writer = open(self._segment_path(segment), "ab")
+        self._segments.append(segment)
+        self._sizes[segment] = 0
+        self._counts[segment] = 0
+        self._record_counts[segment] = 0
+
+    def append(self, record, count=1):
+        """ Append a json serializable record to the end of the queue
+        """
+        data = json.dumps(record, separators=(",", ":")).encode("utf-8")
+        size = _HEADER.size + len(data)
+        while self._segments and self.pending_bytes + size > self.max_bytes:
+            self._drop_oldest()
+        if self._writer is None or \
+                self._sizes[self._segments[-1]] + size > self.segment_bytes:
+            self._rotate_writer()
+        self._writer.write(_HEADER.pack(len(data), count))
+        self._writer.write(data)
+        self._writer.flush()
+        segment = self._segments[-1]
+        self._sizes[segment] += size
+        self._counts[segment] += count
+        self._record_counts[segment] += 1
+        self.pending_bytes += size
+        self.pending_count += count
+        self._records += 1
+        self.spilled_bytes += size
+
+    def pop(self):
+        """ Remove and return the record at the read cursor or None
+        """
+        while self._segments:
+            segment = self._segments[0]
+            if self._read_segment != segment:
+                if self._reader:
+                    self._reader.close()
+                self._reader = open(self._segment_path(segment), "rb")
+                self._read_segment = segment
+                self._read_offset = 0
+            header = self._reader.read(_HEADER.size)
+            if len(header) == _HEADER.size:
+                length, count = _HEADER.unpack(header)
+                data = self._reader.read(length)
+                self._read_offset += _HEADER.size + length
+                self.pending_bytes -= _HEADER.size + length
+                self.pending_count -= count
+                self._records -= 1
+                self._counts[segment] -= count
+                self._record_counts[segment] -= 1
+                return json.loads(data.decode("utf-8"))
+            if segment == self._segments[-1]:
+                # Everything written has been read, start over on a new
+                # segment next time instead of growing this one
+                self._remove_segment(segment)
+                if self._writer:
+                    self._writer.close()
+                    self._writer = None
+                return None
+            self._remove_segment(segment)
+        return None
+
+    def _remove_segment(self, segment):
+        if self._read_segment == segment and self._reader:
+            self._reader.close()
+            self._reader = None
+            self._read_segment = None
+        self._segments.remove(segment)
+        del self._sizes[segment]
+        del self._counts[segment]
+        del self._record_counts[segment]
+        try:
+            os.unlink(self._segment_path(segment))
+        except OSError:
+            pass
+
+    def _drop_oldest(self):
+        segment = self._segments[0]
+        unread = self._sizes[segment]
+        if self._read_segment == segment:
+            unread -= self._read_offset
+        self.dropped_bytes += unread
+        self.dropped_count += self._counts[segment]
+        self.pending_bytes -= unread
+        self.pending_count -= self._counts[segment]
+        self._records -= self._record_counts[segment]
+        if segment == self._segments[-1] and self._writer:
+            self._writer.close()
+            self._writer = None
+        self._remove_segment(segment)
+
+    def close(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+        if self._reader:
+            self._reader.close()
+            self._reader = None
+        self._remove_segment_files()
+        self._segments = []
+
+    def _remove_segment_files(self):
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith(".seg"):
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except OSError:
+                    pass
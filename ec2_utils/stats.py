@@ -0,0 +1,327 @@
+""" Metrics of a running log shipper in the Prometheus text format, served
+over HTTP on a TCP port or a Unix socket so that shipping lag can be
+alerted on and hosts sized from real numbers.
+"""
+import os
+import socket
+import socketserver
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Lock, Thread
+
+from ec2_utils.listen import remove_socket
+
+PREFIX = "log_to_cloudwatch_"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+PUT_SECONDS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_BYTES_BUCKETS = tuple(1024 * 4 ** power for power in range(6)) + (1048576,)
+THROTTLING_CODES = ("ThrottlingException", "Throttling", "TooManyRequestsException")
+
+
+class Histogram(object):
+    """ Cumulative buckets, sum and count of observed values. Not thread
+    safe
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        samples = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            samples.append(("_bucket", {"le": _number(bound)}, total))
+        samples.append(("_bucket", {"le": "+Inf"}, self.count))
+        samples.append(("_sum", {}, self.sum))
+        samples.append(("_count", {}, self.count))
+        return samples
+
+
+class ShipperStats(object):
+    """ Counters that the LogSenders of a LogShipper update as they send.
+    A failed PutLogEvents call is always tried again, so failures are
+    counted as retries. Thread safe.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.events = 0
+        self.bytes = 0
+        self.retries = 0
+        self.throttles = 0
+        self.last_sent = None
+        self.batch_bytes = Histogram(BATCH_BYTES_BUCKETS)
+        self.put_seconds = Histogram(PUT_SECONDS_BUCKETS)
+        self._lock = Lock()
+
+    def put_done(self, seconds):
+        with self._lock:
+            self.put_seconds.observe(seconds)
+
+    def put_failed(self, error):
+        code = getattr(error, "response", {}).get("Error", {}).get("Code")
+        with self._lock:
+            self.retries += 1
+            if code in THROTTLING_CODES:
+                self.throttles += 1
+
+    def batch_sent(self, batch):
+        with self._lock:
+            if batch.events:
+                self.events += len(batch.events)
+                self.bytes += batch.size
+                self.batch_bytes.observe(batch.size)
+            self.last_sent = time.time()
+
+    def families(self):
+        with self._lock:
+            return [
+                ("sent_events_total", "counter", "Log events sent",
+                 [("", {}, self.events)]),
+                ("sent_bytes_total", "counter",
+                 "Bytes of log events sent, as counted against the batch size limit",
+                 [("", {}, self.bytes)]),
+                ("batch_bytes", "histogram", "Bytes of the batches sent",
+                 self.batch_bytes.samples()),
+                ("put_seconds", "histogram", "Duration of PutLogEvents calls",
+                 self.put_seconds.samples()),
+                ("put_retries_total", "counter", "PutLogEvents calls that failed " +
+                 "and were tried again", [("", {}, self.retries)]),
+                ("put_throttles_total", "counter", "PutLogEvents calls that were " +
+                 "throttled", [("", {}, self.throttles)]),
+                ("last_send_timestamp_seconds", "gauge", "Time of the last batch " +
+                 "that was sent", [("", {}, self.last_sent or 0)])]
+
+
+def shipper_collector(shipper):
+    """ Collector of the stats of shipper and the queues of its senders
+    """
+    def collect():
+        queued = []
+        queued_bytes = []
+        dropped = []
+        for group, stream, lines, size, dropped_lines in shipper.queues():
+            labels = {"group": group, "stream": stream}
+            queued.append(("", labels, lines))
+            queued_bytes.append(("", labels, size))
+            dropped.append(("", labels, dropped_lines))
+        return shipper.stats.families() + [
+            ("queued_lines", "gauge", "Lines waiting to be sent", queued),
+            ("queued_bytes", "gauge", "Bytes of lines waiting to be sent, in " +
+             "memory or spilled to disk", queued_bytes),
+            ("dropped_lines_total", "counter", "Lines dropped because memory " +
+             "and spill space were full", dropped)]
+    return collect
+
+
+def follower_collector(follower, checkpoints):
+    """ Collector of the bytes of each file of a MultiFollower that have not
+    been read yet and that have not been sent yet, which is what is after
+    the checkpoint of the file
+    """
+    def collect():
+        unread = []
+        unsent = []
+        for key, file_name, dev, ino, offset in follower.positions():
+            try:
+                stat = os.stat(file_name)
+            except OSError:
+                continue
+            labels = {"file": key}
+            if (stat.st_dev, stat.st_ino) == (dev, ino):
+                unread.append(("", labels, max(0, stat.st_size - offset)))
+            else:
+                unread.append(("", labels, stat.st_size))
+            position = checkpoints.get(key)
+            if position and tuple(position[:2]) == (stat.st_dev, stat.st_ino):
+                unsent.append(("", labels, max(0, stat.st_size - position[2])))
+            else:
+                unsent.append(("", labels, stat.st_size))
+        return [("file_unread_bytes", "gauge", "Bytes of a followed file that " +
+                 "have not been read", unread),
+                ("file_unsent_bytes", "gauge", "Bytes of a followed file after " +
+                 "its checkpoint, that have not been sent", unsent)]
+    return collect
+
+
+def rules_collector(rules):
+    def collect():
+        hits = []
+        dropped = []
+        for name, action, rule_hits, rule_dropped in rules.counters():
+            labels = {"rule": name, "action": action}
+            hits.append(("", labels, rule_hits))
+            dropped.append(("", labels, rule_dropped))
+        return [("rule_hits_total", "counter", "Lines that a rule matched, " +
+                 "matches for redaction rules", hits),
+                ("rule_dropped_total", "counter", "Lines that a rule dropped",
+                 dropped)]
+    return collect
+
+
+def emf_collector(metrics):
+    def collect():
+        lines, events = metrics.counters()
+        return [("emf_lines_total", "counter", "Lines counted in metrics",
+                 [("", {}, lines)]),
+                ("emf_events_total", "counter", "EMF events sent",
+                 [("", {}, events)])]
+    return collect
+
+
+def archive_collector(archive):
+    def collect():
+        chunks, failed = archive.counters()
+        return [("archive_chunks_total", "counter", "Chunks archived to S3",
+                 [("", {"result": "uploaded"}, chunks - failed),
+                  ("", {"result": "failed"}, failed)])]
+    return collect
+
+
+def listener_collector(listener):
+    def collect():
+        return [("listener_messages_total", "counter",
+                 "Messages received on sockets", [("", {}, listener.messages)])]
+    return collect
+
+
+def format_families(families):
+    """ Prometheus text format of (name, type, help, samples) families where
+    samples are (suffix, labels, value)
+    """
+    lines = []
+    for name, kind, help_text, samples in families:
+        name = PREFIX + name
+        lines.append("# HELP %s %s" % (name, help_text))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for suffix, labels, value in samples:
+            if labels:
+                label_text = "{" + ",".join('%s="%s"' % (label, _escape(labels[label]))
+                                            for label in labels) + "}"
+            else:
+                label_text = ""
+            lines.append("%s%s%s %s" % (name, suffix, label_text, _number(value)))
+    return "\n".join(lines) + "\n"
+
+
+def parse_endpoint(address):
+    """ ("unix", path) of unix:PATH and ("tcp", (host, port)) of
+    [tcp:][HOST:]PORT. The host defaults to 127.0.0.1
+    """
+    if address.startswith("unix:") and len(address) > 5:
+        return "unix", address[5:]
+    if address.startswith("tcp:"):
+        address = address[4:]
+    host, _, port = address.rpartition(":")
+    if not port.isdigit():
+        raise ValueError("Invalid metrics endpoint " + address +
+                         ", expected [HOST:]PORT or unix:PATH")
+    return "tcp", (host.strip("[]") or "127.0.0.1", int(port))
+
+
+class MetricsServer(object):
+    """ Serves the families returned by collectors at /metrics and health at
+    /health in a thread of its own. healthy is called for /health and
+    returns a message if something is wrong, None otherwise.
+    """
+    def __init__(self, address, collectors, healthy=None):
+        self.kind, self.address = parse_endpoint(address) \
+            if isinstance(address, str) else address
+        self.collectors = collectors
+        self.healthy = healthy
+        self._server = None
+        self._thread = None
+
+    def render(self):
+        families = []
+        for collector in self.collectors:
+            families.extend(collector())
+        return format_families(families)
+
+    def start(self):
+        handler = type("Handler", (_Handler,), {"metrics_server": self})
+        if self.kind == "unix":
+            remove_socket(self.address)
+            self._server = _UnixHTTPServer(self.address, handler)
+        else:
+            server_class = _HTTP6Server if ":" in self.address[0] else _HTTPServer
+            self._server = server_class(self.address, handler)
+        self._thread = Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self._server.server_address
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            if self.kind == "unix":
+                try:
+                    os.unlink(self.address)
+                except OSError:
+                    pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+    metrics_server = None
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/metrics":
+            self._reply(200, self.metrics_server.render(), CONTENT_TYPE)
+        elif path == "/health":
+            problem = self.metrics_server.healthy() \
+                if self.metrics_server.healthy else None
+            if problem:
+                self._reply(503, problem + "\n")
+            else:
+                self._reply(200, "ok\n")
+        else:
+            self._reply(404, "Not found\n")
+
+    def _reply(self, status, text, content_type="text/plain; charset=utf-8"):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _HTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _HTTP6Server(_HTTPServer):
+    address_family = socket.AF_INET6
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _number(value):
+    if isinstance(value, float) and value != int(value):
+        return repr(value)
+    return str(int(value))
@@ -173,4 +173,13 @@ def get_file_content(filename):
         return f.read()
 
 def contains_key(dct, keyname):
-    return keyname in dct and dct[keyname]
\ No newline at end of file
+    return keyname in dct and dct[keyname]
+
+def is_ascii(text):
+    """ True if text is ASCII only, so its length is its size in UTF-8. Always
+        False without str.isascii (before Python 3.7)
+    """
+    isascii = getattr(text, "isascii", None)
+    if isascii:
+        return isascii()
+    return False
@@ -24,6 +24,7 @@ setup(name='ec2-utils',
       author_email='pasi@nitor.com',
       license='Apache 2.0',
       packages=['ec2_utils'],
+      python_requires='>=3.6',
       include_package_data=True,
       entry_points={
           'console_scripts': CONSOLESCRIPTS,
@@ -47,6 +48,9 @@ setup(name='ec2-utils',
           'wmi',
           'pypiwin32'
           ] if sys.platform.startswith('win') else []),
+      extras_require={
+          'export': ['pyarrow', 'zstandard']
+      },
       tests_require=[
           'pytest',
           'pytest-mock',
@@ -0,0 +1,92 @@
+""" Local stub of StartLiveTail that speaks the event stream protocol. Each
+session sends updates with one event per log group and then ends with
+SessionTimeoutException. Requests after the first sessions_ok ones are
+refused with AccessDeniedException.
+"""
+import json
+import struct
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+
+
+def _header(name, value):
+    name = name.encode("utf-8")
+    value = value.encode("utf-8")
+    return struct.pack("B", len(name)) + name + b"\x07" + \
+        struct.pack(">H", len(value)) + value
+
+
+def frame(headers, payload):
+    header_bytes = b"".join(_header(name, value) for name, value in headers)
+    prelude = struct.pack(">II", 16 + len(header_bytes) + len(payload),
+                          len(header_bytes))
+    prelude += struct.pack(">I", zlib.crc32(prelude) & 0xffffffff)
+    message = prelude + header_bytes + payload
+    return message + struct.pack(">I", zlib.crc32(message) & 0xffffffff)
+
+
+def event(kind, body):
+    return frame([(":message-type", "event"), (":event-type", kind),
+                  (":content-type", "application/json")],
+                 json.dumps(body).encode("utf-8"))
+
+
+def exception(kind, message):
+    return frame([(":message-type", "exception"), (":exception-type", kind),
+                  (":content-type", "application/json")],
+                 json.dumps({"message": message}).encode("utf-8"))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server.requests.append(body)
+        session = len(server.requests)
+        if session > server.sessions_ok:
+            self.send_response(400)
+            self.send_header("Content-Type", "application/x-amz-json-1.1")
+            self.end_headers()
+            self.wfile.write(json.dumps({"__type": "AccessDeniedException",
+                                         "message": "no live tail"}).encode("utf-8"))
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.amazon.eventstream")
+        self.end_headers()
+        groups = body["logGroupIdentifiers"]
+        self.wfile.write(event("initial-response", {}))
+        self.wfile.write(event("sessionStart", {"sessionId": str(session),
+                                                "logGroupIdentifiers": groups}))
+        for update in range(server.updates):
+            time.sleep(server.interval)
+            now = int(time.time() * 1000)
+            self.wfile.write(event("sessionUpdate", {
+                "sessionMetadata": {"sampled": False},
+                "sessionResults": [{
+                    "logGroupIdentifier": group, "logStreamName": "live",
+                    "message": "live %d %d" % (session, update),
+                    "timestamp": now, "ingestionTime": now} for group in groups]}))
+            self.wfile.flush()
+        self.wfile.write(exception("SessionTimeoutException", "session over"))
+
+
+def serve(sessions_ok=1, updates=2, interval=0.1):
+    """ Start the stub on a free port. requests of the returned server has
+    the bodies of the StartLiveTail requests it got
+    """
+    server = HTTPServer(("127.0.0.1", 0), _Handler)
+    server.sessions_ok = sessions_ok
+    server.updates = updates
+    server.interval = interval
+    server.requests = []
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,45 @@
+from ec2_utils.aggregate import EventAggregator, TopCounter
+from ec2_utils.merge import INFINITY
+
+
+def test_top_counter_is_exact_within_capacity():
+    counter = TopCounter(capacity=3)
+    for key, count in (("a", 5), ("b", 3), ("c", 1)):
+        for _ in range(count):
+            counter.add(key, 10)
+    assert counter.top(2) == [("a", 5, 50, 0), ("b", 3, 30, 0)]
+
+
+def test_top_counter_keeps_heavy_keys_with_their_error():
+    counter = TopCounter(capacity=2)
+    for _ in range(10):
+        counter.add("heavy", 1)
+    for key in ("x", "y", "z"):
+        counter.add(key, 1)
+    (heavy, events, size, error), (light, light_events, _, light_error) = counter.top(2)
+    assert (heavy, events, size, error) == ("heavy", 10, 10, 0)
+    # The last key took over the counter of the one before it
+    assert light == "z"
+    assert (light_events, light_error) == (3, 2)
+    assert light_events - light_error <= 1
+
+
+def event(timestamp, message="message", stream="stream"):
+    return {'timestamp': timestamp, 'message': message, 'logStreamName': stream}
+
+
+def test_buckets_close_once_every_group_is_past_them():
+    aggregator = EventAggregator(bucket_millis=1000)
+    aggregator.add_group("a")
+    aggregator.add_group("b")
+    aggregator.add("a", event(100, "ä"))
+    aggregator.add("a", event(1100))
+    aggregator.advance("a", 2500)
+    assert aggregator.closed_buckets(aggregator.watermark()) == []
+    aggregator.add("b", event(900))
+    aggregator.advance("b", 1000)
+    assert aggregator.closed_buckets(aggregator.watermark()) == \
+        [(0, "a", 1, 2), (0, "b", 1, 7)]
+    aggregator.advance("b", INFINITY)
+    assert aggregator.closed_buckets(aggregator.watermark()) == [(1000, "a", 1, 7)]
+    assert aggregator.top_streams()[0] == ("a", "stream", 2, 9, 0)
@@ -0,0 +1,113 @@
+import base64
+import gzip
+import os
+from threading import Event
+
+import pytest
+
+import ec2_utils.archive
+from ec2_utils.archive import S3Archive, S3ArchiveSender
+
+
+class FakeS3(object):
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+
+class SlowMultipartS3(FakeS3):
+    """ Multipart uploads that are created once created is set
+    """
+    def __init__(self):
+        FakeS3.__init__(self)
+        self.created = Event()
+        self.parts = {}
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.created.wait(5)
+        return {'UploadId': "upload"}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.parts[PartNumber] = Body
+        return {'ETag': str(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.objects[Key] = b"".join(self.parts[part['PartNumber']]
+                                     for part in MultipartUpload['Parts'])
+
+
+class Checkpoints(object):
+    def __init__(self):
+        self.positions = []
+
+    def set(self, file_name, position):
+        self.positions.append(position)
+
+
+class Chunk(object):
+    def __init__(self, seq, position):
+        self.seq = seq
+        self.position = position
+
+
+@pytest.fixture
+def archive(monkeypatch):
+    client = FakeS3()
+    monkeypatch.setattr(ec2_utils.archive, "s3", lambda: client)
+    archive = S3Archive("bucket", prefix="logs", instance_id="i-1")
+    yield archive, client
+    archive.stop()
+
+
+def test_chunk_is_uploaded_and_checkpointed(archive):
+    archive, client = archive
+    checkpoints = Checkpoints()
+    sender = S3ArchiveSender("/var/log/app.log", archive, checkpoints=checkpoints)
+    sender.send(b"one", position=(1, 2, 4))
+    sender.send("two\n", position=(1, 2, 8))
+    archive.stop()
+    (key, body), = client.objects.items()
+    assert key.startswith("logs/date=")
+    assert "/instance=i-1/file=var_log_app.log/" in key
+    assert key.endswith("-000000.log.gz")
+    assert gzip.decompress(body) == b"one\ntwo\n"
+    assert checkpoints.positions == [(1, 2, 8)]
+    assert (sender.chunks, sender.failed) == (1, 0)
+
+
+def test_checkpoint_stays_before_a_failed_chunk(archive):
+    archive, _ = archive
+    checkpoints = Checkpoints()
+    sender = S3ArchiveSender("app.log", archive, checkpoints=checkpoints)
+    sender._chunk_done(Chunk(1, "second"), True)
+    assert checkpoints.positions == []
+    sender._chunk_done(Chunk(0, "first"), True)
+    sender._chunk_done(Chunk(3, "fourth"), True)
+    sender._chunk_done(Chunk(2, "third"), False)
+    sender._chunk_done(Chunk(4, "fifth"), True)
+    assert checkpoints.positions == ["second"]
+    assert (sender.chunks, sender.failed) == (5, 1)
+    # Chunks after the failure do not pile up waiting for it
+    assert sender._done == {}
+    assert sender._commit_seq == 5
+
+
+def test_multipart_upload_is_created_in_the_upload_threads(monkeypatch):
+    client = SlowMultipartS3()
+    monkeypatch.setattr(ec2_utils.archive, "s3", lambda: client)
+    archive = S3Archive("bucket", instance_id="i-1", part_bytes=0)
+    sender = S3ArchiveSender("app.log", archive)
+    lines = [base64.b64encode(os.urandom(48 * 1024)) for _ in range(160)]
+    for line in lines:
+        sender.send(line)
+    # Lines keep coming while the upload is being created
+    assert not client.created.is_set()
+    assert client.parts == {}
+    client.created.set()
+    archive.stop()
+    (body,) = client.objects.values()
+    assert len(client.parts) > 1
+    assert gzip.decompress(body) == b"".join(line + b"\n" for line in lines)
+    assert (sender.chunks, sender.failed) == (1, 0)
@@ -0,0 +1,101 @@
+import time
+
+import pytest
+
+from ec2_utils.discovery import LogGroupCache, literal_prefix
+
+
+@pytest.mark.parametrize("pattern, prefix", [
+    ("^/aws/lambda/", "/aws/lambda/"),
+    ("^/aws/lambda/api-.*", "/aws/lambda/api-"),
+    ("^prod\\.web", "prod.web"),
+    ("^abc?", "ab"),
+    ("^ab+", "ab"),
+    ("^ab{2}", "a"),
+    ("^a\\d", "a"),
+    ("/aws/lambda", ""),
+    ("^/aws/(lambda|ecs)", ""),
+    ("^a|^b", ""),
+    ("", ""),
+])
+def test_literal_prefix(pattern, prefix):
+    assert literal_prefix(pattern) == prefix
+
+
+class FakeClient(object):
+    def __init__(self, names, page_size=2):
+        self.names = names
+        self.page_size = page_size
+        self.calls = 0
+
+    def describe_log_groups(self, logGroupNamePrefix="", nextToken=None):
+        self.calls += 1
+        names = [name for name in self.names if name.startswith(logGroupNamePrefix)]
+        start = int(nextToken or 0)
+        response = {'logGroups': [{'logGroupName': name} for name
+                                  in names[start:start + self.page_size]]}
+        if start + self.page_size < len(names):
+            response['nextToken'] = str(start + self.page_size)
+        return response
+
+
+def test_cached_list_answers_longer_prefixes(tmp_path):
+    client = FakeClient(["/aws/a", "/aws/b", "/app/c"])
+    cache = LogGroupCache(client, cache_dir=str(tmp_path))
+    assert cache.groups("/a") == ["/aws/a", "/aws/b", "/app/c"]
+    calls = client.calls
+    assert cache.groups("/aws/") == ["/aws/a", "/aws/b"]
+    assert client.calls == calls
+
+
+def test_stale_list_is_refreshed_in_the_background(tmp_path):
+    client = FakeClient(["/aws/a"])
+    cache = LogGroupCache(client, cache_dir=str(tmp_path), ttl=0.01)
+    assert cache.groups() == ["/aws/a"]
+    client.names.append("/aws/new")
+    time.sleep(0.02)
+    updates = []
+    assert cache.groups(on_update=updates.append) == ["/aws/a"]
+    end = time.time() + 5
+    while not updates and time.time() < end:
+        time.sleep(0.01)
+    assert updates == [["/aws/new"]]
+
+
+def test_stale_list_is_refreshed_first_with_wait(tmp_path):
+    client = FakeClient(["/aws/a"])
+    cache = LogGroupCache(client, cache_dir=str(tmp_path), ttl=0.01)
+    cache.groups()
+    client.names.append("/aws/new")
+    time.sleep(0.02)
+    assert cache.groups(wait=True) == ["/aws/a", "/aws/new"]
+
+
+class FailingClient(FakeClient):
+    def describe_log_groups(self, logGroupNamePrefix="", nextToken=None):
+        if nextToken:
+            raise RuntimeError("throttled")
+        return FakeClient.describe_log_groups(self, logGroupNamePrefix, nextToken)
+
+
+def test_groups_found_by_a_refresh_cut_short_are_kept(tmp_path):
+    client = FailingClient(["/aws/a"])
+    cache = LogGroupCache(client, cache_dir=str(tmp_path), ttl=300)
+    cache.groups()
+    client.names[:0] = ["/aws/new"]
+    client.names.append("/aws/later")
+    new = []
+    with pytest.raises(RuntimeError):
+        cache.refresh(on_new=new.extend)
+    assert new == ["/aws/new"]
+    assert LogGroupCache(client, cache_dir=str(tmp_path)).groups() == ["/aws/a", "/aws/new"]
+
+
+def test_forgotten_group_is_not_listed_from_cache(tmp_path):
+    client = FakeClient(["/aws/a", "/aws/gone"])
+    cache = LogGroupCache(client, cache_dir=str(tmp_path))
+    cache.groups("/aws")
+    cache.forget("/aws/gone")
+    calls = client.calls
+    assert cache.groups("/aws") == ["/aws/a"]
+    assert client.calls == calls
@@ -0,0 +1,103 @@
+import json
+
+import pytest
+
+from ec2_utils.emf import Metric, MetricConfig
+
+
+def config(**kwargs):
+    metrics = [Metric("Requests", "count", "GET "),
+               Metric("Latency", "histogram",
+                      r"status=(?P<status>\d+) took=(?P<value>[\d.]+)ms",
+                      unit="Milliseconds", dimensions=["status"])]
+    return MetricConfig(metrics, "App", dimensions={"Service": "api"}, **kwargs)
+
+
+def test_window_becomes_one_event_per_dimension_values():
+    events = []
+    aggregator = config(window=10).aggregator(events.append)
+    assert aggregator.add("GET / status=200 took=10ms", now=100.5)
+    assert aggregator.add(b"GET / status=200 took=30ms", now=105)
+    assert aggregator.add("POST / status=500 took=2.5ms", now=109)
+    assert not aggregator.add("nothing to count", now=109)
+    aggregator.flush_expired(now=109.9)
+    assert events == []
+    aggregator.flush_expired(now=110)
+    documents = [json.loads(event) for event in events]
+    # Metrics with other dimensions go to events of their own
+    assert [document.get("status") for document in documents] == [None, "200", "500"]
+    requests, ok, failed = documents
+    assert requests["Service"] == ok["Service"] == "api"
+    assert requests["Requests"] == 2
+    assert requests["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [["Service"]]
+    assert ok["Latency"]["Count"] == 2
+    assert (ok["Latency"]["Min"], ok["Latency"]["Max"], ok["Latency"]["Sum"]) == \
+        (10, 30, 40)
+    assert failed["Latency"]["Values"] == [pytest.approx(2.5, rel=0.02)]
+    metrics = ok["_aws"]["CloudWatchMetrics"][0]
+    assert ok["_aws"]["Timestamp"] == 100000
+    assert metrics["Namespace"] == "App"
+    assert metrics["Dimensions"] == [["Service", "status"]]
+    assert metrics["Metrics"] == [{"Name": "Latency", "Unit": "Milliseconds",
+                                   "StorageResolution": 1}]
+    assert (aggregator.lines, aggregator.events) == (3, 3)
+
+
+def test_series_beyond_max_series_are_other():
+    events = []
+    aggregator = config(max_series=2, keep_lines=True).aggregator(events.append)
+    for status in ("200", "404", "500", "503"):
+        assert not aggregator.add("status=%s took=1ms" % status, now=0)
+    aggregator.flush()
+    assert [json.loads(event)["status"] for event in events] == ["200", "404", "other"]
+    assert json.loads(events[-1])["Latency"]["Count"] == 2
+
+
+def test_histogram_keeps_at_most_max_values():
+    events = []
+    metrics = [Metric("Size", "histogram", r"size=(\d+)")]
+    aggregator = MetricConfig(metrics, "App").aggregator(events.append)
+    for size in range(1, 100000, 7):
+        aggregator.add("size=%d" % size, now=0)
+    aggregator.flush()
+    value = json.loads(events[0])["Size"]
+    assert len(value["Values"]) <= 100
+    assert sum(value["Counts"]) == value["Count"] == len(range(1, 100000, 7))
+
+
+def test_values_that_are_not_finite_are_skipped():
+    events = []
+    metrics = [Metric("Latency", "histogram", r"took=(\S+)"),
+               Metric("Bytes", "sum", r"bytes=(\S+)")]
+    aggregator = MetricConfig(metrics, "App").aggregator(events.append)
+    for line in ("took=inf", "took=nan", "bytes=-inf", "took=1e999", "took=2"):
+        aggregator.add(line, now=0)
+    aggregator.flush()
+    document = json.loads(events[0])
+    assert document["Latency"]["Count"] == 1
+    assert "Bytes" not in document
+    assert aggregator.lines == 1
+
+
+def test_invalid_metrics():
+    with pytest.raises(ValueError):
+        Metric("Bytes", "sum", "bytes")
+    with pytest.raises(ValueError):
+        Metric("Latency", "average", r"took=(\d+)")
+    with pytest.raises(ValueError):
+        Metric("Latency", "sum", r"took=(\d+)", dimensions=["status"])
+    with pytest.raises(ValueError):
+        MetricConfig([], "App", window=30)
+
+
+def test_from_file(tmp_path):
+    path = tmp_path / "metrics.json"
+    path.write_text(json.dumps({"namespace": "App", "window": 10, "metrics": [
+        {"name": "Bytes", "match": r"bytes=(\d+)", "type": "sum", "unit": "Bytes"}]}))
+    metric_config = MetricConfig.from_file(str(path))
+    assert metric_config.window == 10
+    assert [(metric.name, metric.kind, metric.unit) for metric in metric_config.metrics] == \
+        [("Bytes", "sum", "Bytes")]
+    path.write_text(json.dumps({"namespace": "App", "metrics": []}))
+    with pytest.raises(ValueError):
+        MetricConfig.from_file(str(path))
@@ -0,0 +1,103 @@
+import os
+import time
+
+import ec2_utils.logs
+from ec2_utils.eventcache import EventCache
+from ec2_utils.logs import CloudWatchLogsGroups
+
+from test_fetch import FakeClient, fetcher_for  # noqa: F401
+
+
+def scan(fetcher, cache, start, end, namespace="eu-west-1"):
+    events = []
+    fetcher.submit(cache.scan(fetcher, {'logGroupName': "group", 'startTime': start,
+                                        'endTime': end},
+                              events.append, namespace=namespace)).result(5)
+    return [event['timestamp'] for event in events]
+
+
+def test_cached_ranges_are_read_from_disk(tmp_path, fetcher_for):
+    client = FakeClient()
+    fetcher = fetcher_for(client)
+    cache = EventCache(cache_dir=str(tmp_path), margin=0, segment_events=30)
+    assert scan(fetcher, cache, 0, 9999) == list(range(0, 10000, 100))
+    calls = client.calls
+    key = cache.key("group", namespace="eu-west-1")
+    pieces = cache.coverage(key, 0, 9999)
+    assert len(pieces) > 1
+    assert all(segment for _, _, segment in pieces)
+    assert (pieces[0][0], pieces[-1][1]) == (0, 9999)
+    assert scan(fetcher, cache, 0, 9999) == list(range(0, 10000, 100))
+    assert client.calls == calls
+    # Only the part after the cached range is fetched
+    assert scan(fetcher, cache, 5000, 14999) == list(range(5000, 15000, 100))
+    assert client.calls > calls
+    assert cache.coverage(key, 0, 14999)[-1][2]["end"] == 14999
+
+
+def test_segments_of_other_processes_are_seen(tmp_path, fetcher_for):
+    fetcher = fetcher_for(FakeClient())
+    scan(fetcher, EventCache(cache_dir=str(tmp_path), margin=0), 0, 999)
+    other = EventCache(cache_dir=str(tmp_path), margin=0)
+    pieces = other.coverage(other.key("group", namespace="eu-west-1"), 0, 999)
+    assert [(start, end, bool(segment)) for start, end, segment in pieces] == \
+        [(0, 999, True)]
+    assert not [name for name in os.listdir(str(tmp_path)) if name.endswith(".tmp")]
+
+
+def test_least_recently_used_segments_are_evicted(tmp_path, fetcher_for):
+    fetcher = fetcher_for(FakeClient())
+    cache = EventCache(cache_dir=str(tmp_path), margin=0)
+    for start in (0, 10000, 20000):
+        scan(fetcher, cache, start, start + 9999)
+    segments = sorted(cache.segments(), key=lambda segment: segment["start"])
+    assert [segment["start"] for segment in segments] == [0, 10000, 20000]
+    for age, segment in zip((30, 10, 20), segments):
+        path = os.path.join(str(tmp_path), segment["file"])
+        os.utime(path, (time.time() - age, time.time() - age))
+    cache.max_bytes = sum(segment["bytes"] for segment in segments) - 1
+    cache._evict()
+    assert sorted(segment["start"] for segment in cache.segments()) == [10000, 20000]
+
+
+def test_namespaces_do_not_share_segments(tmp_path, fetcher_for):
+    client = FakeClient()
+    fetcher = fetcher_for(client)
+    cache = EventCache(cache_dir=str(tmp_path), margin=0)
+    scan(fetcher, cache, 0, 999, namespace="111|default|eu-west-1")
+    calls = client.calls
+    scan(fetcher, cache, 0, 999, namespace="222|other|eu-west-1")
+    assert client.calls > calls
+    assert cache.key("group", namespace="111|default|eu-west-1") != \
+        cache.key("group", namespace="222|other|eu-west-1")
+
+
+def test_namespace_has_account_and_profile(tmp_path, monkeypatch):
+    config = tmp_path / "config"
+    config.write_text("[default]\n[profile other]\n")
+    monkeypatch.setenv("AWS_CONFIG_FILE", str(config))
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "key")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "secret")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-west-1")
+    monkeypatch.setattr(ec2_utils.logs, "resolve_account", lambda: "123456789012")
+    namespaces = []
+
+    class Fetcher(object):
+        def for_region(self, region):
+            return self
+
+    class Cache(object):
+        def scan(self, fetcher, params, on_event, on_done=None, on_watermark=None,
+                 namespace=""):
+            namespaces.append(namespace)
+
+    for profile in ("default", "other"):
+        monkeypatch.setenv("AWS_PROFILE", profile)
+        groups = CloudWatchLogsGroups(log_group_filter="group", start_time="2h",
+                                      end_time="1h", event_cache=Cache())
+        groups.fetch_group(Fetcher(), "group", None)
+        groups.fetch_group(Fetcher(), "group", None, region="us-east-1")
+    assert namespaces == ["123456789012|default|eu-west-1",
+                          "123456789012|default|us-east-1",
+                          "123456789012|other|eu-west-1",
+                          "123456789012|other|us-east-1"]
@@ -0,0 +1,55 @@
+import asyncio
+import gzip
+import json
+import os
+
+from ec2_utils.export import EventExporter, file_name
+
+
+def event(group_name, timestamp):
+    return {'timestamp': timestamp, 'logGroupName': group_name,
+            'logStreamName': 'stream', 'message': 'event %d' % timestamp}
+
+
+def read(path):
+    with gzip.open(path, "rb") as export_file:
+        return [json.loads(line) for line in export_file]
+
+
+def test_file_names_of_different_groups_differ():
+    names = set(file_name(group, "jsonl.gz")
+                for group in ("/a/b", "a_b", "a/b", "a b", "a_b-"))
+    assert len(names) == 5
+    assert file_name("plain.name", "jsonl.gz") == "plain.name.jsonl.gz"
+
+
+def test_groups_with_colliding_names_get_files_of_their_own(tmp_path):
+    exporter = EventExporter(str(tmp_path), export_format="jsonl.gz",
+                             row_group_size=2)
+    colliding = "a_b-%s" % file_name("/a/b", "x")[4:-2]
+    for timestamp in range(5):
+        exporter.add("/a/b", event("/a/b", timestamp))
+        exporter.add(colliding, event(colliding, timestamp))
+    exporter.close()
+    assert exporter.errors == []
+    paths = [group_file.path for group_file in exporter.files.values()]
+    assert len(set(paths)) == 2
+    for group_name, group_file in exporter.files.items():
+        events = read(group_file.path)
+        assert [item['timestamp'] for item in events] == list(range(5))
+        assert set(item['logGroupName'] for item in events) == set([group_name])
+    assert sorted(os.listdir(str(tmp_path))) == sorted(
+        os.path.basename(path) for path in paths)
+
+
+def test_add_async_writes_in_order(tmp_path):
+    exporter = EventExporter(str(tmp_path), export_format="jsonl.gz",
+                             row_group_size=10, writer_count=1, max_batches=1)
+
+    async def add_all():
+        for timestamp in range(100):
+            await exporter.add_async("group", event("group", timestamp))
+    asyncio.new_event_loop().run_until_complete(add_all())
+    exporter.close()
+    events = read(exporter.files["group"].path)
+    assert [item['timestamp'] for item in events] == list(range(100))
@@ -0,0 +1,173 @@
+import pytest
+from botocore.exceptions import ClientError
+
+import ec2_utils.fetch
+from ec2_utils.fetch import LogEventsFetcher, PollInterval
+
+
+class FakeClient(object):
+    """ filter_log_events over events at every 100 ms of the range, or an
+    error for the groups in errors
+    """
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.calls = 0
+
+    def filter_log_events(self, **params):
+        self.calls += 1
+        code = self.errors.get(params['logGroupName'])
+        if code:
+            raise ClientError({'Error': {'Code': code, 'Message': code}},
+                              'FilterLogEvents')
+        start = params['startTime'] + (-params['startTime'] % 100)
+        return {'events': [{'timestamp': timestamp, 'message': str(timestamp)}
+                           for timestamp in range(start, params['endTime'] + 1, 100)]}
+
+
+@pytest.fixture
+def fetcher_for():
+    fetchers = []
+
+    def create(client):
+        fetcher = LogEventsFetcher(client=client, delay=0.01).start()
+        fetchers.append(fetcher)
+        return fetcher
+    yield create
+    for fetcher in fetchers:
+        fetcher.stop()
+
+
+def scan(fetcher, group, start, end):
+    events = []
+    done = []
+    future = fetcher.submit(fetcher.scan(
+        {'logGroupName': group, 'startTime': start, 'endTime': end},
+        events.append, on_done=lambda: done.append(True), min_span=100))
+    return future, events, done
+
+
+def test_scan_hands_on_events_in_order(fetcher_for):
+    fetcher = fetcher_for(FakeClient())
+    future, events, done = scan(fetcher, "group", 0, 9999)
+    future.result(5)
+    assert [event['timestamp'] for event in events] == list(range(0, 10000, 100))
+    assert done == [True]
+
+
+def test_scan_of_missing_group_fails_without_retrying(fetcher_for):
+    client = FakeClient(errors={"gone": "ResourceNotFoundException"})
+    fetcher = fetcher_for(client)
+    future, events, done = scan(fetcher, "gone", 0, 9999)
+    with pytest.raises(ClientError):
+        future.result(5)
+    assert events == []
+    assert done == [True]
+    # One call per slice, none of them retried
+    assert client.calls <= 8
+
+
+def test_other_errors_are_retried(fetcher_for):
+    client = FakeClient(errors={"broken": "ServiceUnavailableException"})
+    fetcher = fetcher_for(client)
+    future = fetcher.submit(fetcher.call("filter_log_events",
+                                         logGroupName="broken",
+                                         startTime=0, endTime=1))
+    with pytest.raises(ClientError):
+        future.result(5)
+    assert client.calls == fetcher.tries
+
+
+class RecordingClient(FakeClient):
+    """ FakeClient that records the range of each call and returns at most
+    page_size events a page
+    """
+    def __init__(self, page_size=None):
+        FakeClient.__init__(self)
+        self.page_size = page_size
+        self.ranges = []
+
+    def filter_log_events(self, **params):
+        if 'nextToken' not in params:
+            self.ranges.append((params['startTime'], params['endTime']))
+        response = FakeClient.filter_log_events(self, **params)
+        if self.page_size:
+            skip = int(params.get('nextToken', 0))
+            events = response['events'][skip:]
+            response['events'] = events[:self.page_size]
+            if len(events) > self.page_size:
+                response['nextToken'] = str(skip + self.page_size)
+        return response
+
+
+@pytest.mark.parametrize("start, end", [(0, 9999), (0, 1000), (50, 849), (0, 99)])
+def test_scan_slices_cover_the_range_once(fetcher_for, start, end):
+    client = RecordingClient()
+    fetcher = fetcher_for(client)
+    future, events, _ = scan(fetcher, "group", start, end)
+    future.result(5)
+    ranges = sorted(client.ranges)
+    assert ranges[0][0] == start and ranges[-1][1] == end
+    assert all(earlier[1] + 1 == later[0] for earlier, later in zip(ranges, ranges[1:]))
+    assert [event['timestamp'] for event in events] == \
+        list(range(start + (-start % 100), end + 1, 100))
+
+
+def test_dense_ranges_are_split_without_gaps_or_overlaps(fetcher_for):
+    client = RecordingClient(page_size=5)
+    fetcher = fetcher_for(client)
+    future, events, _ = scan(fetcher, "group", 0, 9999)
+    future.result(5)
+    # Ranges that were split are followed by their halves
+    assert len(client.ranges) > 8
+    leaves = [(start, end) for start, end in client.ranges
+              if not any(other != (start, end) and start <= other[0] and
+                         other[1] <= end for other in client.ranges)]
+    leaves.sort()
+    assert (leaves[0][0], leaves[-1][1]) == (0, 9999)
+    assert all(earlier[1] + 1 == later[0] for earlier, later in zip(leaves, leaves[1:]))
+    assert [event['timestamp'] for event in events] == list(range(0, 10000, 100))
+
+
+def test_poll_interval_backs_off_while_idle_and_resets_on_events():
+    schedule = PollInterval(interval=1.0, max_interval=8.0, hot_rate=100)
+    waits = [schedule.update(0, 1.0) for _ in range(5)]
+    assert schedule.current == 8.0
+    for wait, expected in zip(waits, (2.0, 4.0, 8.0, 8.0, 8.0)):
+        assert expected * 0.9 <= wait <= expected * 1.1
+    assert 0.9 <= schedule.update(3, 8.0) <= 1.1
+    assert schedule.current == 1.0
+
+
+def test_hot_group_is_polled_without_backing_off():
+    schedule = PollInterval(interval=1.0, max_interval=8.0, hot_rate=1.0, weight=0.5)
+    for _ in range(5):
+        schedule.update(20, 1.0)
+    assert schedule.rate > 1.0
+    schedule.update(0, 1.0)
+    assert schedule.current == 1.0
+    # The rate decays on empty polls until the group cools down
+    while schedule.rate >= 1.0:
+        schedule.update(0, 1.0)
+    assert schedule.update(0, 1.0) >= 1.8
+
+
+def test_for_region_gives_one_fetcher_per_region(fetcher_for, monkeypatch):
+    clients = {}
+
+    def logs(region=None, config=None):
+        return clients.setdefault(region, FakeClient())
+    monkeypatch.setattr(ec2_utils.fetch, "logs", logs)
+    default = FakeClient()
+    fetcher = fetcher_for(default)
+    west = fetcher.for_region("eu-west-1")
+    assert fetcher.for_region("eu-west-1") is west
+    east = fetcher.for_region("us-east-1")
+    assert (west.region, east.region) == ("eu-west-1", "us-east-1")
+    # Limits are per region but the loop and threads are shared
+    assert len(set(id(each.limiter) for each in (fetcher, west, east))) == 3
+    assert west._loop is east._loop is fetcher._loop
+    future, events, _ = scan(west, "group", 0, 999)
+    future.result(5)
+    assert len(events) == 10
+    assert clients["eu-west-1"].calls == west.calls > 0
+    assert (default.calls, clients["us-east-1"].calls) == (0, 0)
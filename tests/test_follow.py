@@ -0,0 +1,151 @@
+import os
+import time
+from threading import Thread
+
+from ec2_utils.follow import FileFollower, MultiFollower
+
+
+def wait_for(condition, timeout=5.0):
+    end = time.time() + timeout
+    while time.time() < end:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+
+def start(follower):
+    thread = Thread(target=follower.follow)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def test_reads_existing_and_appended_lines(tmp_path):
+    path = tmp_path / "app.log"
+    path.write_bytes(b"one\ntwo\n")
+    lines = []
+    follower = FileFollower(str(path), lines.append, wait=0.1, binary=True)
+    thread = start(follower)
+    try:
+        assert wait_for(lambda: lines == [b"one\n", b"two\n"])
+        with open(str(path), "ab") as log:
+            log.write(b"three\n")
+        assert wait_for(lambda: lines[-1:] == [b"three\n"])
+    finally:
+        follower.stop()
+        thread.join(5)
+
+
+def test_partial_line_is_handed_over_when_idle(tmp_path):
+    path = tmp_path / "app.log"
+    path.write_bytes(b"complete\nno newline")
+    lines = []
+    follower = FileFollower(str(path), lines.append, wait=0.1, binary=True)
+    thread = start(follower)
+    try:
+        assert wait_for(lambda: lines == [b"complete\n", b"no newline"])
+    finally:
+        follower.stop()
+        thread.join(5)
+
+
+def test_positions_are_line_ends(tmp_path):
+    path = tmp_path / "app.log"
+    path.write_bytes(b"a\nbb\n")
+    seen = []
+    follower = FileFollower(str(path), lambda line, position: seen.append(
+        (line, position[2])), binary=True, with_position=True)
+    follower._open_initial()
+    follower.read_available()
+    follower._close()
+    assert seen == [(b"a\n", 2), (b"bb\n", 5)]
+
+
+def test_multi_follower_picks_up_new_files(tmp_path):
+    first = tmp_path / "first.log"
+    first.write_bytes(b"first\n")
+    lines = []
+
+    def follower_for(file_name):
+        name = os.path.basename(file_name)
+        return {"line_function": lambda line: lines.append((name, line)),
+                "binary": True}
+
+    follower = MultiFollower([str(tmp_path / "*.log")], follower_for, wait=0.1,
+                             rescan_interval=0.1)
+    thread = start(follower)
+    try:
+        assert wait_for(lambda: ("first.log", b"first\n") in lines)
+        (tmp_path / "second.log").write_bytes(b"second\n")
+        assert wait_for(lambda: ("second.log", b"second\n") in lines)
+    finally:
+        follower.stop()
+        thread.join(5)
+
+
+def read_positions(path, start_position=None):
+    seen = []
+    follower = FileFollower(str(path), lambda line, position: seen.append(
+        (line, position)), binary=True, with_position=True,
+        start_position=start_position)
+    return follower, seen
+
+
+def test_truncated_file_is_read_from_the_start(tmp_path):
+    path = tmp_path / "app.log"
+    path.write_bytes(b"old line one\nold line two\n")
+    follower, seen = read_positions(path)
+    follower._open_initial()
+    follower.read_available()
+    with open(str(path), "wb") as log:
+        log.write(b"new\n")
+    follower._check_file()
+    follower._close()
+    assert [line for line, _ in seen] == [b"old line one\n", b"old line two\n",
+                                          b"new\n"]
+
+
+def test_rotated_file_is_drained_before_switching(tmp_path):
+    path = tmp_path / "app.log"
+    path.write_bytes(b"before\n")
+    follower, seen = read_positions(path)
+    follower._open_initial()
+    follower.read_available()
+    with open(str(path), "ab") as log:
+        log.write(b"late\n")
+    os.rename(str(path), str(tmp_path / "app.log.1"))
+    path.write_bytes(b"after\n")
+    follower._check_file()
+    follower._close()
+    assert [line for line, _ in seen] == [b"before\n", b"late\n", b"after\n"]
+
+
+def test_resumes_from_position(tmp_path):
+    path = tmp_path / "app.log"
+    path.write_bytes(b"sent\nnot sent\n")
+    follower, seen = read_positions(path)
+    follower._open_initial()
+    follower.read_available()
+    follower._close()
+    resumed, seen = read_positions(path, start_position=seen[0][1])
+    resumed._open_initial()
+    resumed.read_available()
+    resumed._close()
+    assert [line for line, _ in seen] == [b"not sent\n"]
+
+
+def test_resumes_in_rotated_file(tmp_path):
+    path = tmp_path / "app.log"
+    path.write_bytes(b"sent\nnot sent\n")
+    follower, seen = read_positions(path)
+    follower._open_initial()
+    follower.read_available()
+    follower._close()
+    os.rename(str(path), str(tmp_path / "app.log.1"))
+    path.write_bytes(b"new file\n")
+    resumed, seen = read_positions(path, start_position=seen[0][1])
+    resumed._open_initial()
+    resumed.read_available()
+    resumed._close()
+    assert [line for line, _ in seen] == [b"not sent\n", b"new file\n"]
@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+from ec2_utils.logs import EventFormatter, millis2iso
+
+
+def colored(text, color):
+    """ colored() of termcolor 1.1.0, which colored whatever the output was
+    """
+    return "\033[%dm%s\033[0m" % ({'yellow': 33, 'green': 32, 'cyan': 36}[color], text)
+
+
+def legacy_format(event, color=True):
+    """ The output of logs before EventFormatter: millis2iso, termcolor and
+    uprint
+    """
+    if color:
+        output = [colored(millis2iso(event['timestamp']), 'yellow'),
+                  colored(event['logGroupName'], 'green'),
+                  colored(event['logStreamName'], 'cyan')]
+    else:
+        output = [millis2iso(event['timestamp']), event['logGroupName'],
+                  event['logStreamName']]
+    return ' '.join(output + [event['message']]).strip()
+
+
+def event(timestamp, stream="i-0123|/var/log/app.log#1", message="hello\n"):
+    return {'timestamp': timestamp, 'logGroupName': "group",
+            'logStreamName': stream, 'message': message}
+
+
+TIMESTAMPS = [0, 999, 1000, 1500123456789, 1500123456000, 1500123456001]
+
+
+@pytest.mark.parametrize("color", [True, False])
+def test_text_is_the_same_as_before(color):
+    formatter = EventFormatter(color=color)
+    for timestamp in TIMESTAMPS + TIMESTAMPS:
+        for stream in ("app#1", "i-0123|/var/log/app.log#1", "plain"):
+            assert formatter.format(event(timestamp, stream)) == \
+                legacy_format(event(timestamp, stream), color)
+
+
+def test_shards_are_merged_only_when_asked():
+    assert EventFormatter(color=False).format(event(0, "app#12")).split()[2] == "app#12"
+    merged = EventFormatter(color=False, merge_shards=True)
+    assert merged.format(event(0, "app#12")).split()[2] == "app"
+    assert merged.format(event(0, "i-0123|app#3")).split()[2] == "i-0123|app"
+    line = json.loads(EventFormatter(output="jsonl").format(event(1000, "app#2")))
+    assert line == {'timestamp': 1000, 'logGroupName': "group",
+                    'logStreamName': "app#2", 'message': "hello\n"}
+    line = json.loads(EventFormatter(output="jsonl", merge_shards=True)
+                      .format(event(1000, "app#2")))
+    assert line['logStreamName'] == "app"
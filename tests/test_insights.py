@@ -0,0 +1,67 @@
+from ec2_utils.insights import MAX_RESULTS, InsightsQuery, row_to_event
+
+from test_fetch import fetcher_for  # noqa: F401
+
+
+class FakeInsights(object):
+    """ Insights queries over one event a second from 0 to seconds in each
+    group, returning at most limit rows like the service does
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.queries = {}
+
+    def start_query(self, logGroupNames, startTime, endTime, queryString, limit):
+        query_id = str(len(self.queries))
+        self.queries[query_id] = (logGroupNames, startTime, endTime, queryString, limit)
+        return {'queryId': query_id}
+
+    def get_query_results(self, queryId):
+        groups, start, end, query_string, limit = self.queries[queryId]
+        if "stats" in query_string:
+            return {'status': "Complete",
+                    'results': [[{'field': "count", 'value': str(len(groups))}]]}
+        rows = [[{'field': "@timestamp",
+                  'value': "1970-01-01 %02d:%02d:%02d.000" % (second // 3600,
+                                                              second // 60 % 60,
+                                                              second % 60)},
+                 {'field': "@message", 'value': "%s %d" % (group, second)},
+                 {'field': "@log", 'value': "123456789012:" + group}]
+                for group in groups
+                for second in range(max(0, start), min(self.seconds, end) + 1)]
+        return {'status': "Complete", 'results': rows[:limit]}
+
+
+def run(fetcher, query_string, groups, start, end):
+    rows = []
+    query = InsightsQuery(fetcher, query_string, groups, start, end, rows.append,
+                          poll_interval=0)
+    fetcher.submit(query.run()).result(10)
+    return query, rows
+
+
+def test_query_that_hits_the_limit_is_split_until_all_rows_fit(fetcher_for):
+    client = FakeInsights(seconds=25000)
+    fetcher = fetcher_for(client)
+    query, rows = run(fetcher, "fields @timestamp, @message", ["group"], 0, 24999999)
+    assert query.failed == []
+    assert len(rows) == 25000
+    assert sorted(row_to_event(row)['timestamp'] for row in rows) == \
+        list(range(0, 25000000, 1000))
+    assert len(client.queries) > 3
+    # The ranges that were handed on fit under the limit and split on seconds
+    ranges = sorted((start, end) for _, start, end, _, _ in client.queries.values())
+    assert all(end - start + 1 < MAX_RESULTS for start, end in ranges
+               if not any(other != (start, end) and start <= other[0] and
+                          other[1] <= end for other in ranges))
+
+
+def test_aggregating_query_is_not_split(fetcher_for):
+    client = FakeInsights(seconds=25000)
+    fetcher = fetcher_for(client)
+    groups = ["group%d" % index for index in range(120)]
+    query, rows = run(fetcher, "stats count(*) by bin(1h)", groups, 0, 24999999)
+    # 120 groups are queried 50 at a time
+    assert sorted(len(queried) for queried, _, _, _, _ in client.queries.values()) == \
+        [20, 50, 50]
+    assert sorted(row['count'] for row in rows) == ["20", "50", "50"]
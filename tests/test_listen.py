@@ -0,0 +1,121 @@
+import os
+import socket
+import stat
+import time
+from threading import Thread
+
+import pytest
+
+from ec2_utils.listen import LogListener, parse_address, stream_framing
+
+
+class Sender(object):
+    def __init__(self, messages, source):
+        self.messages = messages
+        self.source = source
+
+    def send(self, message):
+        self.messages.append((self.source, message))
+
+
+@pytest.fixture
+def listening(tmp_path):
+    listeners = []
+
+    def create(kind, **kwargs):
+        messages = []
+        path = str(tmp_path / "log.sock")
+        listener = LogListener([(kind, path)], lambda source: Sender(messages, source),
+                               **kwargs)
+        listener.start()
+        thread = Thread(target=listener.serve)
+        thread.daemon = True
+        thread.start()
+        listeners.append((listener, thread))
+        return path, messages
+    yield create
+    for listener, thread in listeners:
+        listener.stop()
+        thread.join(5)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def send_stream(path, *chunks):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(path)
+    for chunk in chunks:
+        connection.sendall(chunk)
+        time.sleep(0.05)
+    connection.close()
+
+
+def test_framing_is_decided_from_the_first_bytes():
+    assert stream_framing(b"12 <13>1 ") == "octet"
+    assert stream_framing(b"12") is None
+    assert stream_framing(b"12 ") is None
+    assert stream_framing(b"12", final=True) == "newline"
+    assert stream_framing(b"12 apples\n") == "newline"
+    assert stream_framing(b"<13>Jan  1 00:00:00 app: hi\n") == "newline"
+
+
+def test_newline_connection_keeps_lines_that_look_like_frames(listening):
+    path, messages = listening("unix-stream")
+    send_stream(path, b"first line\n", b"5 <13>and more\n", b"last")
+    wait_for(lambda: len(messages) == 3)
+    assert [message for _, message in messages] == \
+        [b"first line", b"5 <13>and more", b"last"]
+    assert {source for source, _ in messages} == {"log.sock"}
+
+
+def test_octet_counted_connection_split_across_reads(listening):
+    path, messages = listening("unix-stream")
+    first = b"<13>Jan  1 00:00:00 app[1]: one\nline"
+    second = b"<13>1 2024-01-01T00:00:00Z host other - - - two"
+    data = b"%d %s%d %s" % (len(first), first, len(second), second)
+    send_stream(path, data[:2], data[2:20], data[20:])
+    wait_for(lambda: len(messages) == 2)
+    assert messages == [("app", b"Jan  1 00:00:00 app[1]: one\nline"),
+                        ("other", b"1 2024-01-01T00:00:00Z host other - - - two")]
+
+
+def test_unix_socket_mode(tmp_path):
+    listener = LogListener([("unix", str(tmp_path / "a.sock")),
+                            ("unix-stream", str(tmp_path / "b.sock"))], None,
+                           socket_mode=0o620)
+    listener.start()
+    try:
+        assert stat.S_IMODE(os.stat(str(tmp_path / "a.sock")).st_mode) == 0o620
+        assert stat.S_IMODE(os.stat(str(tmp_path / "b.sock")).st_mode) == 0o620
+    finally:
+        listener._close()
+    listener = LogListener([("unix", str(tmp_path / "a.sock"))], None)
+    listener.start()
+    try:
+        assert stat.S_IMODE(os.stat(str(tmp_path / "a.sock")).st_mode) == 0o660
+    finally:
+        listener._close()
+
+
+def test_refuses_to_replace_a_file(tmp_path):
+    path = tmp_path / "log.sock"
+    path.write_text("keep me")
+    listener = LogListener([("unix", str(path))], None)
+    with pytest.raises(ValueError):
+        listener.start()
+    assert path.read_text() == "keep me"
+
+
+def test_parse_address_listens_locally_without_a_host():
+    assert parse_address("udp::5140") == ("udp", ("127.0.0.1", 5140))
+    assert parse_address("udp:5140") == ("udp", ("127.0.0.1", 5140))
+    assert parse_address("tcp:0.0.0.0:5140") == ("tcp", ("0.0.0.0", 5140))
+    assert parse_address("tcp:[::1]:5140") == ("tcp", ("::1", 5140))
+    assert parse_address("unix:/dev/log") == ("unix", "/dev/log")
+    with pytest.raises(ValueError):
+        parse_address("udp:localhost")
@@ -0,0 +1,93 @@
+import time
+
+import pytest
+
+import ec2_utils.livetail
+from ec2_utils.fetch import LogEventsFetcher
+from ec2_utils.livetail import LiveTail
+
+import livetail_stub
+
+
+class FakeClient(object):
+    """ filter_log_events that returns one event at the start of ranges with
+    an end and nothing otherwise
+    """
+    def __init__(self):
+        self.calls = []
+
+    def filter_log_events(self, **params):
+        self.calls.append(params)
+        if 'endTime' not in params:
+            return {'events': []}
+        return {'events': [{'timestamp': params['startTime'], 'logStreamName': 'old',
+                            'message': 'old'}]}
+
+
+@pytest.fixture
+def live(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "key")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "secret")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-west-1")
+    monkeypatch.setattr(ec2_utils.livetail, "resolve_account", lambda: "123456789012")
+    servers = []
+    fetchers = []
+
+    def create(sessions_ok):
+        server = livetail_stub.serve(sessions_ok)
+        servers.append(server)
+        client = FakeClient()
+        fetcher = LogEventsFetcher(client=client, delay=0.01).start()
+        fetchers.append(fetcher)
+        live_tail = LiveTail(fetcher, coalesce=0.01, endpoint_url="http://127.0.0.1:%d" %
+                             server.server_port)
+        return live_tail, server, client
+    yield create
+    for fetcher in fetchers:
+        fetcher.stop()
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+def test_restarted_session_backfills_the_gap(live):
+    live_tail, server, client = live(2)
+    events = []
+    start = int(time.time() * 1000) - 60000
+    live_tail.fetcher.submit(live_tail.follow(
+        {'logGroupName': "group", 'startTime': start}, events.append))
+    # Two sessions and then polling once the third one is refused
+    wait_for(lambda: any('endTime' not in call for call in client.calls))
+    assert len(server.requests) == 3
+    assert server.requests[0]['logGroupIdentifiers'] == \
+        ["arn:aws:logs:eu-west-1:123456789012:log-group:group"]
+    live_events = [event for event in events if event['message'].startswith("live")]
+    assert [event['message'] for event in live_events] == \
+        ["live 1 0", "live 1 1", "live 2 0", "live 2 1"]
+    catch_up, gap, poll = client.calls[:3]
+    assert catch_up['startTime'] == start
+    assert catch_up['endTime'] < live_events[0]['timestamp']
+    assert gap['startTime'] == live_events[1]['timestamp'] + 1
+    assert gap['endTime'] < live_events[2]['timestamp']
+    assert poll['startTime'] == live_events[3]['timestamp'] + 1
+    assert len([event for event in events if event['message'] == "old"]) == 2
+
+
+def test_falls_back_to_polling_without_live_tail(live):
+    live_tail, server, client = live(0)
+    events = []
+    start = int(time.time() * 1000) - 60000
+    live_tail.fetcher.submit(live_tail.follow(
+        {'logGroupName': "group", 'startTime': start}, events.append))
+    wait_for(lambda: client.calls)
+    assert len(server.requests) == 1
+    assert client.calls[0]['startTime'] == start
+    assert 'endTime' not in client.calls[0]
+    assert live_tail.sessions == 0
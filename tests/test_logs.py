@@ -0,0 +1,184 @@
+import time
+from threading import Lock
+
+import pytest
+from botocore.exceptions import ClientError
+
+import ec2_utils.logs
+from ec2_utils.logs import EventBatch, LogSender, LogShipper, ShardedLogSender
+
+
+class FakeLogs(object):
+    """ put_log_events that records the messages per stream and fails for
+    the streams in failing, with ResourceNotFoundException for the ones in
+    missing
+    """
+    def __init__(self):
+        self.sent = {}
+        self.calls = {}
+        self.created = []
+        self.failing = set()
+        self.missing = set()
+        self._lock = Lock()
+
+    def create_log_group(self, logGroupName):
+        pass
+
+    def create_log_stream(self, logGroupName, logStreamName):
+        with self._lock:
+            self.created.append(logStreamName)
+            self.missing.discard(logStreamName)
+
+    def put_log_events(self, logGroupName, logStreamName, logEvents):
+        with self._lock:
+            self.calls.setdefault(logStreamName, []).append(time.time())
+            if logStreamName in self.missing:
+                code = "ResourceNotFoundException"
+            elif logStreamName in self.failing:
+                code = "ThrottlingException"
+            else:
+                self.sent.setdefault(logStreamName, []).extend(
+                    event['message'] for event in logEvents)
+                return {}
+        raise ClientError({'Error': {'Code': code, 'Message': code}}, 'PutLogEvents')
+
+
+class Checkpoints(object):
+    def __init__(self):
+        self.positions = []
+
+    def set(self, file_name, position):
+        self.positions.append(position)
+
+
+@pytest.fixture
+def shipper_for(monkeypatch):
+    client = FakeLogs()
+    monkeypatch.setattr(ec2_utils.logs, "logs", lambda: client)
+    monkeypatch.setattr(ec2_utils.logs, "info", lambda: "instance info")
+    shippers = []
+
+    def create(**kwargs):
+        shipper = LogShipper(**kwargs)
+        shippers.append(shipper)
+        return shipper, client
+    yield create
+    for shipper in shippers:
+        with shipper._lock:
+            for sender in shipper._senders:
+                sender._retry_at = 0
+        client.failing.clear()
+        shipper.stop()
+
+
+def sender_for(shipper, stream, **kwargs):
+    return LogSender(stream + ".log", group="group", stream=stream, shipper=shipper,
+                     flush_interval=0.01, send_info=False, **kwargs)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_failing_stream_backs_off_without_holding_up_others(shipper_for):
+    shipper, client = shipper_for(workers=1, flush_interval=0.05)
+    client.failing.add("failing")
+    failing = sender_for(shipper, "failing")
+    healthy = sender_for(shipper, "healthy")
+    failing.send("stuck")
+    time.sleep(0.1)
+    healthy.send("one")
+    wait_for(lambda: client.sent.get("healthy") == ["one"], timeout=1)
+    wait_for(lambda: len(client.calls["failing"]) >= 4)
+    calls = client.calls["failing"]
+    gaps = [later - earlier for earlier, later in zip(calls, calls[1:])]
+    assert gaps[2] > gaps[0] * 2
+    assert failing._failures >= 3
+    client.failing.clear()
+    with shipper._lock:
+        failing._retry_at = 0
+        shipper._wakeup.notify()
+    wait_for(lambda: client.sent.get("failing") == ["stuck"])
+    assert failing._failures == 0
+
+
+def test_deleted_stream_is_created_again(shipper_for):
+    shipper, client = shipper_for(workers=1, flush_interval=0.01)
+    sender = sender_for(shipper, "stream")
+    sender.send("one")
+    wait_for(lambda: client.sent.get("stream") == ["one"])
+    client.missing.add("stream")
+    sender.send("two")
+    wait_for(lambda: client.sent.get("stream") == ["one", "two"])
+    assert client.created == ["stream", "stream"]
+
+
+def test_checkpoint_waits_for_earlier_batches_in_flight(shipper_for):
+    shipper, _ = shipper_for(workers=0)
+    checkpoints = Checkpoints()
+    sender = sender_for(shipper, "stream", checkpoints=checkpoints, max_in_flight=3)
+    batches = []
+    for seq in range(4):
+        batch = EventBatch(0)
+        batch.seq = seq
+        batch.position = (1, 2, seq * 10)
+        batch.empty_lines = 1
+        batches.append(batch)
+    sender._batch_done(batches[2])
+    sender._batch_done(batches[1])
+    assert checkpoints.positions == []
+    sender._batch_done(batches[0])
+    assert checkpoints.positions == [(1, 2, 20)]
+    sender._batch_done(batches[3])
+    assert checkpoints.positions == [(1, 2, 20), (1, 2, 30)]
+
+
+def send_spaced(sender, count, client):
+    """ Send lines far enough apart that each one is sent in a batch of its
+    own, when it is due
+    """
+    for number in range(1, count + 1):
+        sent = sum(len(messages) for messages in client.sent.values())
+        calls = sum(len(calls) for calls in client.calls.values())
+        sender.send("line %d" % number, (1, 2, number * 10))
+        wait_for(lambda: sum(len(calls) for calls in client.calls.values()) > calls or
+                 sum(len(messages) for messages in client.sent.values()) > sent)
+
+
+def test_due_batches_rotate_the_shards(shipper_for):
+    shipper, client = shipper_for(workers=1, flush_interval=0.01)
+    sender = ShardedLogSender("app.log", group="group", stream="app", shards=3,
+                              shipper=shipper, flush_interval=0.01)
+    send_spaced(sender, 6, client)
+    wait_for(lambda: sum(len(messages) for messages in client.sent.values()) == 9)
+    for index in range(3):
+        lines = [message for message in client.sent["app#%d" % index]
+                 if message.startswith("line")]
+        assert len(lines) == 2
+
+
+def test_checkpoint_stays_before_the_lines_of_a_failing_shard(shipper_for):
+    # Shard 1 waits half a second to retry, longer than sending the lines takes
+    shipper, client = shipper_for(workers=1, flush_interval=0.5)
+    checkpoints = Checkpoints()
+    sender = ShardedLogSender("app.log", group="group", stream="app", shards=2,
+                              shipper=shipper, flush_interval=0.01,
+                              checkpoints=checkpoints)
+    wait_for(lambda: len(client.sent) == 2)
+    client.failing.add("app#1")
+    send_spaced(sender, 5, client)
+    wait_for(lambda: "line 5" in client.sent["app#0"])
+    # line 1 went to the failing shard 1 and the rest to shard 0 while
+    # shard 1 waits to retry
+    assert client.sent["app#0"][1:] == ["line 2", "line 3", "line 4", "line 5"]
+    assert checkpoints.positions == []
+    client.failing.clear()
+    with shipper._lock:
+        for shard in sender._shards:
+            shard._retry_at = 0
+        shipper._wakeup.notify()
+    wait_for(lambda: checkpoints.positions[-1:] == [(1, 2, 50)])
+    assert checkpoints.positions == sorted(checkpoints.positions)
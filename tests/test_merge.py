@@ -0,0 +1,74 @@
+import asyncio
+import random
+
+from ec2_utils.merge import WatermarkMerge
+
+
+def run(coroutine):
+    return asyncio.new_event_loop().run_until_complete(coroutine)
+
+
+async def feed(source, timestamps, delay=0):
+    for timestamp in timestamps:
+        await source.put(timestamp, (source.name, timestamp))
+        if delay:
+            await asyncio.sleep(delay * random.random())
+    await source.close()
+
+
+def test_items_come_out_in_timestamp_order():
+    async def main():
+        emitted = []
+        merge = WatermarkMerge(emitted.append, buffer_size=5)
+        streams = {"a": list(range(0, 300, 3)), "b": list(range(1, 300, 7)),
+                   "c": list(range(2, 300, 11))}
+        feeders = [feed(merge.source(name), timestamps, delay=0.001)
+                   for name, timestamps in sorted(streams.items())]
+        await asyncio.gather(merge.run(), *feeders)
+        return emitted, streams
+    emitted, streams = run(main())
+    timestamps = [timestamp for _, timestamp in emitted]
+    assert timestamps == sorted(timestamps)
+    assert len(emitted) == sum(len(values) for values in streams.values())
+
+
+def test_waits_for_the_watermark_of_a_quiet_source():
+    async def main():
+        emitted = []
+        merge = WatermarkMerge(emitted.append)
+        busy = merge.source("busy")
+        quiet = merge.source("quiet")
+        task = asyncio.ensure_future(merge.run())
+        await busy.put(10, "busy 10")
+        await busy.put(20, "busy 20")
+        await asyncio.sleep(0.01)
+        before_watermark = list(emitted)
+        await quiet.advance(15)
+        await asyncio.sleep(0.01)
+        after_watermark = list(emitted)
+        await busy.close()
+        await quiet.close()
+        await task
+        return before_watermark, after_watermark, emitted
+    before_watermark, after_watermark, emitted = run(main())
+    assert before_watermark == []
+    assert after_watermark == ["busy 10"]
+    assert emitted == ["busy 10", "busy 20"]
+
+
+def test_full_buffer_holds_back_a_source_that_is_ahead():
+    async def main():
+        merge = WatermarkMerge(lambda item: None, buffer_size=3)
+        ahead = merge.source("ahead")
+        merge.source("behind")
+        task = asyncio.ensure_future(merge.run())
+        put = asyncio.ensure_future(feed(ahead, range(10)))
+        await asyncio.sleep(0.01)
+        buffered = len(ahead._buffer)
+        blocked = not put.done()
+        put.cancel()
+        task.cancel()
+        return buffered, blocked
+    buffered, blocked = run(main())
+    assert buffered == 3
+    assert blocked
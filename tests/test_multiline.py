@@ -0,0 +1,60 @@
+import pytest
+
+from ec2_utils.multiline import MultilineAssembler
+
+
+def assembler(**kwargs):
+    events = []
+    return MultilineAssembler(lambda line, position: events.append((line, position)),
+                              **kwargs), events
+
+
+def test_start_pattern_begins_events():
+    multiline, events = assembler(start=r"^\d{4}-")
+    for position, line in enumerate(["2024-01-01 first\n", "  at one\n", "  at two\n",
+                                     "2024-01-01 second\n"]):
+        multiline.add(line, position)
+    assert events == [("2024-01-01 first\n  at one\n  at two", 2)]
+    multiline.flush()
+    assert events[1] == ("2024-01-01 second", 3)
+    assert multiline.lines == 4
+    assert multiline.events == 2
+
+
+def test_continuation_pattern_continues_events():
+    multiline, events = assembler(continuation=r"^\s")
+    for line in [b"Traceback\n", b"  File x\r\n", b"Error\n", b"next\n"]:
+        multiline.add(line)
+    multiline.flush()
+    assert [line for line, _ in events] == [b"Traceback\n  File x", b"Error", b"next"]
+
+
+def test_events_are_cut_at_max_lines_and_max_bytes():
+    multiline, events = assembler(start="^start", max_lines=3)
+    for line in ["start"] + ["more"] * 4:
+        multiline.add(line)
+    multiline.flush()
+    assert [line for line, _ in events] == ["start\nmore\nmore", "more\nmore"]
+
+    multiline, events = assembler(start="^start", max_bytes=12)
+    for line in ["start", "12345", "678"]:
+        multiline.add(line)
+    multiline.flush()
+    assert [line for line, _ in events] == ["start\n12345", "678"]
+
+
+def test_flush_expired_waits_for_the_timeout():
+    multiline, events = assembler(start="^start", timeout=5)
+    multiline.add("start")
+    added = multiline._added
+    multiline.flush_expired(added + 4)
+    assert events == []
+    multiline.flush_expired(added + 5)
+    assert events == [("start", None)]
+
+
+def test_needs_start_or_continuation():
+    with pytest.raises(ValueError):
+        MultilineAssembler(print)
+    with pytest.raises(ValueError):
+        MultilineAssembler(print, start="a", continuation="b")
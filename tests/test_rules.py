@@ -0,0 +1,65 @@
+import json
+from threading import Thread
+
+import pytest
+
+from ec2_utils.rules import Rule, RuleSet
+
+
+def test_first_rule_in_the_file_decides():
+    rules = RuleSet([Rule("debug", "drop", "DEBUG"),
+                     Rule("health", "sample", "/health", every=2)])
+    # /health comes first in the line but debug comes first in the file
+    assert rules.apply("/health DEBUG") is None
+    assert rules.apply("GET /health") == "GET /health"
+    assert rules.apply("GET /health") is None
+    assert rules.apply("GET /health") == "GET /health"
+    assert rules.apply("other") == "other"
+    assert rules.counters() == [("debug", "drop", 1, 1),
+                                ("health", "sample", 3, 1)]
+
+
+def test_rate_keeps_per_second_lines_each_second():
+    rule = Rule("errors", "rate", "ERROR", per_second=2)
+    assert [rule.keep(10.1), rule.keep(10.5), rule.keep(10.9)] == [True, True, False]
+    assert [rule.keep(11.0), rule.keep(11.2)] == [True, True]
+    assert (rule.hits, rule.dropped) == (5, 1)
+
+
+def test_redaction_of_kept_lines_in_bytes_and_text():
+    rules = RuleSet([Rule("cards", "redact", r"\b\d{16}\b", replace="<card>"),
+                     Rule("tokens", "redact", "token=\\w+", replace="token=*"),
+                     Rule("noise", "drop", "noise")])
+    assert rules.apply("card 1234567812345678 token=abc") == "card <card> token=*"
+    assert rules.apply(b"token=abc token=def") == b"token=* token=*"
+    assert rules.apply("noise 1234567812345678") is None
+    assert rules.counters() == [("cards", "redact", 1, 0),
+                                ("tokens", "redact", 3, 0),
+                                ("noise", "drop", 1, 1)]
+
+
+def test_redactions_from_many_threads_are_all_counted():
+    rules = RuleSet([Rule("tokens", "redact", "token=\\w+", replace="token=*")])
+
+    def redact():
+        for _ in range(2000):
+            rules.apply("token=a token=b")
+    threads = [Thread(target=redact) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert rules.counters() == [("tokens", "redact", 16000, 0)]
+
+
+def test_from_file(tmp_path):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps({"rules": [
+        {"match": "x", "action": "drop"},
+        {"name": "y", "match": "y", "action": "rate", "per_second": 5}]}))
+    rules = RuleSet.from_file(str(path))
+    assert [(rule.name, rule.action, rule.per_second) for rule in rules.rules] == \
+        [("rule1", "drop", 0), ("y", "rate", 5)]
+    path.write_text(json.dumps({"rules": [{"match": "x", "action": "keep"}]}))
+    with pytest.raises(ValueError):
+        RuleSet.from_file(str(path))
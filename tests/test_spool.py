@@ -0,0 +1,64 @@
+import os
+
+from ec2_utils.logs import EventBatcher
+from ec2_utils.spool import SpillQueue
+
+
+def test_records_come_back_in_order_across_segments(tmp_path):
+    spool = SpillQueue(str(tmp_path), segment_bytes=64)
+    for index in range(20):
+        spool.append({"n": index}, count=2)
+    assert len(spool) == 20
+    assert spool.pending_count == 40
+    assert len(os.listdir(str(tmp_path))) > 1
+    assert [spool.pop()["n"] for _ in range(20)] == list(range(20))
+    assert spool.pop() is None
+    assert spool.pending_bytes == 0
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_oldest_segments_are_dropped_over_max_bytes(tmp_path):
+    spool = SpillQueue(str(tmp_path), max_bytes=200, segment_bytes=64)
+    for index in range(20):
+        spool.append({"n": index})
+    assert spool.pending_bytes <= 200
+    assert spool.dropped_count == 20 - len(spool)
+    assert spool.dropped_bytes > 0
+    remaining = [spool.pop()["n"] for _ in range(len(spool))]
+    assert remaining == list(range(20 - len(remaining), 20))
+
+
+def test_appending_after_reading_everything(tmp_path):
+    spool = SpillQueue(str(tmp_path))
+    spool.append({"n": 1})
+    assert spool.pop() == {"n": 1}
+    assert spool.pop() is None
+    spool.append({"n": 2})
+    assert spool.pop() == {"n": 2}
+
+
+def test_old_segments_are_removed_when_opened(tmp_path):
+    spool = SpillQueue(str(tmp_path))
+    spool.append({"n": 1})
+    reopened = SpillQueue(str(tmp_path))
+    assert len(reopened) == 0
+    assert reopened.pop() is None
+
+
+def test_batcher_spills_batches_over_memory_and_keeps_order(tmp_path):
+    batcher = EventBatcher(max_batch_events=10, max_memory_bytes=1000,
+                           spill_dir=str(tmp_path))
+    for index in range(200):
+        batcher.add(b"line %03d" % index, position=(1, 1, index))
+    assert batcher.spilled_bytes > 0
+    messages = []
+    positions = []
+    while True:
+        batch = batcher.take_batch()
+        if batch is None:
+            break
+        messages.extend(event["message"] for event in batch.events)
+        positions.append(batch.position)
+    assert messages == ["line %03d" % index for index in range(200)]
+    assert positions[-1] == (1, 1, 199)
+    assert batcher.dropped_lines == 0
@@ -0,0 +1,52 @@
+import os
+import socket
+
+import pytest
+
+from ec2_utils.emf import Metric, MetricConfig
+from ec2_utils.follow import MultiFollower
+from ec2_utils.stats import MetricsServer, emf_collector, follower_collector, \
+    format_families
+
+
+def test_follower_collector_reports_unread_and_unsent_bytes(tmp_path):
+    path = tmp_path / "app.log"
+    path.write_bytes(b"one\ntwo\n")
+    follower = MultiFollower([str(path)], lambda file_name: {"line_function": print})
+    follower._scan()
+    (key, file_name, dev, ino, offset), = follower.positions()
+    assert (key, offset) == (str(path), 0)
+    with open(str(path), "ab") as log:
+        log.write(b"three\n")
+    checkpoints = {key: (dev, ino, 4)}
+    families = dict((name, samples) for name, _, _, samples
+                    in follower_collector(follower, checkpoints)())
+    assert families["file_unread_bytes"] == [("", {"file": key}, 14)]
+    assert families["file_unsent_bytes"] == [("", {"file": key}, 10)]
+
+
+def test_emf_collector():
+    metrics = MetricConfig([Metric("Requests", "count", "GET")], "App")
+    aggregator = metrics.aggregator(lambda line: None)
+    aggregator.add("GET /")
+    aggregator.flush()
+    text = format_families(emf_collector(metrics)())
+    assert "log_to_cloudwatch_emf_lines_total 1\n" in text
+    assert "log_to_cloudwatch_emf_events_total 1\n" in text
+
+
+def test_unix_server_replaces_a_socket_but_not_a_file(tmp_path):
+    path = str(tmp_path / "metrics.sock")
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+    server = MetricsServer(("unix", path), [])
+    server.start()
+    server.stop()
+    assert not os.path.exists(path)
+    with open(path, "w") as not_socket:
+        not_socket.write("keep me")
+    with pytest.raises(ValueError):
+        MetricsServer(("unix", path), []).start()
+    with open(path) as not_socket:
+        assert not_socket.read() == "keep me"
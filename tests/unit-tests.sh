@@ -0,0 +1,4 @@
+#!/bin/bash -ex
+
+cd "$(dirname "${BASH_SOURCE[0]}")/.."
+python -m pytest -q tests